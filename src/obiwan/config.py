@@ -1,6 +1,7 @@
 from obiwan.log import logger
 
 import os
+import sys
 import yaml
 
 DEFAULT_CFG_FILE = "conf/obiwan.config.yaml"
@@ -10,12 +11,14 @@ class Config:
     def __init__ ( self, file_path = None ):
         if file_path is None:
             fp = Config.compute_path ( DEFAULT_CFG_FILE )
+        else:
+            fp = os.path.abspath ( file_path )
             
         with open (fp) as yaml_file:
             try:
                 config = yaml.safe_load (yaml_file)
             except Exception as e:
-                logger.error(f"Could not parse YAML configuration file ({file_path})!")
+                logger.error(f"Could not parse YAML configuration file ({fp})!")
                 logger.error(f"Error: {str(e)}")
                 sys.exit (1)
                 
@@ -34,6 +37,12 @@ class Config:
         self.scc_website_credentials = tuple ( config['scc_website_credentials'] )
         self.scc_base_url = config['scc_base_url']
         self.maximum_upload_retry_count = config['scc_maximum_upload_retries']
+        self.scc_requests_per_second = config.get('scc_requests_per_second', 5)
+        self.scc_maximum_request_retries = config.get('scc_maximum_request_retries', 4)
+        self.scc_retry_delay = config.get('scc_retry_delay', 2)
+        self.scc_failures_before_pause = config.get('scc_failures_before_pause', 5)
+        self.scc_pause_time = config.get('scc_pause_time', 60)
+        self.scc_index_lifetime = config.get('scc_index_lifetime', 3600)
         
         # Licel header location types:
         self.measurement_location = config['measurement_location']
@@ -44,6 +53,16 @@ class Config:
         self.min_acceptable_length = config['minimum_measurement_length']
         self.max_acceptable_length = config['maximum_measurement_length']
         self.center_type = config['measurement_center_type']
+        self.folder_date_pattern = config.get('folder_date_pattern', None)
+        self.match_dark_channels = config.get('match_dark_channels', False)
+        
+        # Conversion:
+        self.dark_cache_size = config.get('dark_cache_size', 256)
+        self.conversion_block_size = config.get('conversion_block_size', 0)
+        self.netcdf_compression_level = config.get('netcdf_compression_level', 4)
+        self.netcdf_shuffle = config.get('netcdf_shuffle', True)
+        self.netcdf_chunk_profiles = config.get('netcdf_chunk_profiles', None)
+        self.upload_bandwidth = config.get('upload_bandwidth', 1024)
         
         # Measurements debug:
         self.measurements_debug_dir = Config.compute_path ( config['measurements_debug_dir'] )
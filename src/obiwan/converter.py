@@ -0,0 +1,644 @@
+import importlib
+import multiprocessing
+import netCDF4
+import numpy as np
+import os
+import sys
+import threading
+import time
+
+from collections import namedtuple, OrderedDict
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+
+from atmospheric_lidar import generic
+from atmospheric_lidar.licel import LicelLidarMeasurement
+from obiwan.log import logger
+
+# Number of conversions a worker process runs before being replaced. netCDF4 and
+# atmospheric-lidar don't give back all their memory, so workers are recycled:
+TASKS_PER_WORKER = 10
+
+# Compression of the lidar profiles in SCC NetCDF files:
+# - level: zlib compression level, from 1 to 9. Profiles are not compressed when 0.
+# - shuffle: whether the HDF5 shuffle filter is applied before compressing.
+# - chunk_profiles: number of profiles of a channel stored in each chunk. If None,
+#   the netCDF4 library chooses the chunks.
+NetcdfCompression = namedtuple ( 'NetcdfCompression', [ 'level', 'shuffle', 'chunk_profiles' ] )
+
+# Settings used by atmospheric-lidar on its own:
+DEFAULT_COMPRESSION = NetcdfCompression ( 4, True, None )
+
+# Variables holding the lidar profiles, which make up most of a SCC NetCDF file:
+PROFILE_VARIABLES = ( 'Raw_Lidar_Data', 'Background_Profile' )
+
+# Measurement class used inside the worker processes, set by InitializeWorker:
+worker_measurement_class = None
+
+# Parsed dark measurements of this process, set by UseDarkCache:
+dark_cache = None
+
+# Compression settings of this process, set by UseNetcdfCompression:
+netcdf_compression = None
+
+# Number of raw data files read at a time when converting, set by UseConversionBlocks:
+conversion_block_size = None
+
+# Held while reading or writing NetCDF files. The NetCDF library is not thread safe, and
+# conversions, uploads (which read the measurement ID of their file) and downloads can
+# run in different threads. Only the NetCDF calls are locked, not reading the raw files:
+netcdf_lock = threading.RLock ()
+
+def LoadParametersModule ( netcdf_parameters_path ):
+    '''
+    Imports the lidar system NetCDF parameters module.
+
+    Parameters
+    ----------
+    netcdf_parameters_path : str
+        Path of the python file holding the system parameters.
+    '''
+    folder = os.path.dirname ( netcdf_parameters_path )
+
+    if folder not in sys.path:
+        sys.path.append ( folder )
+
+    module_name = os.path.basename ( netcdf_parameters_path )
+    if module_name.endswith ('.py'):
+        module_name = module_name[:-3]
+
+    return importlib.import_module ( module_name )
+
+def MeasurementClass ( nc_parameters_module ):
+    '''
+    Builds the licel measurement class using the given system parameters.
+    '''
+    class CustomLidarMeasurement(LicelLidarMeasurement):
+        extra_netcdf_parameters = nc_parameters_module
+
+    return CustomLidarMeasurement
+
+def MeasurementSize ( measurement ):
+    '''
+    Computes the memory used by the profiles of a licel measurement, in bytes.
+    '''
+    size = 0
+
+    for channel in measurement.channels.values():
+        size += sum ( data.nbytes for data in channel.data.values() )
+
+        matrix = getattr ( channel, 'matrix', None )
+        if matrix is not None:
+            size += matrix.nbytes
+
+    return size
+
+class DarkMeasurementCache:
+    '''
+    Keeps parsed dark measurements in memory. Consecutive measurements usually get the
+    same dark measurement, which is then read only once. The least recently used dark
+    measurements are dropped when their profiles take more than max_size bytes.
+    '''
+    def __init__ ( self, max_size ):
+        self.max_size = max_size
+        self.size = 0
+        self.entries = OrderedDict ()
+        self.hits = 0
+        self.misses = 0
+
+    def Get ( self, dark_paths, measurement_class ):
+        '''
+        Retrieves the dark measurement made of the given files, reading it if needed.
+        The returned measurement is shared, so it must not be modified.
+
+        Parameters
+        ----------
+        dark_paths : list
+            Paths of the raw dark files.
+        measurement_class : class
+            Licel measurement class used to read the files.
+        '''
+        key = ( measurement_class, tuple ( dark_paths ) )
+        entry = self.entries.get ( key )
+
+        if entry is not None:
+            self.entries.move_to_end ( key )
+            self.hits += 1
+            return entry[0]
+
+        self.misses += 1
+        measurement = measurement_class ( dark_paths )
+        size = MeasurementSize ( measurement )
+
+        if size <= self.max_size:
+            self.entries[key] = ( measurement, size )
+            self.size += size
+
+            while self.size > self.max_size:
+                _, ( _, dropped_size ) = self.entries.popitem ( last = False )
+                self.size -= dropped_size
+
+        return measurement
+
+class ParsedMeasurement:
+    '''
+    Picklable copy of a parsed licel measurement, used for sending dark measurements
+    to the conversion workers. Measurement classes are built at run time (see
+    MeasurementClass) and can't be pickled, so only the parsed data is sent and the
+    workers restore it using their own class.
+    '''
+    def __init__ ( self, measurement ):
+        self.state = measurement.__dict__
+
+    def Restore ( self, measurement_class ):
+        measurement = measurement_class.__new__ ( measurement_class )
+        measurement.__dict__.update ( self.state )
+
+        return measurement
+
+def UseDarkCache ( size ):
+    '''
+    Sets up the dark measurements cache of this process.
+
+    Parameters
+    ----------
+    size : int
+        Maximum size of the cache, in megabytes. Use 0 to disable the cache.
+    '''
+    global dark_cache
+    dark_cache = DarkMeasurementCache ( size * 1024 * 1024 ) if size > 0 else None
+
+def CompressionArguments ( compression, shape ):
+    '''
+    Builds the netCDF4 createVariable arguments for a profiles variable.
+
+    Parameters
+    ----------
+    compression : NetcdfCompression
+        The compression settings.
+    shape : list
+        Sizes of the (time, channels, points) dimensions of the variable.
+    '''
+    if compression.level > 0:
+        arguments = { 'zlib': True, 'complevel': compression.level, 'shuffle': compression.shuffle }
+    else:
+        arguments = { 'zlib': False, 'shuffle': False }
+
+    if compression.chunk_profiles:
+        arguments['chunksizes'] = ( max ( min ( compression.chunk_profiles, shape[0] ), 1 ), 1, shape[2] )
+
+    return arguments
+
+def CompressedDatasetClass ( compression ):
+    '''
+    Builds a netCDF4.Dataset replacement writing the lidar profiles with the given
+    compression settings. The dataset is wrapped rather than subclassed, as netCDF4
+    doesn't clean up subclassed datasets properly.
+    '''
+    class CompressedDataset:
+        def __init__ ( self, *args, **kwargs ):
+            # Attributes set on the wrapper become NetCDF attributes of the dataset:
+            object.__setattr__ ( self, 'dataset', netCDF4.Dataset ( *args, **kwargs ) )
+
+        def __getattr__ ( self, name ):
+            return getattr ( self.dataset, name )
+
+        def __setattr__ ( self, name, value ):
+            setattr ( self.dataset, name, value )
+
+        def __enter__ ( self ):
+            return self
+
+        def __exit__ ( self, *exception ):
+            return self.dataset.__exit__ ( *exception )
+
+        def createVariable ( self, varname, datatype, dimensions = (), **kwargs ):
+            if varname in PROFILE_VARIABLES:
+                kwargs.update ( CompressionArguments ( compression, [ self.dataset.dimensions[name].size for name in dimensions ] ) )
+
+            return self.dataset.createVariable ( varname, datatype, dimensions, **kwargs )
+
+    return CompressedDataset
+
+class NetcdfModule:
+    '''
+    Stands in for the netCDF4 module inside atmospheric-lidar, replacing its Dataset class.
+    '''
+    def __init__ ( self, dataset_class ):
+        self.Dataset = dataset_class
+
+    def __getattr__ ( self, name ):
+        return getattr ( netCDF4, name )
+
+@contextmanager
+def CompressedOutput ( compression ):
+    '''
+    Applies compression settings to the SCC NetCDF files written by atmospheric-lidar.
+    The library has no compression options, so the netCDF4 module it uses is replaced
+    while the context is active.
+
+    Parameters
+    ----------
+    compression : NetcdfCompression or None
+        The compression settings. If None, the library defaults are kept.
+    '''
+    if compression is None:
+        yield
+        return
+
+    original_module = generic.netcdf
+    generic.netcdf = NetcdfModule ( CompressedDatasetClass ( compression ) )
+
+    try:
+        yield
+    finally:
+        generic.netcdf = original_module
+
+def UseNetcdfCompression ( compression ):
+    '''
+    Sets up the compression of the SCC NetCDF files written by this process.
+
+    Parameters
+    ----------
+    compression : NetcdfCompression or None
+        The compression settings. If None, the atmospheric-lidar defaults are used.
+    '''
+    global netcdf_compression
+    netcdf_compression = None if compression == DEFAULT_COMPRESSION else compression
+
+def UseConversionBlocks ( block_size ):
+    '''
+    Limits the number of raw data files held in memory while converting a measurement
+    in this process.
+
+    Parameters
+    ----------
+    block_size : int or None
+        Number of raw data files read at a time. If 0 or None, measurements are read at once.
+    '''
+    global conversion_block_size
+    conversion_block_size = block_size or None
+
+def InitializeWorker ( netcdf_parameters_path, compression = None, block_size = None ):
+    '''
+    Prepares a conversion worker process. The system parameters module is imported
+    only once for each worker. Workers don't keep dark measurements, which are parsed
+    by the main process (see ConversionPool).
+    '''
+    global worker_measurement_class
+    worker_measurement_class = MeasurementClass ( LoadParametersModule ( netcdf_parameters_path ) )
+    UseNetcdfCompression ( compression )
+    UseConversionBlocks ( block_size )
+
+def ReadDarkMeasurement ( dark_paths, measurement_class ):
+    '''
+    Reads a dark measurement, using the dark measurements cache of this process if any.
+    The returned measurement may be shared, so it must not be modified.
+    '''
+    if dark_cache is not None:
+        return dark_cache.Get ( dark_paths, measurement_class )
+
+    return measurement_class ( dark_paths )
+
+def ReadMeasurement ( data_paths, dark_paths, measurement_number, measurement_class, dark_measurement = None ):
+    '''
+    Reads the raw files of a measurement and prepares it for writing the SCC NetCDF file.
+    '''
+    measurement = measurement_class ( data_paths )
+
+    if dark_measurement is not None:
+        measurement.dark_measurement = dark_measurement
+    elif len(dark_paths) > 0:
+        measurement.dark_measurement = ReadDarkMeasurement ( dark_paths, measurement_class )
+
+    measurement = measurement.subset_by_scc_channels ()
+    measurement.set_measurement_id(measurement_number=measurement_number)
+
+    return measurement
+
+def ConvertFiles ( data_paths, dark_paths, measurement_number, file_path, measurement_class = None, dark_measurement = None ):
+    '''
+    Converts a set of licel files to an SCC NetCDF file. This is the CPU bound part of
+    the conversion, so it doesn't touch the datalog and can run in a worker process.
+
+    Parameters
+    ----------
+    data_paths : list
+        Paths of the raw data files.
+    dark_paths : list
+        Paths of the raw dark files. Can be empty.
+    measurement_number : str
+        Number of the measurement in its day, as used in the measurement ID.
+    file_path : str
+        Path of the SCC NetCDF file to write.
+    measurement_class : class or None
+        Licel measurement class holding the system parameters. If None, the class
+        prepared by InitializeWorker is used.
+    dark_measurement : LicelLidarMeasurement or None
+        The dark measurement already read from dark_paths. If None, it is read here.
+
+    Returned value
+    --------------
+    The path of the written SCC NetCDF file.
+    '''
+    if measurement_class is None:
+        measurement_class = worker_measurement_class
+
+    if conversion_block_size is not None and len(data_paths) > conversion_block_size:
+        reason = ConvertInBlocks ( data_paths, dark_paths, measurement_number, file_path, measurement_class, conversion_block_size, dark_measurement )
+
+        if reason is None:
+            return file_path
+
+        measurement_id = os.path.splitext ( os.path.basename ( file_path ) )[0]
+        logger.warning ( "Can't convert %d raw files at a time (%s), reading the whole measurement at once." % ( conversion_block_size, reason ), extra = { 'scope': measurement_id } )
+
+    measurement = ReadMeasurement ( data_paths, dark_paths, measurement_number, measurement_class, dark_measurement )
+
+    with netcdf_lock, CompressedOutput ( netcdf_compression ):
+        measurement.save_as_SCC_netcdf (filename=file_path)
+
+    return file_path
+
+def ConvertInWorker ( parsed_dark, data_paths, dark_paths, measurement_number, file_path ):
+    '''
+    Runs ConvertFiles in a worker process, using the dark measurement parsed by the
+    main process.
+
+    Parameters
+    ----------
+    parsed_dark : ParsedMeasurement or None
+        The dark measurement read from dark_paths, or None if there is none.
+    '''
+    dark_measurement = parsed_dark.Restore ( worker_measurement_class ) if parsed_dark is not None else None
+
+    return ConvertFiles ( data_paths, dark_paths, measurement_number, file_path, dark_measurement = dark_measurement )
+
+def ConvertInBlocks ( data_paths, dark_paths, measurement_number, file_path, measurement_class, block_size, dark_measurement = None ):
+    '''
+    Converts a measurement reading block_size raw data files at a time, so memory use
+    doesn't grow with the measurement length. The SCC NetCDF file is written from the
+    first block, and the profiles of the next blocks are appended along its (unlimited)
+    time dimension.
+
+    This only works if all the channels share the same profile times (otherwise the
+    file holds one time scale for each group of channels) and if the next blocks hold
+    the same channels, with no more bins than in the first block. Otherwise, the
+    conversion is given up.
+
+    Returned value
+    --------------
+    None if the file was written, otherwise the reason why the measurement must be
+    converted at once.
+    '''
+    blocks = [ data_paths[index:index+block_size] for index in range ( 0, len(data_paths), block_size ) ]
+
+    measurement = ReadMeasurement ( blocks[0], dark_paths, measurement_number, measurement_class, dark_measurement )
+
+    if measurement.dimensions['nb_of_time_scales'] != 1:
+        return "the channels don't share the same profile times"
+
+    channel_names = list ( measurement.channels.keys () )
+    start_time = measurement.info['start_time']
+    stop_time = measurement.info['stop_time']
+
+    with netcdf_lock, CompressedOutput ( netcdf_compression ):
+        measurement.save_as_SCC_netcdf (filename=file_path)
+
+    del measurement
+
+    for block in blocks[1:]:
+        try:
+            measurement = measurement_class ( block ).subset_by_channels ( channel_names )
+        except KeyError:
+            return "some raw files don't hold all the channels"
+
+        if measurement.dimensions['nb_of_time_scales'] != 1:
+            return "the channels don't share the same profile times"
+
+        try:
+            with netcdf_lock, netCDF4.Dataset ( file_path, 'a' ) as f:
+                AppendProfiles ( f, measurement, channel_names, start_time )
+        except ( IndexError, ValueError ) as e:
+            return str(e) or type(e).__name__
+
+        stop_time = max ( stop_time, measurement.info['stop_time'] )
+
+    with netcdf_lock, netCDF4.Dataset ( file_path, 'a' ) as f:
+        f.RawData_Stop_Time_UT = stop_time.strftime('%H%M%S')
+
+    return None
+
+def AppendProfiles ( f, measurement, channel_names, start_time ):
+    '''
+    Appends the profiles of a measurement to an SCC NetCDF file, the same way
+    atmospheric-lidar writes them.
+
+    Parameters
+    ----------
+    f : netCDF4.Dataset
+        The SCC NetCDF file, opened for appending.
+    measurement : LicelLidarMeasurement
+        Measurement holding the next profiles, using a single time scale.
+    channel_names : list
+        Channel names, in the order used in the file.
+    start_time : datetime.datetime
+        Start time of the whole measurement.
+
+    Raises
+    ------
+    ValueError
+        If a channel has more bins than the file can hold. Nothing is written then.
+    '''
+    points = len ( f.dimensions['points'] )
+
+    for name in channel_names:
+        if measurement.channels[name].points > points:
+            raise ValueError ( "channel %s has more bins (%d) than in the first raw files (%d)" % ( name, measurement.channels[name].points, points ) )
+
+    first = len ( f.dimensions['time'] )
+    channel = measurement.channels[channel_names[0]]
+    count = len ( channel.time )
+
+    raw_start = np.array ( [ ( time - start_time ).seconds for time in channel.time ] )
+    raw_stop = raw_start + channel.get_duration ()
+
+    f['Raw_Data_Start_Time'][first:first+count, 0] = raw_start
+    f['Raw_Data_Stop_Time'][first:first+count, 0] = raw_stop
+    f['Laser_Pointing_Angle_of_Profiles'][first:first+count, 0] = 0
+    f['Laser_Shots'][first:first+count, :] = np.vstack ( [ measurement.channels[name].laser_shots for name in channel_names ] ).T
+
+    raw_data = f['Raw_Lidar_Data']
+
+    for index, name in enumerate ( channel_names ):
+        channel = measurement.channels[name]
+        raw_data[first:first+count, index, :channel.points] = channel.matrix
+
+def CompareCompression ( data_paths, dark_paths, measurement_number, folder, candidates, measurement_class ):
+    '''
+    Writes the SCC NetCDF file of a measurement once for each compression setting.
+    The raw files are read only once.
+
+    Parameters
+    ----------
+    data_paths, dark_paths, measurement_number :
+        See ConvertFiles.
+    folder : str
+        Folder used for the written files, which are removed afterwards.
+    candidates : list
+        The NetcdfCompression settings to compare.
+    measurement_class : class
+        Licel measurement class holding the system parameters.
+
+    Returned value
+    --------------
+    A list of (compression, write_time, file_size) tuples, holding the write time in
+    seconds and the file size in bytes.
+    '''
+    measurement = ReadMeasurement ( data_paths, dark_paths, measurement_number, measurement_class )
+    results = []
+
+    for index, compression in enumerate ( candidates ):
+        file_path = os.path.join ( folder, f"compression_{index}.nc" )
+
+        started = time.perf_counter ()
+
+        with netcdf_lock, CompressedOutput ( compression ):
+            measurement.save_as_SCC_netcdf (filename=file_path)
+
+        results.append ( ( compression, time.perf_counter () - started, os.path.getsize ( file_path ) ) )
+        os.remove ( file_path )
+
+    return results
+
+# Modules imported by the forkserver process, so workers forked from it start quickly:
+WORKER_PRELOAD_MODULES = [ 'numpy', 'netCDF4', 'atmospheric_lidar.licel' ]
+
+def WorkerContext ():
+    '''
+    Selects how conversion worker processes are started. Workers are never forked from
+    obiwan itself: upload, download and polling threads may be running, and a forked
+    worker would inherit the locks they hold (NetCDF, logging, SSL) in their current
+    state. Workers are forked from a forkserver process where available, which has no
+    other threads, and spawned otherwise.
+    '''
+    if 'forkserver' in multiprocessing.get_all_start_methods ():
+        context = multiprocessing.get_context ( 'forkserver' )
+        context.set_forkserver_preload ( WORKER_PRELOAD_MODULES )
+        return context
+
+    return multiprocessing.get_context ( 'spawn' )
+
+def CanConvertInParallel ():
+    '''
+    Checks if conversion worker processes can be started (see WorkerContext).
+    '''
+    start_methods = multiprocessing.get_all_start_methods ()
+
+    return 'forkserver' in start_methods or 'spawn' in start_methods
+
+class ConversionPool:
+    '''
+    Runs ConvertFiles in a pool of worker processes. Only a few conversions are queued
+    at a time, so measurements can be supplied by a generator, and each worker is
+    replaced after running TASKS_PER_WORKER conversions (on Python 3.11 and later).
+
+    Dark measurements are read by this process, using its dark measurements cache (see
+    UseDarkCache), and sent to the workers along with the conversions. Each dark
+    measurement is then read once for all the workers, and the cache size limits the
+    memory used by all of them.
+    '''
+    def __init__ ( self, workers, netcdf_parameters_path, measurement_class, tasks_per_worker = TASKS_PER_WORKER, compression = None, block_size = None ):
+        self.workers = workers
+        self.netcdf_parameters_path = netcdf_parameters_path
+        self.measurement_class = measurement_class
+        self.tasks_per_worker = tasks_per_worker
+        self.compression = compression
+        self.block_size = block_size
+
+    def NewExecutor ( self ):
+        options = {}
+
+        if sys.version_info >= ( 3, 11 ):
+            options['max_tasks_per_child'] = self.tasks_per_worker
+
+        return ProcessPoolExecutor (
+            max_workers = self.workers,
+            mp_context = WorkerContext (),
+            initializer = InitializeWorker,
+            initargs = ( self.netcdf_parameters_path, self.compression, self.block_size ),
+            **options
+        )
+
+    def Map ( self, tasks ):
+        '''
+        Converts measurements in the worker processes.
+
+        Parameters
+        ----------
+        tasks : iterable
+            (key, arguments) tuples, the arguments being passed to ConvertFiles. If the
+            arguments are None there is nothing to convert, and (key, None, None) is
+            yielded right away.
+
+        Returned value
+        --------------
+        A generator of (key, file_path, error) tuples, in the order the conversions
+        finished. Either file_path or error is None.
+        '''
+        tasks = iter ( tasks )
+        running = {}
+        executor = None
+        exhausted = False
+
+        try:
+            while True:
+                # Keep every worker busy, with one more task waiting for each:
+                while not exhausted and len(running) < 2 * self.workers:
+                    try:
+                        key, arguments = next ( tasks )
+                    except StopIteration:
+                        exhausted = True
+                        break
+
+                    if arguments is None:
+                        yield key, None, None
+                        continue
+
+                    dark_paths = arguments[1]
+
+                    try:
+                        parsed_dark = ParsedMeasurement ( ReadDarkMeasurement ( dark_paths, self.measurement_class ) ) if len(dark_paths) > 0 else None
+                    except Exception as e:
+                        yield key, None, str(e) or type(e).__name__
+                        continue
+
+                    if executor is None:
+                        executor = self.NewExecutor ()
+
+                    try:
+                        future = executor.submit ( ConvertInWorker, parsed_dark, *arguments )
+                    except BrokenProcessPool:
+                        # A worker died (e.g. out of memory), start over with new workers:
+                        executor.shutdown ( wait = False, cancel_futures = True )
+                        executor = self.NewExecutor ()
+                        future = executor.submit ( ConvertInWorker, parsed_dark, *arguments )
+
+                    running[future] = key
+
+                if len(running) == 0:
+                    break
+
+                done, _ = wait ( running, return_when = FIRST_COMPLETED )
+
+                for future in done:
+                    key = running.pop ( future )
+
+                    try:
+                        yield key, future.result (), None
+                    except Exception as e:
+                        yield key, None, str(e) or type(e).__name__
+        finally:
+            if executor is not None:
+                executor.shutdown ( cancel_futures = True )
@@ -1,8 +1,7 @@
 import os
 
 from obiwan.log import logger
-
-from atmospheric_lidar.licel import LicelLidarMeasurement
+from obiwan.lidarchive.lidarchive import ChannelDescriptor, channel_key, channel_signature, read_licel_header
 
 class Channel:
     '''
@@ -17,6 +16,12 @@ class Channel:
         self.analog = licel_channel.is_analog
         self.active = licel_channel.active
         
+    def Key (self):
+        '''
+        Retrieve the properties used when comparing channels, as a hashable tuple.
+        '''
+        return channel_key (self)
+        
     def Equals (self, channel):
         '''
         Compares two lidar channels.
@@ -26,46 +31,59 @@ class Channel:
         channel : Channel
             The channel used for comparison.
         '''
-        if  (self.name == channel.name and
-                self.resolution == channel.resolution and
-                self.laser_used == channel.laser_used and
-                self.adcbits == channel.adcbits and
-                self.analog == channel.analog and
-                self.active == channel.active):
-            
-            return True
-            
-        return False
+        return self.Key () == channel_key (channel)
 
 class System:
     '''
     Helper class to describe a lidar system.
     '''
-    def __init__ (self, file):
+    def __init__ (self, file, channels=None):
+        '''
+        Parameters
+        ----------
+        file : str
+            Path of the raw lidar data file.
+        channels : list or None
+            Channel descriptors of the file, if already known. If None,
+            they are read from the file header.
+        '''
         self.file = None
         self.id = None
         self.channels = []
+        self.signature = None
         
-        self.ReadFromFile (file)
+        if channels is None:
+            self.ReadFromFile (file)
+        else:
+            self.FromChannels (file, channels)
         
     def ReadFromFile (self, file):
         '''
         Reads a sample file to determine the lidar
-        system configuration.
+        system configuration. Only the file header is parsed.
         
         Parameters
         ----------
         file : str
             Path of the raw lidar data file.
         '''
+        self.FromChannels (file, read_licel_header (file)['Channels'])
+        
+    def FromChannels (self, file, channels):
+        '''
+        Describe the lidar system using already known channel descriptors.
+        
+        Parameters
+        ----------
+        file : str
+            Path of the raw lidar data file.
+        channels : list
+            Channel descriptors of the file.
+        '''
         self.file = file
         self.id = os.path.basename (file)
-        measurement = LicelLidarMeasurement ([file])
-        
-        for channel_name, channel in measurement.channels.items():
-            self.channels.append (Channel (channel))
-            
-        del measurement
+        self.channels = [Channel (channel) for channel in channels]
+        self.signature = channel_signature (self.channels)
         
     def Equals (self, system):
         '''
@@ -76,34 +94,27 @@ class System:
         system : System
             The system used for comparison.
         '''
-        # Make a copy of the other system's channel list:
-        other_channels = system.channels[:]
-        
-        if len(self.channels) != len(other_channels):
-            return False
-        
-        for channel in self.channels:
-            found = False
-            for other_channel in other_channels:
-                if channel.Equals (other_channel):
-                    found = True
-                    other_channels.remove (other_channel)
-                    break
-                    
-            if found == False:
-                return False
-           
-        if len (other_channels) > 0:
-            return False
-            
-        return True
+        return self.signature == system.signature
         
 class SystemIndex:
     '''
     Holds an index of lidar systems.
     '''
-    def __init__ (self, folder):
+    def __init__ (self, folder, catalog=None):
+        '''
+        Parameters
+        ----------
+        folder : str
+            Path of the folder holding the sample data files.
+        catalog : HeaderCatalog or None
+            Header catalog used to avoid parsing unchanged sample files
+            on every start.
+        '''
         self.systems = []
+        self.catalog = catalog
+        
+        # System IDs matching each channel signature, filled in as measurements get resolved:
+        self.resolved = {}
         
         self.ReadFolder (folder)
         
@@ -122,10 +133,38 @@ class SystemIndex:
         
         for file in files:
             try:
-                self.systems.append (System (file))
+                self.systems.append (self.ReadSystem (file))
             except Exception:
                 logger.warning ("File %s is not a valid sample file" % file)
                 pass
+                
+        if self.catalog is not None:
+            self.catalog.Commit ()
+            
+    def ReadSystem (self, file):
+        '''
+        Describe the lidar system of a sample file, using the header
+        catalog entry if the file did not change since it was cataloged.
+        
+        Parameters
+        ----------
+        file : str
+            Path of the sample data file.
+        '''
+        if self.catalog is None:
+            return System (file)
+            
+        path = os.path.abspath (file)
+        stat = os.stat (path)
+        info = self.catalog.Lookup (path, stat)
+        
+        if info is not None:
+            return System (file, [ChannelDescriptor (*channel) for channel in info['Channels']])
+            
+        info = read_licel_header (path)
+        self.catalog.Store (path, stat, info, info['Channels'])
+        
+        return System (file, info['Channels'])
         
     def GetSystemId (self, system):
         '''
@@ -133,17 +172,29 @@ class SystemIndex:
         given lidar system. Used to determine the system ID for a
         specific measurement.
         
+        Results are remembered by channel signature, so each distinct
+        configuration is compared against the sample systems only once.
+        
         Parameters
         ----------
-        system : System
-            The system you need to retrieve the ID for.
+        system : str or Lidarchive.MeasurementFile
+            The raw data file of the system you need to retrieve the ID for.
+            The channel signature of a MeasurementFile is reused, otherwise
+            the file header is parsed.
         '''
-        compatible_ids = []
-        system_obj = System (system)
+        signature = getattr (system, 'signature', None)
+        
+        if signature is None:
+            if not isinstance (system, str):
+                system = system.Path ()
+                
+            signature = System (system).signature
+        
+        compatible_ids = self.resolved.get (signature)
         
-        for s in self.systems:
-            if system_obj.Equals (s):
-                compatible_ids.append (s.id)
+        if compatible_ids is None:
+            compatible_ids = [s.id for s in self.systems if s.signature == signature]
+            self.resolved[signature] = compatible_ids
                 
         if len(compatible_ids) == 0:
             raise ValueError ( "Couldn't find a matching configuration." )
@@ -151,4 +202,4 @@ class SystemIndex:
         if len(compatible_ids) > 1:
             raise ValueError ( "More than one configuration matches." )
             
-        return compatible_ids[0]
\ No newline at end of file
+        return compatible_ids[0]
@@ -0,0 +1,125 @@
+import json
+import sqlite3
+from datetime import datetime
+
+class HeaderCatalog:
+    '''
+    Persistent catalog of licel file headers, stored in an SQLite database. Each
+    entry is keyed by the file path and remembers the file size and modification
+    time it was parsed at, so unchanged files can be served without opening them again.
+    '''
+
+    # Bump this whenever the stored information changes, so old catalogs get rebuilt:
+    SCHEMA_VERSION = 1
+
+    DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+    def __init__(self, path):
+        '''
+        Opens (or creates) a header catalog.
+
+        Parameters
+        ----------
+        path : str
+            Path of the SQLite database file.
+        '''
+        self.path = path
+        self.connection = sqlite3.connect(path)
+
+        version = self.connection.execute("PRAGMA user_version").fetchone()[0]
+
+        if version != HeaderCatalog.SCHEMA_VERSION:
+            self.connection.execute("DROP TABLE IF EXISTS files")
+            self.connection.execute("PRAGMA user_version = %d" % HeaderCatalog.SCHEMA_VERSION)
+
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            "path TEXT PRIMARY KEY, "
+            "size INTEGER NOT NULL, "
+            "mtime INTEGER NOT NULL, "
+            "filename TEXT, "
+            "start TEXT NOT NULL, "
+            "stop TEXT NOT NULL, "
+            "site TEXT NOT NULL, "
+            "channels TEXT NOT NULL)"
+        )
+        self.connection.commit()
+
+    def Lookup(self, path, stat):
+        '''
+        Retrieve the cached header information of a file.
+
+        Parameters
+        ----------
+        path : str
+            The absolute file path.
+        stat : os.stat_result
+            The current status of the file, used to check the entry is still valid.
+
+        Returned value
+        --------------
+        A dictionary with the same keys as Lidarchive.ReadInfoFromHeader plus 'Channels'
+        (a list of channel descriptor rows), or None if the file is missing from the
+        catalog or has changed since it was cataloged.
+        '''
+        row = self.connection.execute(
+            "SELECT size, mtime, filename, start, stop, site, channels FROM files WHERE path = ?",
+            (path,)
+        ).fetchone()
+
+        if row is None:
+            return None
+
+        size, mtime, filename, start, stop, site, channels = row
+
+        if size != stat.st_size or mtime != stat.st_mtime_ns:
+            return None
+
+        return {
+            'Filename': filename,
+            'Site': site,
+            'StartDateTime': datetime.strptime(start, HeaderCatalog.DATETIME_FORMAT),
+            'StopDateTime': datetime.strptime(stop, HeaderCatalog.DATETIME_FORMAT),
+            'Channels': json.loads(channels),
+        }
+
+    def Store(self, path, stat, info, channels):
+        '''
+        Add or replace the catalog entry of a file. Changes are written to disk
+        only after calling Commit.
+
+        Parameters
+        ----------
+        path : str
+            The absolute file path.
+        stat : os.stat_result
+            The status of the file when the header was parsed.
+        info : dict
+            Header information, as returned by Lidarchive.ReadInfoFromHeader.
+        channels : list
+            Channel descriptors of the file.
+        '''
+        self.connection.execute(
+            "INSERT OR REPLACE INTO files (path, size, mtime, filename, start, stop, site, channels) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                path,
+                stat.st_size,
+                stat.st_mtime_ns,
+                info['Filename'],
+                info['StartDateTime'].strftime(HeaderCatalog.DATETIME_FORMAT),
+                info['StopDateTime'].strftime(HeaderCatalog.DATETIME_FORMAT),
+                info['Site'],
+                json.dumps([list(channel) for channel in channels]),
+            )
+        )
+
+    def Commit(self):
+        '''
+        Write pending changes to disk.
+        '''
+        self.connection.commit()
+
+    def Close(self):
+        self.connection.commit()
+        self.connection.close()
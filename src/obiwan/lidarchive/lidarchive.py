@@ -1,17 +1,61 @@
 import fileinput
 
-from atmospheric_lidar import licel
-from atmospheric_lidar.licel import LicelLidarMeasurement
+from bisect import bisect_left, bisect_right
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timedelta
+from operator import attrgetter
 import glob
+import hashlib
+import heapq
 import os
 import shutil
+import sys
+
+import numpy as np
+
+from .catalog import HeaderCatalog
+from .segmentation import epoch_arrays, gap_segments, key_ids, length_segments, time_segments
+from .walker import DateFolderWalker
 
 licel_file_header_format = ['Filename',
                             'StartDate StartTime EndDate EndTime Altitude Longtitude Latitude ZenithAngle',
                             # Appart from Site that is read manually
                             'LS1 Rate1 LS2 Rate2 DataSets', ]
 
+licel_file_channel_format = 'active analog_photon laser_used number_of_datapoints 1 HV bin_width wavelength d1 d2 d3 d4 ADCbits number_of_shots discriminator ID'
+
+licel_analog_photon_strings = {'0': 'an', '1': 'ph', '2': 'std_an', '3': 'std_ph'}
+
+# Number of bytes read at once when parsing a licel header. A header line is about
+# 80 bytes long, so this covers files with up to a hundred channels in a single read.
+LICEL_HEADER_READ_SIZE = 8192
+
+# Below this number of files to parse, starting a process pool costs more than it saves:
+PARALLEL_SCAN_MIN_FILES = 100
+
+# Number of bytes read at once when hashing the full content of a file:
+HASH_READ_SIZE = 1 << 20
+
+# When streaming, files are held back until a file starting this many seconds later was
+# read, so folders which don't exactly follow the files' chronology are still read in order:
+STREAM_REORDER_WINDOW = 3600
+
+# When streaming, dark segments starting later than this many seconds after a measurement
+# are not waited for. Same interval FindDarkFiles looks for dark files in:
+DARK_LOOKAHEAD = 86400
+
+# Reference for converting datetime objects to epoch seconds:
+EPOCH = datetime(1970, 1, 1)
+
+# Plain description of a lidar channel. It exposes the same attributes as the
+# atmospheric-lidar channel objects, so it can be used in their place:
+ChannelDescriptor = namedtuple('ChannelDescriptor', ['name', 'resolution', 'wavelength', 'laser_used', 'adcbits', 'is_analog', 'active'])
+
+# Channel lists and signatures shared by all the files with the same channel configuration:
+interned_channels = {}
+interned_signatures = {}
+
 class Lidarchive:
     '''
     Class used to read all files from a licel lidar data folder. It crawls through all the subfolders
@@ -34,6 +78,26 @@ class Lidarchive:
             self.analog = licel_channel.is_analog
             self.active = licel_channel.active
 
+        def Descriptor(self):
+            '''
+            Retrieve a plain description of the channel, suitable for storing on disk.
+            '''
+            return ChannelDescriptor(
+                name=self.name,
+                resolution=self.resolution,
+                wavelength=self.wavelength,
+                laser_used=self.laser_used,
+                adcbits=self.adcbits,
+                is_analog=self.analog,
+                active=self.active
+            )
+
+        def Key(self):
+            '''
+            Retrieve the properties used when comparing channels, as a hashable tuple.
+            '''
+            return channel_key(self)
+
         def Equals(self, channel):
             '''
             Compares two lidar channels.
@@ -43,30 +107,53 @@ class Lidarchive:
             channel : Channel
                 The channel used for comparison.
             '''
-            if (self.name == channel.name and
-                    self.resolution == channel.resolution and
-                    self.laser_used == channel.laser_used and
-                    self.adcbits == channel.adcbits and
-                    self.analog == channel.analog and
-                    self.active == channel.active):
-                return True
-
-            return False
+            return self.Key() == channel_key(channel)
 
     class MeasurementFile:
-        def __init__(self, path, start_datetime, end_datetime, site, type):
-            self.path = path
-            self.start_datetime = start_datetime
-            self.end_datetime = end_datetime
-            self.site = site
-            self.type = type
-
-            licel_measurement = LicelLidarMeasurement([path])
-
-            self.channels = []
+        '''
+        Compact record of a licel file. Start and end times are stored as epoch seconds,
+        while folder paths, sites and channel lists are shared by all the files using them,
+        so millions of files can be kept in memory. The accessors build the datetime objects
+        and the full path when asked for.
+        '''
 
-            for channel_name, channel in licel_measurement.channels.items():
-                self.channels.append(Lidarchive.MeasurementChannel(channel))
+        __slots__ = ('folder', 'name', 'start', 'end', 'site', 'type', 'channels', 'signature')
+
+        def __init__(self, path, start_datetime, end_datetime, site, type, channels=None):
+            # Channels can be provided directly (e.g. from the header catalog),
+            # otherwise they are read from the file header:
+            if channels is None:
+                channels = read_licel_header(path)['Channels']
+
+            self.SetFields(path, to_epoch(start_datetime), to_epoch(end_datetime), site, type, channels)
+
+        def SetFields(self, path, start, end, site, type, channels):
+            folder, self.name = os.path.split(path)
+            self.folder = sys.intern(folder)
+            self.start = start
+            self.end = end
+            self.site = sys.intern(site)
+            self.type = sys.intern(type)
+
+            # Files with the same channel configuration share the same channel objects:
+            self.channels, self.signature = intern_channels(channels)
+
+        def __getstate__(self):
+            return {
+                'path': self.Path(),
+                'start': self.start,
+                'end': self.end,
+                'site': self.site,
+                'type': self.type,
+                'channels': self.channels,
+            }
+
+        def __setstate__(self, state):
+            if 'start_datetime' in state:
+                # Stored before files were kept as compact records:
+                self.SetFields(state['path'], to_epoch(state['start_datetime']), to_epoch(state['end_datetime']), state['site'], state['type'], state['channels'])
+            else:
+                self.SetFields(state['path'], state['start'], state['end'], state['site'], state['type'], state['channels'])
 
         def IsDark(self, dark_location = "Dark"):
             '''
@@ -82,16 +169,22 @@ class Lidarchive:
             return False
 
         def Path(self):
-            return self.path
+            return os.path.join(self.folder, self.name)
             
         def Filename(self):
-            return os.path.basename(self.path)
+            return self.name
 
         def StartDateTime(self):
-            return self.start_datetime
+            return from_epoch(self.start)
 
         def EndDateTime(self):
-            return self.end_datetime
+            return from_epoch(self.end)
+
+        def StartEpoch(self):
+            return self.start
+
+        def EndEpoch(self):
+            return self.end
 
         def Site(self):
             return self.site
@@ -108,26 +201,8 @@ class Lidarchive:
             system : System
                 The system used for comparison.
             '''
-            # Make a copy of the other system's channel list:
-            other_channels = measurement.channels[:]
-
-            if len(self.channels) != len(other_channels):
-                return False
-            for channel in self.channels:
-                found = False
-                for other_channel in other_channels:
-                    if channel.Equals(other_channel):
-                        found = True
-                        other_channels.remove(other_channel)
-                        break
-
-                if found == False:
-                    return False
-
-            if len(other_channels) > 0:
-                return False
-
-            return True
+            # Signatures are interned, so this is usually an identity check:
+            return self.signature is measurement.signature or self.signature == measurement.signature
 
     class Measurement:
         def __init__(self, dark, data, number):
@@ -155,21 +230,395 @@ class Lidarchive:
             except:
                 return "UNKNOWN_MEASUREMENT"
 
+    class DarkIndex:
+        '''
+        Sorted index of dark measurement files, allowing time window queries by
+        binary search instead of scanning all the files.
+        '''
+
+        def __init__(self, files):
+            '''
+            Parameters
+            ----------
+            files : list of MeasurementFile
+                The dark measurement files to index.
+            '''
+            self.files = sorted(files, key=lambda x: x.StartDateTime())
+            self.starts = [f.StartEpoch() for f in self.files]
+            self.ends = [f.EndEpoch() for f in self.files]
+
+            # Longest file duration, used to bound overlap queries:
+            self.max_duration = max([end - start for start, end in zip(self.starts, self.ends)], default=0)
+
+        def Files(self):
+            return self.files
+
+        def StartingBetween(self, start_date, end_date):
+            '''
+            Retrieve the dark files starting inside the [start_date, end_date] interval.
+            '''
+            first = bisect_left(self.starts, to_epoch(start_date))
+            last = bisect_right(self.starts, to_epoch(end_date))
+
+            return self.files[first:last]
+
+        def Overlapping(self, start_date, end_date):
+            '''
+            Retrieve the dark files which overlap the [start_date, end_date] interval.
+            '''
+            start = to_epoch(start_date)
+            end = to_epoch(end_date)
+
+            first = bisect_left(self.starts, start - self.max_duration)
+            last = bisect_right(self.starts, end)
+
+            return [self.files[index] for index in range(first, last) if self.ends[index] >= start]
+
+    class DarkSegmentIndex:
+        '''
+        Dark measurement segments sorted by time, allowing the closest dark segment
+        of a data segment to be found by binary search.
+        '''
+
+        class Timeline:
+            '''
+            Sorted start/end epochs of a set of time ordered segments.
+            '''
+
+            def __init__(self):
+                self.segments = []
+                self.starts = []
+                self.ends = []
+
+                # Latest end among the first n segments and the segment it belongs to:
+                self.max_ends = []
+                self.max_end_indexes = []
+
+            def Append(self, segment):
+                start = segment[0].StartEpoch()
+                end = segment[-1].EndEpoch()
+
+                if len(self.max_ends) > 0 and self.max_ends[-1] >= end:
+                    self.max_ends.append(self.max_ends[-1])
+                    self.max_end_indexes.append(self.max_end_indexes[-1])
+                else:
+                    self.max_ends.append(end)
+                    self.max_end_indexes.append(len(self.segments))
+
+                self.segments.append(segment)
+                self.starts.append(start)
+                self.ends.append(end)
+
+            def Closest(self, data_start, data_end):
+                # Last segment starting before the data ends:
+                last = bisect_right(self.starts, data_end) - 1
+
+                if last >= 0:
+                    # First segment ending after the data starts. If it also started before
+                    # the data ended, the two overlap:
+                    first = bisect_left(self.max_ends, data_start)
+
+                    if first <= last:
+                        return self.segments[first]
+
+                best = None
+                best_gap = None
+
+                # Segments before the data:
+                if last >= 0:
+                    best = self.segments[self.max_end_indexes[last]]
+                    best_gap = data_start - self.max_ends[last]
+
+                # Segments after the data:
+                if last + 1 < len(self.segments):
+                    gap = self.starts[last + 1] - data_end
+
+                    if best_gap is None or gap < best_gap:
+                        best = self.segments[last + 1]
+
+                return best
+
+        def __init__(self, dark_segments):
+            '''
+            Parameters
+            ----------
+            dark_segments : list
+                Lists of dark files, as returned by ContinuousDarkMeasurements.
+            '''
+            dark_segments = sorted([segment for segment in dark_segments if len(segment) > 0], key=lambda x: x[0].StartDateTime())
+
+            self.all = Lidarchive.DarkSegmentIndex.Timeline()
+
+            # Segments grouped by their channel signature:
+            self.by_channels = {}
+
+            for segment in dark_segments:
+                self.all.Append(segment)
+
+                if segment[0].signature not in self.by_channels:
+                    self.by_channels[segment[0].signature] = Lidarchive.DarkSegmentIndex.Timeline()
+
+                self.by_channels[segment[0].signature].Append(segment)
+
+        def Closest(self, data_segment, same_channels=False):
+            '''
+            Find the dark segment closest to a data segment. See Lidarchive.ClosestDarkSegment.
+            '''
+            if len(data_segment) < 1:
+                return []
+
+            timeline = self.all
+
+            if same_channels:
+                timeline = self.by_channels.get(data_segment[0].signature, None)
+
+                if timeline is None:
+                    return []
+
+            closest = timeline.Closest(data_segment[0].StartEpoch(), data_segment[-1].EndEpoch())
+
+            if closest is None:
+                return []
+
+            return closest
+
+    class ContinuousMeasurementStream:
+        '''
+        Incremental version of ComputeContinuousMeasurements. Licel files are added in
+        chronological order and measurements are returned as soon as they are final, so
+        only the files of the measurements still being built are kept in memory.
+
+        A data segment is final once its continuous set of files was closed by a gap and
+        no dark segment seen later could be closer to it. Dark segments starting more than
+        DARK_LOOKAHEAD seconds after a data segment are not waited for.
+        '''
+
+        def __init__(self, archive, max_gap, min_length, max_length, center_type):
+            '''
+            Parameters
+            ----------
+            archive : Lidarchive
+                The archive the files come from, providing the locations and the splitting rules.
+            max_gap, min_length, max_length, center_type
+                Same as for ComputeContinuousMeasurements.
+            '''
+            self.archive = archive
+            self.max_gap = max_gap
+            self.min_length = min_length
+            self.max_length = max_length
+            self.center_type = center_type
+
+            # Files of the dark and data segments still being built:
+            self.dark_group = []
+            self.data_group = []
+
+            # Closed dark segments which can still be the closest to a data segment:
+            self.dark_segments = []
+
+            # Data segments waiting for their dark segment, with their measurement number:
+            self.pending = deque()
+
+            self.measurement_number = 0
+            self.last_start = None
+
+            # Start of the latest file added. No file added later can start earlier:
+            self.position = None
+
+        def Add(self, file):
+            '''
+            Add the next licel file.
+
+            Returned value
+            --------------
+            A list of the measurements which became final.
+            '''
+            self.position = file.StartEpoch()
+            self.CloseGroups()
+
+            if file.IsDark(self.archive.dark_location):
+                if len(self.dark_group) > 0 and not file.HasSameChannelsAs(self.dark_group[0]):
+                    self.CloseDarkGroup()
+
+                self.dark_group.append(file)
+            elif file.Site() == self.archive.measurement_location:
+                if len(self.data_group) > 0 and not file.HasSameChannelsAs(self.data_group[0]):
+                    self.CloseDataGroup()
+
+                self.data_group.append(file)
+
+            return self.Release()
+
+        def Finish(self):
+            '''
+            Signal that no more files will be added.
+
+            Returned value
+            --------------
+            A list of all the remaining measurements.
+            '''
+            self.CloseDarkGroup()
+            self.CloseDataGroup()
+
+            return self.Release(finished=True)
+
+        def CloseGroups(self):
+            '''
+            Close the groups which can not be continued by files starting at the current position.
+            '''
+            if len(self.dark_group) > 0 and self.position - self.dark_group[-1].EndEpoch() > self.max_gap:
+                self.CloseDarkGroup()
+
+            if len(self.data_group) > 0 and self.position - self.data_group[-1].EndEpoch() > self.max_gap:
+                self.CloseDataGroup()
+
+        def CloseDarkGroup(self):
+            if len(self.dark_group) > 0:
+                self.dark_segments.append(self.dark_group)
+                self.dark_group = []
+
+        def CloseDataGroup(self):
+            if len(self.data_group) < 1:
+                return
+
+            if self.center_type != -1:
+                segments = self.archive.FilterByTime(self.data_group, self.min_length, self.max_length, self.center_type)
+            else:
+                segments = self.archive.FilterByLength(self.data_group, self.max_length, self.min_length)
+
+            self.data_group = []
+
+            for segment in segments:
+                # Apply measurement number if necessary:
+                if self.last_start != None and segment[0].StartDateTime().date() == self.last_start.date():
+                    self.measurement_number += 1
+                else:
+                    self.measurement_number = 0
+
+                self.last_start = segment[0].StartDateTime()
+                self.pending.append((segment, self.measurement_number))
+
+        def Release(self, finished=False):
+            '''
+            Retrieve the pending measurements whose dark segment can no longer change, in order.
+            '''
+            released = []
+
+            if len(self.pending) > 0:
+                dark_segment_index = Lidarchive.DarkSegmentIndex(self.dark_segments)
+
+            while len(self.pending) > 0:
+                segment, number = self.pending[0]
+                dark = dark_segment_index.Closest(segment, self.archive.match_dark_channels)
+
+                if not finished and not self.IsFinal(segment, dark):
+                    break
+
+                self.pending.popleft()
+
+                # Do not add last segment if new data files might appear just in case it's a recent dataset:
+                if (datetime.now() - segment[-1].EndDateTime()).total_seconds() >= self.max_gap:
+                    released.append(Lidarchive.Measurement(dark=dark, data=segment, number=number))
+                else:
+                    self.archive.HoldBack(segment)
+
+            self.ForgetDarkSegments()
+
+            return released
+
+        def IsFinal(self, segment, dark):
+            '''
+            Check that no dark segment still to come can be closer to a data segment than the given one.
+            '''
+            data_start = segment[0].StartEpoch()
+            data_end = segment[-1].EndEpoch()
+
+            if len(dark) > 0:
+                dark_start = dark[0].StartEpoch()
+                dark_end = dark[-1].EndEpoch()
+                distance = max(0, dark_start - data_end, data_start - dark_end)
+            else:
+                distance = DARK_LOOKAHEAD
+
+            # Nothing can be closer than an overlapping dark segment:
+            if distance == 0:
+                return True
+
+            distance = min(distance, DARK_LOOKAHEAD)
+
+            # The dark segment being built might be closer once complete:
+            if len(self.dark_group) > 0 and self.dark_group[0].StartEpoch() - data_end < distance:
+                return False
+
+            # Dark segments still to come start after the current position. On equal
+            # distances the earlier dark segment is used, so they can't win then:
+            return self.position - data_end >= distance
+
+        def ForgetDarkSegments(self):
+            '''
+            Drop the dark segments which can not be the closest to any data segment still to come.
+            A segment ending before all remaining data is only needed if no later ending segment
+            with the same channels exists.
+            '''
+            starts = [self.position]
+            if len(self.pending) > 0:
+                starts.append(self.pending[0][0][0].StartEpoch())
+            if len(self.data_group) > 0:
+                starts.append(self.data_group[0].StartEpoch())
+
+            earliest = min(starts)
+            latest_ends = {}
+            kept = []
+
+            for segment in reversed(self.dark_segments):
+                end = segment[-1].EndEpoch()
+                latest_end = latest_ends.get(segment[0].signature, None)
+
+                if end < earliest and latest_end is not None and latest_end > end:
+                    continue
+
+                if end < earliest and (latest_end is None or end > latest_end):
+                    latest_ends[segment[0].signature] = end
+
+                kept.append(segment)
+
+            kept.reverse()
+            self.dark_segments = kept
+
     def __init__(self, **kwargs):
         '''
         Constructs a Lidarchive object.
         '''
         self.folder = None
         self.measurements = []
+        self.dark_index = None
+        self.duplicates = {}
+        self.file_table = None
         self.accepted_gap = 0
         self.accepted_min_length = 0
         self.accepted_max_length = 0
         self.accepted_center_type = -1
         self.continuousMeasurements = []
+        # End (epoch seconds) of the newest data segment left out as too recent:
+        self.held_back_end = None
+        # Paths of the files skipped by StreamFiles, found after newer files were yielded:
+        self.late_files = []
         self.tests = kwargs.get("tests", {})
         self.dark_location = kwargs.get("dark_location", "Dark")
         self.measurement_location = kwargs.get("measurement_location", "N/A")
 
+        # Optional persistent catalog of already parsed file headers:
+        catalog_path = kwargs.get("catalog", None)
+        self.catalog = HeaderCatalog(catalog_path) if catalog_path is not None else None
+
+        # Number of processes used to parse file headers:
+        self.workers = kwargs.get("workers", 1)
+
+        # Only attach dark measurements with the same channels as the data:
+        self.match_dark_channels = kwargs.get("match_dark_channels", False)
+
+        # Date structured folder layout (e.g. "%Y/%m/%d"), used to skip folders outside the requested dates:
+        self.walker = DateFolderWalker(kwargs.get("folder_pattern", None))
+
     def SetFolder(self, folder):
         '''
         Indicate the folder which contains the licel files.
@@ -181,6 +630,9 @@ class Lidarchive:
         '''
         self.folder = os.path.abspath(folder)
         self.measurements = []
+        self.dark_index = None
+        self.duplicates = {}
+        self.file_table = None
 
     def MeasurementWasSent(self, last_end, min_length, max_length):
         '''
@@ -250,35 +702,13 @@ class Lidarchive:
         if len(measurements) < 1:
             return []
 
-        cset = [measurements[0]]
-        last_measurement = measurements[0]
-        distinct_sets = []
-
-        for measurement_index in range(1, len(measurements)):
-            previous_end = measurements[measurement_index - 1].EndDateTime()
-            current_start = measurements[measurement_index].StartDateTime()
-
-            gap_trigger = ((current_start - previous_end).total_seconds() > max_gap) or (
-                        measurements[measurement_index].HasSameChannelsAs(last_measurement) == False)
-
-            location_trigger = False
-            if same_location:
-                if measurements[measurement_index - 1].Site() != measurements[measurement_index].Site():
-                    location_trigger = True
-
-            if gap_trigger == True or location_trigger == True:
-                distinct_sets.append(cset)
-
-                cset = []
-                last_measurement = measurements[measurement_index]
+        starts, ends = epoch_arrays(measurements)
+        keys = [key_ids(map(attrgetter('signature'), measurements))]
 
-            cset.append(measurements[measurement_index])
-
-        if len(cset) > 0:
-            distinct_sets.append(cset)
-
-        return distinct_sets
+        if same_location:
+            keys.append(key_ids(map(attrgetter('site'), measurements)))
 
+        return [measurements[first:stop] for first, stop in gap_segments(starts, ends, max_gap, *keys)]
 
     def FilterByTime(self, measurements, min_length, max_length, center_type):
         '''
@@ -302,82 +732,12 @@ class Lidarchive:
          A list containing lists of measurements
         '''
 
-        remaining_hours = int(max_length / 3600)
-        
-        '''
-        with open(os.path.abspath(time_parameter_file), "r") as f:
-            last_end = f.readlines()[1][:-1]
-        if measurements:
-            was_sent = self.MeasurementWasSent(last_end, min_length, max_length)[0]
-        if not was_sent:
-            return []
-        '''
-
         if len(measurements) < 1:
             return []
 
-        segments = []
-        segment = [measurements[0]]
-
-
-        if measurements[0].EndDateTime().minute - measurements[0].StartDateTime().minute < 0 and center_type == 1:
-            remaining_hours -= 1
-            if remaining_hours == 0:
-                segments.append(segment)
-                segment = []
-                remaining_hours = int(max_length / 3600)
-
-        if measurements[0].StartDateTime().minute <= 30 and measurements[0].EndDateTime().minute >= 30 and center_type == 0:
-            remaining_hours -= 1
-            if remaining_hours == 0:
-                segments.append(segment)
-                segment = []
-                remaining_hours = int(max_length / 3600)
-
-        for i in range(1, len(measurements)):
-            segment.append(measurements[i])
-            if measurements[i].EndDateTime().minute - measurements[i].StartDateTime().minute < 0 and center_type == 1:
-                remaining_hours -= 1
-                if remaining_hours == 0:
-                    segments.append(segment)
-                    segment = []
-                    remaining_hours = int(max_length / 3600)
-                continue
-            if measurements[i].StartDateTime().minute - measurements[i - 1].EndDateTime().minute < 0 and center_type == 1:
-                remaining_hours -= 1
-                if remaining_hours == 0:
-                    segments.append(segment)
-                    segment = []
-                    remaining_hours = int(max_length / 3600)
-                continue
-            if measurements[i].StartDateTime().minute < 30 and measurements[i].EndDateTime().minute >= 30 and center_type == 0:
-                remaining_hours -= 1
-                if remaining_hours == 0:
-                    segments.append(segment)
-                    segment = []
-                    remaining_hours = int(max_length / 3600)
-                continue
-            if measurements[i - 1].EndDateTime().minute < 30 and measurements[i].StartDateTime().minute >= 30 and center_type == 0:
-                remaining_hours -= 1
-                if remaining_hours == 0:
-                    segments.append(segment)
-                    segment = []
-                    remaining_hours = int(max_length / 3600)
-                continue
+        starts, ends = epoch_arrays(measurements)
 
-        if len(segment) > 0:
-            segments.append(segment)
-
-        if len(segments) == 0:
-            return segments
-        if (segments[0][-1].EndDateTime() - segments[0][0].StartDateTime()).total_seconds() < min_length and len(segments) > 1:
-            segments[0].extend(segments[1])
-            segments.remove(segments[1])
-
-        if (segments[-1][-1].EndDateTime() - segments[-1][0].StartDateTime()).total_seconds() < min_length and len(segments) > 1:
-            segments[-2].extend(segments[-1])
-            segments.remove(segments[-1])
-        return segments
+        return [measurements[first:stop] for first, stop in time_segments(starts, ends, min_length, max_length, center_type)]
 
     def FilterByLength(self, measurements, max_length, min_length):
         '''
@@ -402,28 +762,9 @@ class Lidarchive:
         if len(measurements) < 1:
             return []
 
-        last_end = measurements[-1].EndDateTime()
-        segment_start = measurements[0].StartDateTime()
-        segments = []
-        segment = [measurements[0]]
-
-        for index in range(1, len(measurements)):
-            current_start = measurements[index].StartDateTime()
-
-            if (last_end - current_start).total_seconds() < min_length:
-                segment.extend(measurements[index:])
-                segments.append(segment)
-                break
+        starts, ends = epoch_arrays(measurements)
 
-            if (current_start - segment_start).total_seconds() > max_length:
-                segments.append(segment)
-                segment = [measurements[index]]
-                segment_start = measurements[index].StartDateTime()
-                continue
-
-            segment.append(measurements[index])
-
-        return segments
+        return [measurements[first:stop] for first, stop in length_segments(starts, ends, max_length, min_length)]
         
     def CopyTestFiles ( self, out_folder, date_format = "%Y-%m-%d-%H-%M", strict = True ):
         '''
@@ -492,10 +833,10 @@ class Lidarchive:
         return test_valid
 
     def FindDarkFiles(self, measurement_date):
-
-
         '''
-        Retrieve all dark measurements within given time stamps.
+        Retrieve all dark measurements starting at most one day before or after the given
+        date. The dark files are looked up in the index built by ReadFolder, so only the
+        files found by ReadFolder are taken into account and the disk is not accessed.
 
         Parameters
         -----------------
@@ -506,55 +847,13 @@ class Lidarchive:
         -----------------
         A list of all the dark measurements found between the time parameters.
         '''
+        if self.dark_index is None:
+            self.dark_index = Lidarchive.DarkIndex([m for m in self.measurements if m.IsDark(self.dark_location)])
 
         start_date = measurement_date - timedelta(days=1)
         end_date = measurement_date + timedelta(days=1)
 
-        dark_measurements = []
-        # Walk the folder tree:
-        for root, dirs, files, in os.walk(self.folder):
-            for file in files:
-                path = os.path.join(root, file)
-
-                try:
-                    date = self.DateFromFilename(file)
-                except Exception:
-                    # Date could not be determined from the filename
-                    # as this is most likely not a raw licel file!
-                    continue
-
-                if date == None:
-                    continue
-                # Only read the files that are between specified dates:
-                good_file = False
-                if start_date == None:
-                    if end_date == None:
-                        good_file = True
-                    elif date <= end_date:
-                        good_file = True
-                elif end_date == None:
-                    if date >= start_date:
-                        good_file = True
-                elif date >= start_date and date <= end_date:
-                    good_file = True
-
-                if good_file == True:
-                    try:
-                        info = self.ReadInfoFromHeader(path)
-                        measurement = Lidarchive.MeasurementFile(
-                            path=path,
-                            start_datetime=info['StartDateTime'],
-                            end_datetime=info['StopDateTime'],
-                            site=info['Site'],
-                            type=''
-                        )
-
-                        if measurement.IsDark( self.dark_location ):
-                            dark_measurements.append(measurement)
-                    except Exception as e:
-                        pass
-
-        return dark_measurements
+        return self.dark_index.StartingBetween(start_date, end_date)
 
     def IdentifyDarkFile(self, segment, max_gap):
 
@@ -672,7 +971,10 @@ class Lidarchive:
         return self.continuousMeasurements
         
     def ContinuousDarkMeasurements(self, max_gap):
-        dark_measurements = [ m for m in self.measurements if m.IsDark ( self.dark_location ) ]
+        if self.dark_index is not None:
+            dark_measurements = self.dark_index.Files()
+        else:
+            dark_measurements = [ m for m in self.measurements if m.IsDark ( self.dark_location ) ]
         
         dark_segments = self.FilterByGap ( dark_measurements, max_gap, same_location = False )
         
@@ -685,44 +987,86 @@ class Lidarchive:
         
         return data_segments
         
-    @staticmethod
-    def ClosestDarkSegment ( data_segment, dark_segments ):
-        data_start = data_segment[0].StartDateTime()
-        data_end = data_segment[0].EndDateTime()
-        
-        closest = None
-        best_dark_segment = None
+    def FileTable(self):
+        '''
+        Retrieve the start and end times, channel signatures and sites of the files found
+        by ReadFolder as arrays, so they can be segmented without going through the
+        MeasurementFile objects again. The arrays are built once for each file list.
+
+        Returned value
+        --------------
+        A tuple holding the start and end epoch arrays, the signature id and site id
+        arrays and a dictionary giving the id of each site.
+        '''
+        if self.file_table is None or self.file_table[0] is not self.measurements or len(self.file_table[1][0]) != len(self.measurements):
+            starts, ends = epoch_arrays(self.measurements)
+            site_ids = {}
+            signatures = key_ids(map(attrgetter('signature'), self.measurements))
+            sites = key_ids(map(attrgetter('site'), self.measurements), site_ids)
+
+            self.file_table = (self.measurements, (starts, ends, signatures, sites, site_ids))
+
+        return self.file_table[1]
         
-        for index, dark_segment in enumerate(dark_segments):
-            dark_start = data_segment[0].StartDateTime()
-            dark_end = data_end = data_segment[0].EndDateTime()
-            
-            if dark_end < data_start:
-                # Dark measurements were taken before data measurements.
-                time_gap = data_start - dark_end
-            elif dark_start > data_end:
-                # Dark measurements were taken after data measurements.
-                time_gap = dark_start - data_end
-            else:
-                # Dark measurements and data measurements overlap so set
-                # the time gap to zero.
-                #
-                # We can also safely assume no other dark segment will come
-                # close to this performance. :P
-                time_gap = timedelta(seconds=0)
-                return dark_segment
-                
-            if closest is None:
-                closest = time_gap
-                best_dark_segment = index
-            elif time_gap < closest:
-                closest = time_gap
-                best_dark_segment = index
-                
-        if best_dark_segment is None:
+    def ContinuousDataSegments(self, max_gap, min_length, max_length, center_type):
+        '''
+        Split the data files into measurements. Gives the same result as splitting each
+        group returned by ContinuousDataMeasurements with FilterByTime (or FilterByLength
+        if center_type is -1), but works on the file table.
+
+        Returned value
+        --------------
+        A list of lists of data files, one for each measurement.
+        '''
+        starts, ends, signatures, sites, site_ids = self.FileTable()
+
+        if self.measurement_location == self.dark_location or self.measurement_location not in site_ids:
             return []
-            
-        return dark_segments[index]
+
+        data = np.flatnonzero(sites == site_ids[self.measurement_location])
+        data_starts = starts[data]
+        data_ends = ends[data]
+        data_signatures = signatures[data]
+        data = data.tolist()
+
+        segments = []
+
+        for first, stop in gap_segments(data_starts, data_ends, max_gap, data_signatures):
+            if center_type != -1:
+                pairs = time_segments(data_starts[first:stop], data_ends[first:stop], min_length, max_length, center_type)
+            else:
+                pairs = length_segments(data_starts[first:stop], data_ends[first:stop], max_length, min_length)
+
+            for segment_first, segment_stop in pairs:
+                segments.append([self.measurements[index] for index in data[first + segment_first:first + segment_stop]])
+
+        return segments
+        
+    @staticmethod
+    def ClosestDarkSegment ( data_segment, dark_segments, same_channels = False ):
+        '''
+        Find the dark segment closest in time to a data segment. A dark segment overlapping
+        the data segment is always preferred. When two dark segments are equally close, the
+        earlier one is used.
+
+        Parameters
+        ----------
+        data_segment : list of MeasurementFile
+            The data files of the measurement.
+        dark_segments : DarkSegmentIndex or list
+            The dark segments to choose from. Passing a DarkSegmentIndex avoids rebuilding
+            the index for every data segment.
+        same_channels : boolean
+            Only consider dark segments with the same channels as the data segment.
+
+        Returned value
+        --------------
+        The closest dark segment, or an empty list if none could be found.
+        '''
+        if not isinstance ( dark_segments, Lidarchive.DarkSegmentIndex ):
+            dark_segments = Lidarchive.DarkSegmentIndex ( dark_segments )
+
+        return dark_segments.Closest ( data_segment, same_channels )
 
     def ComputeContinuousMeasurements(self, max_gap, min_length, max_length, center_type):
         '''
@@ -743,6 +1087,7 @@ class Lidarchive:
             previous one.
         '''
         self.continuousMeasurements = []
+        self.held_back_end = None
 
         if len(self.measurements) < 1:
             self.accepted_gap = max_gap
@@ -751,50 +1096,59 @@ class Lidarchive:
             self.accepted_center_type = center_type
             return
             
-        gapped_dark_segments = self.ContinuousDarkMeasurements ( max_gap )
-        gapped_data_segments = self.ContinuousDataMeasurements ( max_gap )
+        dark_segment_index = Lidarchive.DarkSegmentIndex ( self.ContinuousDarkMeasurements ( max_gap ) )
+        data_segments = self.ContinuousDataSegments ( max_gap, min_length, max_length, center_type )
 
         measurement_number = 0
         last_start = None
 
-        for continuous in gapped_data_segments:
-            # First file in continuous should be a dark file:
-            #segments = self.FilterByLength(continuous, max_length, min_length)
-            if center_type != -1:
-                segments = self.FilterByTime(continuous, min_length, max_length, center_type) #, time_parameter_file)
-            else:
-                segments = self.FilterByLength(continuous, max_length, min_length)
-                
-            for segment in segments:
-                # This is already filtered
-                real_measurements = segment
-                # Need to find closest continuous dark segment:
-                dark_measurements = Lidarchive.ClosestDarkSegment(data_segment = segment, dark_segments = gapped_dark_segments)
+        for segment in data_segments:
+            # This is already filtered
+            real_measurements = segment
+            # Need to find closest continuous dark segment:
+            dark_measurements = Lidarchive.ClosestDarkSegment(data_segment = segment, dark_segments = dark_segment_index, same_channels = self.match_dark_channels)
 
-                # Apply measurement number if necessary:
-                if last_start != None:
-                    if segment[0].StartDateTime().date() != last_start.date():
-                        measurement_number = 0
-                    else:
-                        measurement_number += 1
-                else:
+            # Apply measurement number if necessary:
+            if last_start != None:
+                if segment[0].StartDateTime().date() != last_start.date():
                     measurement_number = 0
+                else:
+                    measurement_number += 1
+            else:
+                measurement_number = 0
 
-                last_start = segment[0].StartDateTime()
+            last_start = segment[0].StartDateTime()
 
-                # Do not add last segment if new data files might appear just in case it's a recent dataset:
-                if (datetime.now() - segment[-1].EndDateTime()).total_seconds() >= max_gap:
-                    self.continuousMeasurements.append(Lidarchive.Measurement(
-                        dark=dark_measurements,
-                        data=real_measurements,
-                        number=measurement_number
-                    ))
+            # Do not add last segment if new data files might appear just in case it's a recent dataset:
+            if (datetime.now() - segment[-1].EndDateTime()).total_seconds() >= max_gap:
+                self.continuousMeasurements.append(Lidarchive.Measurement(
+                    dark=dark_measurements,
+                    data=real_measurements,
+                    number=measurement_number
+                ))
+            else:
+                self.HoldBack(segment)
 
         self.accepted_gap = max_gap
         self.accepted_min_length = min_length
         self.accepted_max_length = max_length
         self.accepted_center_type = center_type
 
+    def HoldBack(self, segment):
+        '''
+        Remember a data segment left out of the continuous measurements because it ended
+        less than the maximum gap ago, and might still be continued by new files.
+
+        Parameters
+        ----------
+        segment : list
+            The MeasurementFile objects of the data segment.
+        '''
+        end = segment[-1].EndEpoch()
+
+        if self.held_back_end is None or end > self.held_back_end:
+            self.held_back_end = end
+
     def Measurements(self):
         '''
         Retrieve all licel files inside the folder.
@@ -875,25 +1229,296 @@ class Lidarchive:
 
         Returned value
         --------------
-        A dictionary containing the information read from the licel file header.
+        A dictionary containing the information read from the licel file header,
+        including the descriptors of all the channels in the file.
+        '''
+        return read_licel_header(file)
+
+    def ReadMeasurementFile(self, path):
+        '''
+        Build the MeasurementFile object describing a licel file. If a header catalog
+        is used and the file did not change since it was cataloged, the file is not opened.
+
+        Parameters
+        ----------
+        path : str
+            The absolute file path.
+
+        Returned value
+        --------------
+        A MeasurementFile object.
+        '''
+        measurement, stat = self.CatalogedMeasurementFile(path)
+
+        if measurement is not None:
+            return measurement
+
+        return self.MeasurementFileFromHeader(path, self.ReadInfoFromHeader(path), stat)
+
+    def CatalogedMeasurementFile(self, path):
+        '''
+        Look up a licel file in the header catalog.
+
+        Parameters
+        ----------
+        path : str
+            The absolute file path.
+
+        Returned value
+        --------------
+        A tuple holding the MeasurementFile object (or None if the file is not cataloged
+        or changed since) and the file status used for the lookup (None if no catalog is used).
+        '''
+        if self.catalog is None:
+            return (None, None)
+
+        stat = os.stat(path)
+        info = self.catalog.Lookup(path, stat)
+
+        if info is None:
+            return (None, stat)
+
+        measurement = Lidarchive.MeasurementFile(
+            path=path,
+            start_datetime=info['StartDateTime'],
+            end_datetime=info['StopDateTime'],
+            site=info['Site'],
+            type='',
+            channels=[ChannelDescriptor(*channel) for channel in info['Channels']]
+        )
+
+        return (measurement, stat)
+
+    def MeasurementFileFromHeader(self, path, info, stat=None):
+        '''
+        Build the MeasurementFile object from already parsed header information,
+        adding it to the header catalog if one is used.
+
+        Parameters
+        ----------
+        path : str
+            The absolute file path.
+        info : dict
+            Header information, as returned by ReadInfoFromHeader.
+        stat : os.stat_result or None
+            The file status taken before the header was parsed.
+
+        Returned value
+        --------------
+        A MeasurementFile object.
+        '''
+        measurement = Lidarchive.MeasurementFile(
+            path=path,
+            start_datetime=info['StartDateTime'],
+            end_datetime=info['StopDateTime'],
+            site=info['Site'],
+            type='',
+            channels=info['Channels']
+        )
+
+        if self.catalog is not None and stat is not None:
+            self.catalog.Store(path, stat, info, info['Channels'])
+
+        return measurement
+
+    def ReadHeaders(self, paths):
+        '''
+        Parse the headers of several licel files, using a process pool if more than
+        one worker was configured.
+
+        Parameters
+        ----------
+        paths : list of str
+            The absolute file paths.
+
+        Returned value
+        --------------
+        A list with a (info, error) tuple for each of the paths, in the same order.
+        One of the two values is always None.
+        '''
+        if self.workers < 2 or len(paths) < PARALLEL_SCAN_MIN_FILES:
+            return [read_licel_header_safe(path) for path in paths]
+
+        chunksize = max(1, len(paths) // (self.workers * 8))
+
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            return list(executor.map(read_licel_header_safe, paths, chunksize=chunksize))
+
+    def RemoveDuplicates(self, paths):
+        '''
+        Remove the copies of the same file stored in different folders.
+
+        Since we're walking down the folder tree, it might just so happen that
+        some files are stored multiple times in different folders. When that
+        happens, atmospheric-lidar is confused and throws errors, so only the
+        first copy (in walk order) is kept. Files sharing a name are compared by
+        size, then by a hash of their header block and only then by a hash of
+        their full content, so files with the same name but different content
+        are all kept.
+
+        The dropped copies are recorded in the duplicates dictionary, keyed by
+        the path of the kept copy.
+
+        Parameters
+        ----------
+        paths : list
+            Paths of the files found while walking the folder.
+
+        Returned value
+        --------------
+        The list of paths without duplicates, in the same order.
         '''
-        raw_info = {}
+        self.duplicates = {}
+
+        by_name = {}
+        for path in paths:
+            by_name.setdefault(os.path.basename(path), []).append(path)
+
+        dropped = set()
+
+        for name, same_name in by_name.items():
+            if len(same_name) < 2:
+                continue
+
+            # Copies kept so far, keyed by size and header block hash. Each one
+            # also holds its full content hash, computed only when needed:
+            kept = {}
 
-        # Read the file header:
-        f = licel.LicelFile(file, use_id_as_name=True, import_now=False)
-        f.import_header_only()
+            for path in same_name:
+                try:
+                    key = (os.path.getsize(path), file_digest(path, LICEL_HEADER_READ_SIZE))
+                except OSError as e:
+                    print(str(e))
+                    continue
+
+                candidates = kept.setdefault(key, [])
+                duplicate_of = None
+
+                if len(candidates) > 0:
+                    try:
+                        digest = file_digest(path)
+
+                        for candidate in candidates:
+                            if candidate[1] is None:
+                                candidate[1] = file_digest(candidate[0])
+
+                            if candidate[1] == digest:
+                                duplicate_of = candidate[0]
+                                break
+                    except OSError as e:
+                        print(str(e))
+                        continue
+                else:
+                    digest = None
+
+                if duplicate_of is not None:
+                    self.duplicates.setdefault(duplicate_of, []).append(path)
+                    dropped.add(path)
+                else:
+                    candidates.append([path, digest])
 
-        raw_info['Filename'] = f.raw_info['Filename']
-        raw_info['Site'] = f.raw_info['site']
+            if sum(len(candidates) for candidates in kept.values()) > 1:
+                print("Found different files named %s, all of them are kept" % name)
 
-        # Construct a datetime object from the time and date information in the header:
-        start_string = '%s %s' % (f.raw_info['start_date'], f.raw_info['start_time'])
-        stop_string = '%s %s' % (f.raw_info['end_date'], f.raw_info['end_time'])
+        return [path for path in paths if path not in dropped]
 
-        raw_info['StartDateTime'] = datetime.strptime(start_string, '%d/%m/%Y %H:%M:%S')
-        raw_info['StopDateTime'] = datetime.strptime(stop_string, '%d/%m/%Y %H:%M:%S')
+    def FilesInInterval(self, root, files, start_date=None, end_date=None):
+        '''
+        Select the licel files of a folder taken between two dates, judging by their names.
 
-        return raw_info
+        Parameters
+        ----------
+        root : str
+            Path of the folder.
+        files : list
+            Names of the files inside the folder.
+        start_date : datetime or None
+            Earliest accepted date. If set to None, this 'filter' will not be used.
+        end_date : datetime or None
+            Latest accepted date. If set to None, this 'filter' will not be used.
+
+        Returned value
+        --------------
+        A list of (path, date) tuples, date being read from the file name.
+        '''
+        selected = []
+
+        for file in files:
+            try:
+                date = self.DateFromFilename(file)
+            except Exception:
+                # Date could not be determined from the filename
+                # as this is most likely not a raw licel file!
+                continue
+
+            if date == None:
+                continue
+
+            # Only read the files that are between specified dates:
+            good_file = False
+            if start_date == None:
+                if end_date == None:
+                    good_file = True
+                elif date <= end_date:
+                    good_file = True
+            elif end_date == None:
+                if date >= start_date:
+                    good_file = True
+            elif date >= start_date and date <= end_date:
+                good_file = True
+
+            if good_file == True:
+                selected.append((os.path.join(root, file), date))
+
+        return selected
+
+    def ReadFiles(self, paths):
+        '''
+        Build the MeasurementFile objects of several licel files. Unchanged files are
+        served from the header catalog and only the rest are parsed.
+
+        Parameters
+        ----------
+        paths : list
+            The absolute file paths.
+
+        Returned value
+        --------------
+        A list of MeasurementFile objects, in the same order as the paths. Files which
+        could not be read are left out.
+        '''
+        measurements = [None] * len(paths)
+        stats = [None] * len(paths)
+        to_parse = []
+
+        for index, path in enumerate(paths):
+            try:
+                measurements[index], stats[index] = self.CatalogedMeasurementFile(path)
+            except Exception as e:
+                print(str(e))
+                continue
+
+            if measurements[index] is None:
+                to_parse.append(index)
+
+        headers = self.ReadHeaders([paths[index] for index in to_parse])
+
+        # Merge the parsed headers back in the original order, so the result
+        # does not depend on the number of workers:
+        for index, (info, error) in zip(to_parse, headers):
+            if error is not None:
+                print(error)
+                continue
+
+            try:
+                measurements[index] = self.MeasurementFileFromHeader(paths[index], info, stats[index])
+            except Exception as e:
+                print(str(e))
+
+        if self.catalog is not None:
+            self.catalog.Commit()
+
+        return [m for m in measurements if m is not None]
 
     def ReadFolder(self, start_date=None, end_date=None):
         '''
@@ -912,59 +1537,146 @@ class Lidarchive:
         # Reset measurements set:
         self.measurements = []
 
-        # Walk the folder tree:
-        for root, dirs, files in os.walk(self.folder):
-            for file in files:
-                path = os.path.join(root, file)
+        paths = []
 
-                try:
-                    date = self.DateFromFilename(file)
-                except Exception:
-                    # Date could not be determined from the filename
-                    # as this is most likely not a raw licel file!
-                    continue
+        # Walk the folder tree, skipping date folders outside the requested interval:
+        for root, files in self.walker.Walk(self.folder, start_date, end_date):
+            paths.extend(path for path, date in self.FilesInInterval(root, files, start_date, end_date))
 
-                if date == None:
-                    continue
+        # Drop the physical copies of the same file before parsing anything:
+        paths = self.RemoveDuplicates(paths)
 
-                # Only read the files that are between specified dates:
-                good_file = False
-                if start_date == None:
-                    if end_date == None:
-                        good_file = True
-                    elif date <= end_date:
-                        good_file = True
-                elif end_date == None:
-                    if date >= start_date:
-                        good_file = True
-                elif date >= start_date and date <= end_date:
-                    good_file = True
+        self.measurements = self.ReadFiles(paths)
+
+        self.measurements.sort(key=lambda x: x.StartEpoch())
+
+        # Keep the dark files at hand, so they can be matched to measurements without reading the folder again:
+        self.dark_index = Lidarchive.DarkIndex([m for m in self.measurements if m.IsDark(self.dark_location)])
+
+    def StreamFiles(self, start_date=None, end_date=None):
+        '''
+        Walk the folder and yield its licel files in chronological order, without keeping
+        all of them in memory. Works best with date structured folders (see the folder_pattern
+        option), where walking the folder already follows the files' chronology.
+
+        Files are held back until a file starting at least STREAM_REORDER_WINDOW seconds
+        later was read. Files found after that (e.g. copies inside a mirrored folder read
+        later) can't be added to measurements already yielded, so they are reported,
+        skipped and recorded in the late_files list. Identical copies found within the
+        window are dropped and recorded in the duplicates dictionary.
+
+        Parameters
+        ----------
+        start_date : datetime or None
+            Same as for ReadFolder.
+        end_date : datetime or None
+            Same as for ReadFolder.
+
+        Returned value
+        --------------
+        A generator of MeasurementFile objects, sorted by start time.
+        '''
+        self.measurements = []
+        self.dark_index = None
+        self.duplicates = {}
+        self.late_files = []
+
+        # Heap of (start epoch, sequence, file) tuples, the sequence keeping the walk order on ties:
+        held = []
+        sequence = 0
 
-                if good_file == True:
+        # Start of the last file yielded:
+        watermark = None
+
+        # Paths of the files read lately, by file name, with the date read from the name:
+        recent_names = {}
+
+        for root, files in self.walker.Walk(self.folder, start_date, end_date):
+            paths = []
+
+            for path, date in self.FilesInInterval(root, files, start_date, end_date):
+                name = os.path.basename(path)
+                duplicate_of = None
+
+                for recent_path in recent_names.get(name, (None, []))[1]:
                     try:
-                        info = self.ReadInfoFromHeader(path)
-                        
-                        self.measurements.append(Lidarchive.MeasurementFile(
-                            path=path,
-                            start_datetime=info['StartDateTime'],
-                            end_datetime=info['StopDateTime'],
-                            site=info['Site'],
-                            type=''
-                        ))
-                    except Exception as e:
+                        if same_file_content(recent_path, path):
+                            duplicate_of = recent_path
+                            break
+                    except OSError as e:
                         print(str(e))
-                        pass
-                    
-        # Make sure we get a unique list of files!
-        # Since we're walking down the folder tree, it might just so happen
-        # that some files can be stored multiple times in different folders.
-        #
-        # When that happens, atmospheric-lidar is confused and throws errors,
-        # so it's better to take care of it here.
-        seen = set()
-        self.measurements = [ m for m in self.measurements if m.Filename() not in seen and not seen.add(m.Filename()) ]
 
-        self.measurements.sort(key=lambda x: x.StartDateTime())
+                if duplicate_of is not None:
+                    self.duplicates.setdefault(duplicate_of, []).append(path)
+                    continue
+
+                recent_names.setdefault(name, (date, []))[1].append(path)
+                paths.append(path)
+
+            late = 0
+
+            for measurement in self.ReadFiles(paths):
+                start = measurement.StartEpoch()
+
+                if watermark is not None and start < watermark:
+                    self.late_files.append(measurement.Path())
+                    late += 1
+                    continue
+
+                heapq.heappush(held, (start, sequence, measurement))
+                sequence += 1
+
+            if late > 0:
+                print("Skipped %d files in %s, older than files already processed" % (late, root))
+
+            if len(held) == 0:
+                continue
+
+            newest = max(item[0] for item in held)
+
+            while len(held) > 0 and held[0][0] < newest - STREAM_REORDER_WINDOW:
+                watermark, _, measurement = heapq.heappop(held)
+                yield measurement
+
+            if watermark is not None:
+                # Names of files older than everything yielded can't be read anymore:
+                oldest = EPOCH + timedelta(seconds=watermark - STREAM_REORDER_WINDOW)
+                recent_names = {name: entry for name, entry in recent_names.items() if entry[0] >= oldest}
+
+        while len(held) > 0:
+            _, _, measurement = heapq.heappop(held)
+            yield measurement
+
+    def StreamContinuousMeasurements(self, max_gap=300, min_length=1800, max_length=3600, center_type=0, start_date=None, end_date=None):
+        '''
+        Streaming version of ReadFolder followed by ContinuousMeasurements. The folder is
+        read in chronological order (see StreamFiles) and each measurement is yielded as
+        soon as it is final, so memory use does not grow with the size of the archive.
+
+        The measurements are the same as the ones found by ContinuousMeasurements, except
+        that dark segments starting more than DARK_LOOKAHEAD seconds after a measurement
+        are not attached to it.
+
+        Parameters
+        ----------
+        max_gap, min_length, max_length, center_type
+            Same as for ContinuousMeasurements.
+        start_date, end_date
+            Same as for ReadFolder.
+
+        Returned value
+        --------------
+        A generator of Measurement objects, in chronological order.
+        '''
+        stream = Lidarchive.ContinuousMeasurementStream(self, max_gap, min_length, max_length, center_type)
+        self.held_back_end = None
+
+        for measurement_file in self.StreamFiles(start_date, end_date):
+            for measurement in stream.Add(measurement_file):
+                yield measurement
+
+        for measurement in stream.Finish():
+            yield measurement
 
 
 def match_lines(f1, f2):
@@ -973,4 +1685,222 @@ def match_lines(f1, f2):
 
     combined = zip(list2, list1)
     combined = dict(combined)
-    return combined 
\ No newline at end of file
+    return combined 
+
+
+def read_licel_header(file):
+    '''
+    Parse the header of a licel file without loading any of the profile data. The
+    header is read with a single bounded read in most cases.
+
+    Parameters
+    ----------
+    file : str
+        The absolute file path.
+
+    Returned value
+    --------------
+    A dictionary holding the file name, site, start and stop datetimes and a list of
+    ChannelDescriptor objects for all the channels found in the file (photodiodes excluded).
+    '''
+    with open(file, 'rb') as f:
+        block = f.read(LICEL_HEADER_READ_SIZE)
+        lines = block.split(b'\n')
+
+        if len(lines) < 4:
+            raise ValueError("File %s does not have a valid licel header" % file)
+
+        # The third line tells how many channel lines follow:
+        datasets = int(match_lines(lines[2].decode(), licel_file_header_format[2])['DataSets'])
+
+        # Keep reading in the (rare) case the header did not fit in the first block:
+        while len(lines) < datasets + 4:
+            more = f.read(LICEL_HEADER_READ_SIZE)
+
+            if not more:
+                raise ValueError("File %s has an incomplete licel header" % file)
+
+            block += more
+            lines = block.split(b'\n')
+
+    raw_info = {}
+    raw_info['Filename'] = lines[0].decode().strip()
+
+    # The site name can contain white spaces, so everything before the first date is used:
+    second_line = lines[1].decode()
+    site = second_line.split('/')[0][:-2].strip()
+    raw_info['Site'] = site
+
+    second_line_info = match_lines(second_line[len(site) + 1:], licel_file_header_format[1])
+
+    # Construct a datetime object from the time and date information in the header:
+    start_string = '%s %s' % (second_line_info['StartDate'], second_line_info['StartTime'])
+    stop_string = '%s %s' % (second_line_info['EndDate'], second_line_info['EndTime'])
+
+    raw_info['StartDateTime'] = datetime.strptime(start_string, '%d/%m/%Y %H:%M:%S')
+    raw_info['StopDateTime'] = datetime.strptime(stop_string, '%d/%m/%Y %H:%M:%S')
+
+    channels = []
+    names = set()
+
+    for line in lines[3:3 + datasets]:
+        channel_info = match_lines(line.decode(), licel_file_channel_format)
+
+        # Photodiodes are not lidar channels:
+        if channel_info['ID'][0:2] == 'PD':
+            continue
+
+        analog_photon = channel_info['analog_photon']
+        name = '%s_%s' % (channel_info['wavelength'], licel_analog_photon_strings.get(analog_photon, analog_photon))
+
+        if name in names:
+            raise IOError("File %s contains two channels named %s" % (file, name))
+
+        names.add(name)
+
+        channels.append(ChannelDescriptor(
+            name=name,
+            resolution=float(channel_info['bin_width']),
+            wavelength=int(channel_info['wavelength'].split('.')[0]),
+            laser_used=int(channel_info['laser_used']),
+            adcbits=int(channel_info['ADCbits']),
+            is_analog=analog_photon == '0',
+            active=int(channel_info['active'])
+        ))
+
+    raw_info['Channels'] = channels
+
+    return raw_info
+
+
+def read_licel_header_safe(file):
+    '''
+    Same as read_licel_header, but returns errors instead of raising them, so it
+    can be used by a process pool.
+
+    Returned value
+    --------------
+    A tuple holding the header information and the error message. One of them is always None.
+    '''
+    try:
+        return (read_licel_header(file), None)
+    except Exception as e:
+        return (None, str(e))
+
+
+def file_digest(file, size=None):
+    '''
+    Hash the content of a file.
+
+    Parameters
+    ----------
+    file : str
+        The absolute file path.
+    size : int or None
+        Number of bytes to hash from the start of the file. If None, the
+        entire file is hashed.
+
+    Returned value
+    --------------
+    The hexadecimal digest.
+    '''
+    digest = hashlib.blake2b()
+
+    with open(file, 'rb') as f:
+        if size is not None:
+            digest.update(f.read(size))
+        else:
+            for block in iter(lambda: f.read(HASH_READ_SIZE), b''):
+                digest.update(block)
+
+    return digest.hexdigest()
+
+
+def same_file_content(first, second):
+    '''
+    Check if two files have the same content, comparing their sizes first, then their
+    header blocks and only then their full content.
+    '''
+    if os.path.getsize(first) != os.path.getsize(second):
+        return False
+
+    if file_digest(first, LICEL_HEADER_READ_SIZE) != file_digest(second, LICEL_HEADER_READ_SIZE):
+        return False
+
+    return file_digest(first) == file_digest(second)
+
+
+def to_epoch(date):
+    '''
+    Convert a datetime object to the number of seconds since 1970-01-01.
+    '''
+    return int((date - EPOCH).total_seconds())
+
+
+def from_epoch(seconds):
+    '''
+    Convert a number of seconds since 1970-01-01 to a datetime object.
+    '''
+    return EPOCH + timedelta(seconds=seconds)
+
+
+def channel_key(channel):
+    '''
+    Retrieve the properties used when comparing two lidar channels, as a hashable tuple.
+
+    Parameters
+    ----------
+    channel : object
+        Any channel object with name, resolution, laser_used, adcbits, analog (or is_analog)
+        and active attributes.
+    '''
+    analog = channel.analog if hasattr(channel, 'analog') else channel.is_analog
+
+    return (channel.name, channel.resolution, channel.laser_used, channel.adcbits, analog, channel.active)
+
+
+def channel_signature(channels):
+    '''
+    Reduce a channel configuration to an immutable, hashable signature. Two configurations
+    have the same signature if they hold the same channels, regardless of their order.
+    The returned object is interned, so equal signatures are usually the same object.
+
+    Parameters
+    ----------
+    channels : list
+        Channel objects, as accepted by channel_key.
+    '''
+    signature = tuple(sorted(channel_key(channel) for channel in channels))
+
+    return interned_signatures.setdefault(signature, signature)
+
+
+def intern_channels(channels):
+    '''
+    Build the MeasurementChannel objects for a channel configuration, reusing the
+    ones already built for identical configurations.
+
+    Parameters
+    ----------
+    channels : list
+        ChannelDescriptor objects or atmospheric-lidar channel objects.
+
+    Returned value
+    --------------
+    A tuple holding the (shared) tuple of MeasurementChannel objects and their signature.
+    '''
+    descriptors = tuple(
+        channel if isinstance(channel, ChannelDescriptor)
+        else channel.Descriptor() if isinstance(channel, Lidarchive.MeasurementChannel)
+        else Lidarchive.MeasurementChannel(channel).Descriptor()
+        for channel in channels
+    )
+
+    interned = interned_channels.get(descriptors, None)
+
+    if interned is None:
+        measurement_channels = tuple(Lidarchive.MeasurementChannel(descriptor) for descriptor in descriptors)
+        interned = (measurement_channels, channel_signature(measurement_channels))
+        interned_channels[descriptors] = interned
+
+    return interned
@@ -0,0 +1,170 @@
+from collections import defaultdict
+from itertools import count
+from operator import attrgetter
+
+import numpy as np
+
+
+def epoch_arrays(measurements):
+    '''
+    Build the start and end time arrays of a list of MeasurementFile objects.
+
+    Returned value
+    --------------
+    A tuple of two int64 arrays, holding the start and end epoch seconds of each file.
+    '''
+    # Read the record fields directly, this runs over every file of the archive:
+    starts = np.fromiter(map(attrgetter('start'), measurements), dtype=np.int64, count=len(measurements))
+    ends = np.fromiter(map(attrgetter('end'), measurements), dtype=np.int64, count=len(measurements))
+
+    return (starts, ends)
+
+
+def key_ids(values, ids=None):
+    '''
+    Number hashable values (e.g. channel signatures or sites), so they can be compared as an array.
+
+    Parameters
+    ----------
+    values : iterable
+        The values to number.
+    ids : dict or None
+        Dictionary filled with the number given to each value.
+
+    Returned value
+    --------------
+    An int64 array holding the same number for equal values.
+    '''
+    numbers = defaultdict(count().__next__)
+    result = np.fromiter(map(numbers.__getitem__, values), dtype=np.int64)
+
+    if ids is not None:
+        ids.update(numbers)
+
+    return result
+
+
+def index_pairs(bounds):
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def gap_segments(starts, ends, max_gap, *keys):
+    '''
+    Split files wherever the gap between the end of a file and the start of the next one
+    is above max_gap, or wherever one of the keys changes. Same rules as Lidarchive.FilterByGap.
+
+    Parameters
+    ----------
+    starts, ends : numpy.ndarray
+        Start and end epoch seconds of the files.
+    max_gap : int
+        Maximum accepted time gap, measured in seconds, between to consecutive files.
+    keys : numpy.ndarray
+        Arrays of ids (see key_ids) which must be the same for all files of a segment.
+
+    Returned value
+    --------------
+    A list of (first, stop) index pairs.
+    '''
+    total = len(starts)
+
+    if total < 1:
+        return []
+
+    breaks = (starts[1:] - ends[:-1]) > max_gap
+
+    for key in keys:
+        breaks |= key[1:] != key[:-1]
+
+    return index_pairs([0] + (np.flatnonzero(breaks) + 1).tolist() + [total])
+
+
+def length_segments(starts, ends, max_length, min_length):
+    '''
+    Split files sorted by start time into segments of at most max_length seconds. Same
+    rules as Lidarchive.FilterByLength: files starting less than min_length seconds
+    before the end of the last file are glued to the previous segment, a single file
+    gives no segment and, if no such tail exists, the last segment is left out.
+
+    Returned value
+    --------------
+    A list of (first, stop) index pairs.
+    '''
+    total = len(starts)
+
+    if total < 2:
+        return []
+
+    # First file (apart from the first one) starting less than min_length before the end:
+    tail = np.flatnonzero(starts[1:] > ends[-1] - min_length)
+    tail = int(tail[0]) + 1 if len(tail) > 0 else total
+
+    segments = []
+    first = 0
+
+    while True:
+        # First file starting more than max_length after the segment start:
+        next_first = max(int(np.searchsorted(starts, starts[first] + max_length, side='right')), first + 1)
+
+        if next_first >= tail:
+            break
+
+        segments.append((first, next_first))
+        first = next_first
+
+    if tail < total:
+        segments.append((first, total))
+
+    return segments
+
+
+def time_segments(starts, ends, min_length, max_length, center_type):
+    '''
+    Split files into segments holding a given number of full or half hour crossings.
+    Same rules as Lidarchive.FilterByTime: a file crossing (or following a gap which
+    crosses) the xx:00 mark for center_type 1, or the xx:30 mark for center_type 0,
+    counts as one hour and a segment is closed once int(max_length / 3600) hours were
+    counted. A first or last segment shorter than min_length is glued to its neighbour.
+
+    Returned value
+    --------------
+    A list of (first, stop) index pairs.
+    '''
+    total = len(starts)
+
+    if total < 1:
+        return []
+
+    hours = int(max_length / 3600)
+    start_minutes = starts // 60 % 60
+    end_minutes = ends // 60 % 60
+
+    # Files counting as one hour:
+    ticks = np.zeros(total, dtype=bool)
+
+    if center_type == 1:
+        ticks[0] = end_minutes[0] < start_minutes[0]
+        ticks[1:] = (end_minutes[1:] < start_minutes[1:]) | (start_minutes[1:] < end_minutes[:-1])
+    elif center_type == 0:
+        ticks[0] = start_minutes[0] <= 30 and end_minutes[0] >= 30
+        ticks[1:] = ((start_minutes[1:] < 30) & (end_minutes[1:] >= 30)) | ((end_minutes[:-1] < 30) & (start_minutes[1:] >= 30))
+
+    # The hour counter can only run out if it starts above zero:
+    if hours > 0:
+        closing = np.flatnonzero(ticks & (np.cumsum(ticks) % hours == 0)) + 1
+        bounds = [0] + closing.tolist()
+    else:
+        bounds = [0]
+
+    if bounds[-1] != total:
+        bounds.append(total)
+
+    segments = index_pairs(bounds)
+
+    if len(segments) > 1 and ends[segments[0][1] - 1] - starts[segments[0][0]] < min_length:
+        segments[0:2] = [(segments[0][0], segments[1][1])]
+
+    if len(segments) > 1 and ends[segments[-1][1] - 1] - starts[segments[-1][0]] < min_length:
+        segments[-2:] = [(segments[-2][0], segments[-1][1])]
+
+    return segments
@@ -0,0 +1,201 @@
+import os
+import re
+from datetime import datetime, timedelta
+
+# Regular expressions for the strftime directives accepted in folder patterns:
+folder_pattern_directives = {
+    'Y': r'(?P<Y>\d{4})',
+    'y': r'(?P<y>\d{2})',
+    'm': r'(?P<m>\d{2})',
+    'd': r'(?P<d>\d{2})',
+    'j': r'(?P<j>\d{3})',
+    'H': r'(?P<H>\d{2})',
+    'M': r'(?P<M>\d{2})',
+}
+
+class DateFolderWalker:
+    '''
+    Walks a folder tree like os.walk, but recognises date structured folder layouts
+    (e.g. YYYY/MM/DD) and skips whole subtrees which cannot hold files between two
+    given dates, without listing them.
+
+    The layout is described by a pattern relative to the scanned folder, using strftime
+    directives for each level (e.g. "%Y/%m/%d" or "%Y/%Y-%m-%d-%H-%M"). Supported
+    directives are %Y, %y, %m, %d, %j, %H and %M. Folders which don't match the pattern
+    are walked normally.
+    '''
+
+    def __init__(self, pattern=None):
+        '''
+        Constructs a DateFolderWalker object.
+
+        Parameters
+        ----------
+        pattern : str or None
+            The folder layout pattern. If None, no folder will be skipped.
+        '''
+        self.pattern = pattern
+        self.levels = []
+
+        if pattern:
+            for component in re.split(r'[\\/]', pattern.strip('/\\')):
+                self.levels.append(re.compile(DateFolderWalker.ComponentExpression(component)))
+
+    @staticmethod
+    def ComponentExpression(component):
+        '''
+        Convert one level of a folder pattern to a regular expression.
+        '''
+        expression = ''
+        index = 0
+
+        while index < len(component):
+            if component[index] == '%' and index + 1 < len(component):
+                directive = component[index + 1]
+
+                if directive not in folder_pattern_directives:
+                    raise ValueError("Unsupported directive %%%s in folder pattern" % directive)
+
+                expression += folder_pattern_directives[directive]
+                index += 2
+            else:
+                expression += re.escape(component[index])
+                index += 1
+
+        return expression
+
+    @staticmethod
+    def Span(fields):
+        '''
+        Compute the time interval covered by a folder.
+
+        Parameters
+        ----------
+        fields : dict
+            Date fields decoded from the folder path so far, keyed by directive.
+
+        Returned value
+        --------------
+        A (start, end) tuple of datetime objects, end being excluded, or None if the
+        fields are not enough to bound the interval.
+        '''
+        if 'Y' in fields:
+            year = int(fields['Y'])
+        elif 'y' in fields:
+            year = int(fields['y'])
+            year += 1900 if year >= 59 else 2000
+        else:
+            return None
+
+        try:
+            if 'j' in fields:
+                start = datetime(year, 1, 1) + timedelta(days=int(fields['j']) - 1)
+                end = start + timedelta(days=1)
+            elif 'm' in fields and 'd' in fields:
+                start = datetime(year, int(fields['m']), int(fields['d']))
+                end = start + timedelta(days=1)
+            elif 'm' in fields:
+                month = int(fields['m'])
+                start = datetime(year, month, 1)
+                end = datetime(year + month // 12, month % 12 + 1, 1)
+                return (start, end)
+            else:
+                return (datetime(year, 1, 1), datetime(year + 1, 1, 1))
+
+            if 'H' in fields:
+                start += timedelta(hours=int(fields['H']))
+                end = start + timedelta(hours=1)
+
+                if 'M' in fields:
+                    start += timedelta(minutes=int(fields['M']))
+                    end = start + timedelta(minutes=1)
+        except ValueError:
+            # Not a real date, so don't use it for skipping folders:
+            return None
+
+        return (start, end)
+
+    def Walk(self, folder, start_date=None, end_date=None):
+        '''
+        Walk the folder tree.
+
+        Parameters
+        ----------
+        folder : str
+            Path of the folder to walk.
+        start_date : datetime or None
+            Folders holding only files older than this date are skipped.
+        end_date : datetime or None
+            Folders holding only files newer than this date are skipped.
+
+        Returned value
+        --------------
+        A generator of (root, files) tuples, where files is the sorted list of
+        file names found directly inside the root folder.
+        '''
+        # Each item holds the folder path, its depth inside the date layout and the
+        # date fields decoded so far. A depth of None means the layout was not followed.
+        stack = [(folder, 0, {})]
+
+        while len(stack) > 0:
+            root, depth, fields = stack.pop()
+
+            try:
+                entries = sorted(os.scandir(root), key=lambda entry: entry.name)
+            except OSError:
+                continue
+
+            files = []
+            subfolders = []
+
+            for entry in entries:
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+
+                if not is_dir:
+                    files.append(entry.name)
+                    continue
+
+                # Same as os.walk, don't follow symbolic links to folders:
+                if entry.is_symlink():
+                    continue
+
+                subfolder_depth = None
+                subfolder_fields = fields
+
+                if depth is not None and depth < len(self.levels):
+                    match = self.levels[depth].fullmatch(entry.name)
+
+                    if match is not None:
+                        subfolder_depth = depth + 1
+                        subfolder_fields = dict(fields, **match.groupdict())
+
+                        if self.IsOutside(subfolder_fields, start_date, end_date):
+                            continue
+
+                subfolders.append((entry.path, subfolder_depth, subfolder_fields))
+
+            yield (root, files)
+
+            # Reversed, so subfolders are visited in name order:
+            stack.extend(reversed(subfolders))
+
+    def IsOutside(self, fields, start_date, end_date):
+        '''
+        Checks if a folder described by the given date fields can only hold files
+        outside the [start_date, end_date] interval.
+        '''
+        span = DateFolderWalker.Span(fields)
+
+        if span is None:
+            return False
+
+        if start_date is not None and span[1] <= start_date:
+            return True
+
+        if end_date is not None and span[0] > end_date:
+            return True
+
+        return False
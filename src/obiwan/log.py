@@ -1,6 +1,8 @@
 import logging
 import pickle
 import os
+import sys
+import threading
 
 '''
 Module intended exports
@@ -40,6 +42,16 @@ def WriteProcessingLog ( file_path ):
                 processing_log[ measurement_id ][ "result" ]
             ))
             
+def IsWorkerProcess ():
+    '''
+    Checks if this is a worker process started by multiprocessing (e.g. a conversion
+    worker), which imports the obiwan modules again. multiprocessing is always loaded
+    in such processes, so it is not imported here for nothing.
+    '''
+    multiprocessing = sys.modules.get ( 'multiprocessing' )
+    
+    return multiprocessing is not None and multiprocessing.current_process ().name != 'MainProcess'
+    
 def SetLogLevel ( level ):
     global logger, console
     
@@ -66,6 +78,9 @@ class SwapFile:
         self.file_path = file_path
         self.csv_path = None
         
+        # Measurements can be updated from several threads (see obiwan.pipeline):
+        self.lock = threading.RLock ()
+        
     def set_file_path ( self, file_path ):
         self.file_path = file_path
         
@@ -74,8 +89,9 @@ class SwapFile:
             with open ( self.file_path, 'rb' ) as file:
                 info = pickle.load(file)
                 
-            self.config = info["config"]
-            self.measurements = info["measurements"]
+            with self.lock:
+                self.config = info["config"]
+                self.measurements = info["measurements"]
             
             return len(self.config.keys()) > 0
         except:
@@ -84,51 +100,57 @@ class SwapFile:
         return False
         
     def save ( self ):
-        with open ( self.file_path, 'wb' ) as file:
+        with self.lock, open ( self.file_path, 'wb' ) as file:
             pickle.dump({
                 "config": self.config,
                 "measurements": self.measurements
             }, file)
             
     def reset ( self ):
-        self.reset_measurements ()
-        self.config = {}
+        with self.lock:
+            self.reset_measurements ()
+            self.config = {}
         
     def reset_measurements ( self ):
-        self.measurements = {}
+        with self.lock:
+            self.measurements = {}
 
     def update_config ( self, kvp, save = True ):
-        self.config[ kvp[0] ] = kvp[1]
-        
-        if save:
-            self.save()
+        with self.lock:
+            self.config[ kvp[0] ] = kvp[1]
+            
+            if save:
+                self.save()
             
     def update_measurement ( self, measurement_id, kvp, save = True ):
-        if measurement_id not in self.measurements.keys():
-            self.measurements[ measurement_id ] = {}
+        with self.lock:
+            if measurement_id not in self.measurements.keys():
+                self.measurements[ measurement_id ] = {}
+                
+            self.measurements[ measurement_id ][ kvp[0] ] = kvp[1]
             
-        self.measurements[ measurement_id ][ kvp[0] ] = kvp[1]
-        
-        if save:
-            self.save()
+            if save:
+                self.save()
         
     def update_measurement_by_scc_id ( self, scc_id, kvp, save = True ):
-        for key in self.measurements.keys():
-            try:
-                if self.measurements[ key ][ "scc_measurement_id" ] == scc_id:
-                    self.measurements[ key ][ kvp[0] ] = kvp[1]
-                    
-                    if save:
-                        self.save()
+        with self.lock:
+            for key in self.measurements.keys():
+                try:
+                    if self.measurements[ key ][ "scc_measurement_id" ] == scc_id:
+                        self.measurements[ key ][ kvp[0] ] = kvp[1]
                         
-                    return
-            except:
-                pass
+                        if save:
+                            self.save()
+                            
+                        return
+                except:
+                    pass
                 
     def get_measurement_by_scc_id ( self, scc_id ):
-        for key in self.measurements.keys():
-            if self.measurements[ key ][ "scc_measurement_id" ] == scc_id:
-                return self.measurements[ key ]
+        with self.lock:
+            for key in self.measurements.keys():
+                if self.measurements[ key ][ "scc_measurement_id" ] == scc_id:
+                    return self.measurements[ key ]
                 
     @staticmethod
     def compute_path ( path ):
@@ -147,40 +169,77 @@ class SwapFile:
     def set_csv_path ( self, file_path ):
         self.csv_path = SwapFile.compute_path ( file_path )
                 
-    def write_csv ( self ):
+    def finish_measurement ( self, measurement_id, save = True ):
+        '''
+        Writes a measurement which won't be updated anymore to the CSV datalog and removes
+        it, so the datalog doesn't grow with the number of processed measurements.
+        
+        Returned value
+        --------------
+        The removed measurement, or None if it was not found.
+        '''
+        with self.lock:
+            measurement = self.measurements.pop ( measurement_id, None )
+            
+            if measurement is not None:
+                self.write_csv ( [ measurement ] )
+                
+                if save:
+                    self.save()
+                    
+            return measurement
+            
+    def finish_measurement_by_scc_id ( self, scc_id, save = True ):
+        with self.lock:
+            for key in self.measurements.keys():
+                if self.measurements[ key ].get ( "scc_measurement_id" ) == scc_id:
+                    return self.finish_measurement ( key, save )
+                    
+    def write_csv ( self, measurements = None ):
+        '''
+        Appends measurements to the CSV datalog, creating it if needed.
+        
+        Parameters
+        ----------
+        measurements : list or None
+            The measurements to write. If None, all the measurements still in the datalog
+            are written.
+        '''
         if self.csv_path is None:
             return
             
-        logger.info (f"Saving datalog to {self.csv_path}")
+        if measurements is None:
+            logger.info (f"Saving datalog to {self.csv_path}")
             
-        if not os.path.isfile ( self.csv_path ):
-            with open ( self.csv_path, 'w' ) as csvfile:
-                csvfile.write ( "Process Start,Data Folder,Data File,SCC System ID,Measurement ID,Uploaded,Downloaded,SCC Version,Result" )
+        with self.lock:
+            if not os.path.isfile ( self.csv_path ):
+                with open ( self.csv_path, 'w' ) as csvfile:
+                    csvfile.write ( "Process Start,Data Folder,Data File,SCC System ID,Measurement ID,Uploaded,Downloaded,SCC Version,Result" )
                 
-        with open (self.csv_path, 'a') as csvfile:
-            for measurement in self.measurements.values():
-                process_start = measurement.get("process_start", "N/A")
+            with open (self.csv_path, 'a') as csvfile:
+                for measurement in ( self.measurements.values() if measurements is None else measurements ):
+                    process_start = measurement.get("process_start", "N/A")
                 
-                try:
-                    path = measurement["scc_netcdf_path"]
-                    data_folder = os.path.dirname ( path )
-                    data_file = os.path.basename ( path )
-                except Exception as e:
-                    logger.error ( str(e) )
-                    data_folder = "N/A"
-                    data_file = "N/A"
+                    try:
+                        path = measurement["scc_netcdf_path"]
+                        data_folder = os.path.dirname ( path )
+                        data_file = os.path.basename ( path )
+                    except Exception as e:
+                        logger.error ( str(e) )
+                        data_folder = "N/A"
+                        data_file = "N/A"
                     
-                csvfile.write ("\n%s,%s,%s,%s,%s,%s,%s,\"%s\",%s" % (
-                    measurement.get("process_start", "N/A"),
-                    data_folder,
-                    data_file,
-                    measurement.get("system_id", "N/A"),
-                    measurement.get("scc_measurement_id", "N/A"),
-                    measurement.get("uploaded", "N/A"),
-                    measurement.get("downloaded", "N/A"),
-                    measurement.get("scc_version", "N/A"),
-                    measurement.get("result", "N/A")
-                ))
+                    csvfile.write ("\n%s,%s,%s,%s,%s,%s,%s,\"%s\",%s" % (
+                        measurement.get("process_start", "N/A"),
+                        data_folder,
+                        data_file,
+                        measurement.get("system_id", "N/A"),
+                        measurement.get("scc_measurement_id", "N/A"),
+                        measurement.get("uploaded", "N/A"),
+                        measurement.get("downloaded", "N/A"),
+                        measurement.get("scc_version", "N/A"),
+                        measurement.get("result", "N/A")
+                    ))
         
 class LoggerFactory:
     class SystemLogFilter ( logging.Filter ):
@@ -213,7 +272,8 @@ class LoggerFactory:
             format = log_format,
             datefmt = '%Y-%m-%d %H:%M',
             filename = LOG_FILE,
-            filemode = 'w'
+            # Worker processes add to the log of the obiwan run instead of replacing it:
+            filemode = 'a' if IsWorkerProcess () else 'w'
         )
 
         logger.addFilter ( LoggerFactory.SystemLogFilter() )
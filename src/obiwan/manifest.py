@@ -0,0 +1,139 @@
+import atmospheric_lidar
+import hashlib
+import os
+import sqlite3
+
+from obiwan.lidarchive.lidarchive import file_digest
+
+class ConversionManifest:
+    '''
+    Persistent list of the SCC NetCDF files written by obiwan, stored in an SQLite
+    database. Each output file is stored with a fingerprint of everything it was
+    converted from, so a file can be reused as long as none of its inputs changed.
+    '''
+
+    # Bump this whenever the fingerprint changes, so old manifests get rebuilt:
+    SCHEMA_VERSION = 1
+
+    def __init__ ( self, path ):
+        '''
+        Opens (or creates) a conversion manifest.
+
+        Parameters
+        ----------
+        path : str
+            Path of the SQLite database file.
+        '''
+        self.path = path
+        self.connection = sqlite3.connect ( path )
+
+        # Fingerprints of the system parameters modules, which don't change during a run:
+        self.parameters_digests = {}
+
+        version = self.connection.execute ( "PRAGMA user_version" ).fetchone ()[0]
+
+        if version != ConversionManifest.SCHEMA_VERSION:
+            self.connection.execute ( "DROP TABLE IF EXISTS outputs" )
+            self.connection.execute ( "PRAGMA user_version = %d" % ConversionManifest.SCHEMA_VERSION )
+
+        self.connection.execute (
+            "CREATE TABLE IF NOT EXISTS outputs ("
+            "path TEXT PRIMARY KEY, "
+            "fingerprint TEXT NOT NULL, "
+            "size INTEGER NOT NULL, "
+            "mtime INTEGER NOT NULL)"
+        )
+        self.connection.commit ()
+
+    def ParametersDigest ( self, netcdf_parameters_path ):
+        digest = self.parameters_digests.get ( netcdf_parameters_path )
+
+        if digest is None:
+            digest = file_digest ( netcdf_parameters_path )
+            self.parameters_digests[netcdf_parameters_path] = digest
+
+        return digest
+
+    def Fingerprint ( self, data_paths, dark_paths, measurement_number, netcdf_parameters_path, options = None ):
+        '''
+        Computes the fingerprint of a conversion. Raw files are identified by their path,
+        size and modification time, the system parameters module by its content.
+
+        Parameters
+        ----------
+        data_paths : list
+            Paths of the raw data files.
+        dark_paths : list
+            Paths of the raw dark files.
+        measurement_number : str
+            Number of the measurement in its day.
+        netcdf_parameters_path : str
+            Path of the system parameters module.
+        options : object
+            Other conversion settings affecting the output (e.g. the NetCDF compression),
+            compared by their representation.
+
+        Returned value
+        --------------
+        A hexadecimal string, or None if one of the files can't be read.
+        '''
+        fingerprint = hashlib.blake2b ( digest_size = 20 )
+
+        try:
+            for kind, paths in ( ( 'data', data_paths ), ( 'dark', dark_paths ) ):
+                fingerprint.update ( kind.encode () )
+
+                for path in paths:
+                    stat = os.stat ( path )
+                    fingerprint.update ( ( "%s\0%d\0%d\0" % ( os.path.abspath ( path ), stat.st_size, stat.st_mtime_ns ) ).encode () )
+
+            fingerprint.update ( self.ParametersDigest ( netcdf_parameters_path ).encode () )
+        except OSError:
+            return None
+
+        # The output also depends on the atmospheric-lidar version doing the conversion:
+        fingerprint.update ( ( "%s\0%s\0%r" % ( measurement_number, atmospheric_lidar.__version__, options ) ).encode () )
+
+        return fingerprint.hexdigest ()
+
+    def IsUpToDate ( self, file_path, fingerprint ):
+        '''
+        Checks if an output file was written from the inputs described by the fingerprint
+        and was not modified since.
+        '''
+        if fingerprint is None:
+            return False
+
+        row = self.connection.execute (
+            "SELECT fingerprint, size, mtime FROM outputs WHERE path = ?",
+            ( os.path.abspath ( file_path ), )
+        ).fetchone ()
+
+        if row is None or row[0] != fingerprint:
+            return False
+
+        try:
+            stat = os.stat ( file_path )
+        except OSError:
+            return False
+
+        return row[1] == stat.st_size and row[2] == stat.st_mtime_ns
+
+    def Store ( self, file_path, fingerprint ):
+        '''
+        Records a newly written output file.
+        '''
+        if fingerprint is None:
+            return
+
+        stat = os.stat ( file_path )
+
+        self.connection.execute (
+            "INSERT OR REPLACE INTO outputs (path, fingerprint, size, mtime) VALUES (?, ?, ?, ?)",
+            ( os.path.abspath ( file_path ), fingerprint, stat.st_size, stat.st_mtime_ns )
+        )
+        self.connection.commit ()
+
+    def Close ( self ):
+        self.connection.commit ()
+        self.connection.close ()
@@ -1,35 +1,65 @@
-from .lidarchive import lidarchive
-
 from obiwan.config import Config
 from obiwan.log import logger, datalog, SetLogLevel, UseSwapFile, UseCsvDatalog
-from obiwan.lidar import SystemIndex
-from obiwan.scc import scc
+from obiwan.runstate import RunState
 
 import argparse
 import datetime
-import importlib
 import os
 import sys
 import shutil
+import tempfile
+import threading
 import time
 
-from atmospheric_lidar.licel import LicelLidarMeasurement
-
 SWAP_FILE_NAME = "obiwan.swp"
+CATALOG_FILE_NAME = "obiwan.catalog"
+MANIFEST_FILE_NAME = "obiwan.manifest"
+SCC_INDEX_FILE_NAME = "obiwan.sccindex"
+RUN_STATE_FILE_NAME = "obiwan.lastrun"
+COMPRESSION_REPORT_LEVELS = (1, 4, 6, 9)
 convert_resumed = []
 upload_resumed = []
 
-def Convert ( config, licel_measurement ):
+# Measurements removed from the datalog with --stream (see FinishMeasurement) which
+# didn't go through every requested step:
+incomplete_measurements = 0
+
+def LoadProcessingModules ():
+    '''
+    Imports the modules used for identifying, converting, uploading and downloading
+    measurements. Importing atmospheric-lidar, netCDF4 and scc-access takes about a
+    second, so this is only done once obiwan knows there is some work to do.
+    '''
+    global lidarchive, Pipeline, scc, SystemIndex, ConversionManifest, ProcessingPoller, SccMeasurementIndex, UploadPool
+    global CanConvertInParallel, CompareCompression, ConversionPool, ConvertFiles, LoadParametersModule, MeasurementClass
+    global NetcdfCompression, UseConversionBlocks, UseDarkCache, UseNetcdfCompression
+    
+    from obiwan.lidarchive import lidarchive
+    from obiwan.converter import CanConvertInParallel, CompareCompression, ConversionPool, ConvertFiles, LoadParametersModule, MeasurementClass, NetcdfCompression, UseConversionBlocks, UseDarkCache, UseNetcdfCompression
+    from obiwan.lidar import SystemIndex
+    from obiwan.manifest import ConversionManifest
+    from obiwan.pipeline import Pipeline
+    from obiwan.scc import scc, ProcessingPoller, UploadPool
+    from obiwan.sccindex import SccMeasurementIndex
+    
+def PrepareConversion ( config, licel_measurement ):
+    '''
+    Determines the system ID and the SCC measurement ID of a measurement before converting it.
+    
+    Returned value
+    --------------
+    The SCC measurement ID, or None if the measurement can't be converted.
+    '''
     logger.info ( "Converting %d licel files to SCC NetCDF format." % len(licel_measurement.DataFiles()) )
     
     try:
-        system_id = system_index.GetSystemId (licel_measurement.DataFiles()[0].Path())
+        system_id = system_index.GetSystemId (licel_measurement.DataFiles()[0])
     except ValueError as e:
         logger.error ("Couldn't determine system ID for measurement '%s': %s. Skipping measurement." % (licel_measurement.DataFiles()[0].Path(), str(e)))
-        return None, None
+        return None
     except IndexError as e:
         logger.error ( "Could not find any data files for this measurement. Skipping." )
-        return None, None
+        return None
         
     datalog.update_measurement ( licel_measurement.Id(), ("system_id", system_id) )
         
@@ -40,32 +70,158 @@ def Convert ( config, licel_measurement ):
         measurement_id = "{0}{1}{2}".format(date_str, earlinet_station_id, measurement_number)
     except Exception as e:
         logger.error ( "Could not determine measurement ID. Skipping..." )
-        return None, None
+        return None
         
     datalog.update_measurement ( licel_measurement.Id(), ("scc_measurement_id", measurement_id) )
-
-    try:
-        measurement = CustomLidarMeasurement ( [file.Path() for file in licel_measurement.DataFiles()] )
-    except:
-        logger.error ( "Could not convert measurement." )
-        return None, None
     
-    if len(licel_measurement.DarkFiles()) > 0:
-        measurement.dark_measurement = CustomLidarMeasurement ( [file.Path() for file in licel_measurement.DarkFiles()] )
-
-    measurement = measurement.subset_by_scc_channels ()
-    measurement.set_measurement_id(measurement_number=licel_measurement.NumberAsString())
+    return measurement_id
+    
+def ConversionArguments ( config, licel_measurement, measurement_id ):
+    '''
+    Retrieves the arguments of converter.ConvertFiles for a measurement.
+    '''
+    return (
+        [file.Path() for file in licel_measurement.DataFiles()],
+        [file.Path() for file in licel_measurement.DarkFiles()],
+        licel_measurement.NumberAsString(),
+        os.path.join(config.netcdf_out_dir, f'{measurement_id}.nc')
+    )
+    
+def CheckConversion ( config, licel_measurement, measurement_id ):
+    '''
+    Checks if the SCC NetCDF file of a measurement, written by a past run, can be reused.
+    
+    Returned value
+    --------------
+    A tuple holding the arguments of converter.ConvertFiles, the conversion fingerprint
+    (see ConversionManifest.Fingerprint) and a boolean which is True if the existing file
+    is up to date.
+    '''
+    arguments = ConversionArguments ( config, licel_measurement, measurement_id )
+    data_paths, dark_paths, measurement_number, file_path = arguments
     
-    file_path = os.path.join(config.netcdf_out_dir, f'{measurement_id}.nc')
+    fingerprint = manifest.Fingerprint ( data_paths, dark_paths, measurement_number, config.netcdf_parameters_path, netcdf_compression )
+    up_to_date = not args.force_convert and manifest.IsUpToDate ( file_path, fingerprint )
     
-    measurement.save_as_SCC_netcdf (filename=file_path)
+    if up_to_date:
+        logger.info ( "SCC NetCDF file is up to date, skipping conversion.", extra={'scope': measurement_id} )
+        
+    return arguments, fingerprint, up_to_date
     
+def FinishConversion ( measurement_id, file_path ):
     datalog.update_measurement_by_scc_id ( measurement_id, ("converted", True) )
     datalog.update_measurement_by_scc_id ( measurement_id, ("scc_netcdf_path", file_path) )
     datalog.update_measurement_by_scc_id ( measurement_id, ("result", "Converted to SCC NetCDF") )
     
+def Convert ( config, licel_measurement ):
+    measurement_id = PrepareConversion ( config, licel_measurement )
+    
+    if not measurement_id:
+        return None, None
+
+    arguments, fingerprint, up_to_date = CheckConversion ( config, licel_measurement, measurement_id )
+    file_path = arguments[3]
+    
+    if not up_to_date:
+        try:
+            ConvertFiles ( *arguments, measurement_class = CustomLidarMeasurement )
+        except Exception as e:
+            logger.error ( "Could not convert measurement: %s" % str(e) )
+            return None, None
+            
+        manifest.Store ( file_path, fingerprint )
+    
+    FinishConversion ( measurement_id, file_path )
+    
     return file_path, measurement_id
     
+def ParallelConvert ( config, licel_measurements, workers ):
+    '''
+    Converts measurements in worker processes. The datalog is only updated by this process.
+    
+    Returned value
+    --------------
+    A generator of (licel_measurement, file_path, measurement_id) tuples, in the order the
+    conversions finished. file_path and measurement_id are None for measurements which
+    could not be converted, the same as with Convert.
+    '''
+    def Tasks ():
+        for licel_measurement in licel_measurements:
+            measurement_id = PrepareConversion ( config, licel_measurement )
+            
+            if not measurement_id:
+                yield (licel_measurement, None, None, None), None
+                continue
+                
+            arguments, fingerprint, up_to_date = CheckConversion ( config, licel_measurement, measurement_id )
+            
+            # Up to date measurements are passed through the pool without being converted:
+            yield (licel_measurement, measurement_id, arguments[3], fingerprint), None if up_to_date else arguments
+    
+    pool = ConversionPool ( workers, config.netcdf_parameters_path, CustomLidarMeasurement, compression = netcdf_compression, block_size = config.conversion_block_size )
+    
+    for (licel_measurement, measurement_id, file_path, fingerprint), converted_path, error in pool.Map ( Tasks () ):
+        if measurement_id is None:
+            yield licel_measurement, None, None
+            continue
+            
+        if error is not None:
+            logger.error ( "Could not convert measurement: %s" % error, extra={'scope': measurement_id} )
+            yield licel_measurement, None, None
+            continue
+            
+        if converted_path is not None:
+            manifest.Store ( file_path, fingerprint )
+            
+        FinishConversion ( measurement_id, file_path )
+        
+        yield licel_measurement, file_path, measurement_id
+    
+def CompressionReport ( config, licel_measurements ):
+    '''
+    Writes the SCC NetCDF file of the first measurement using several compression settings
+    and logs the write time, file size and expected upload time (see upload_bandwidth) of each.
+    '''
+    licel_measurement = next ( iter ( licel_measurements ), None )
+    
+    if licel_measurement is None:
+        logger.error ( "No measurements found, can't compare compression settings." )
+        return
+        
+    chunk_options = [None] if not config.netcdf_chunk_profiles else [None, config.netcdf_chunk_profiles]
+    
+    candidates = [ NetcdfCompression ( 0, False, chunk ) for chunk in chunk_options ]
+    candidates += [
+        NetcdfCompression ( level, shuffle, chunk )
+        for chunk in chunk_options for level in COMPRESSION_REPORT_LEVELS for shuffle in (False, True)
+    ]
+    
+    if netcdf_compression not in candidates:
+        candidates.append ( netcdf_compression )
+        
+    data_paths, dark_paths, measurement_number, _ = ConversionArguments ( config, licel_measurement, "" )
+    logger.info ( "Comparing compression settings using %d raw data files and %d dark files, starting at %s" % (
+        len(data_paths), len(dark_paths), licel_measurement.DataFiles()[0].StartDateTime().strftime ( "%Y-%m-%d %H:%M:%S" )
+    ) )
+    
+    with tempfile.TemporaryDirectory ( dir = config.netcdf_out_dir ) as folder:
+        results = CompareCompression ( data_paths, dark_paths, measurement_number, folder, candidates, CustomLidarMeasurement )
+        
+    logger.info ( "Level  Shuffle  Chunk  Write time  File size (kB)  Upload time at %d kbit/s" % config.upload_bandwidth )
+    
+    for compression, write_time, file_size in results:
+        upload_time = file_size * 8 / ( config.upload_bandwidth * 1000 )
+        
+        logger.info ( "%5d  %-7s  %5s  %9.2fs  %14.1f  %.1fs%s" % (
+            compression.level,
+            compression.shuffle,
+            compression.chunk_profiles or "auto",
+            write_time,
+            file_size / 1000,
+            upload_time,
+            " (configured)" if compression == netcdf_compression else ""
+        ) )
+        
 def DebugMeasurement ( licel_measurement, measurement_path, measurements_debug_dir ):
     if measurements_debug_dir:
         debug_date_str = licel_measurement.DataFiles()[0].StartDateTime().strftime('%Y-%m-%d-%H-%M')
@@ -102,30 +258,87 @@ def DebugMeasurement ( licel_measurement, measurement_path, measurements_debug_d
     if measurements_debug_dir:
         shutil.copy2 ( measurement_path, debug_dir )
             
+def RegisterMeasurement ( licel_measurement ):
+    datalog.update_measurement ( licel_measurement.Id(), ("licel_measurement", licel_measurement), save=False )
+    datalog.update_measurement ( licel_measurement.Id(), ("scc_netcdf_path", ""), save=False )
+    datalog.update_measurement ( licel_measurement.Id(), ("converted", False), save=False )
+    datalog.update_measurement ( licel_measurement.Id(), ("uploaded", False), save=False )
+    datalog.update_measurement ( licel_measurement.Id(), ("downloaded", False), save=False )
+    datalog.update_measurement ( licel_measurement.Id(), ("system_id", None), save=False )
+    datalog.update_measurement ( licel_measurement.Id(), ("scc_measurement_id", None), save=False )
+    datalog.update_measurement ( licel_measurement.Id(), ("already_on_scc", False), save=False )
+    datalog.update_measurement ( licel_measurement.Id(), ("result", ""), save=False )
+    datalog.update_measurement ( licel_measurement.Id(), ("scc_version", ""), save=False )
+    datalog.update_measurement ( licel_measurement.Id(), ("process_start", datetime.datetime.now()), save=False )
+    
+def IsMeasurementComplete ( measurement ):
+    '''
+    Checks if a datalog measurement went through every requested step.
+    '''
+    if not measurement.get ( "converted", False ):
+        return False
+        
+    if not args.convert and not measurement.get ( "uploaded", False ):
+        return False
+        
+    if args.download and not measurement.get ( "downloaded", False ):
+        return False
+        
+    return True
+    
+def FinishMeasurement ( licel_measurement_id = None, scc_measurement_id = None ):
+    '''
+    Called once no other step will update a measurement, whether it succeeded or not.
+    With --stream, the measurement is written to the CSV datalog and removed from the
+    datalog right away, so memory use and the swap file size don't grow with the number
+    of processed measurements.
+    
+    Parameters
+    ----------
+    licel_measurement_id : str or None
+        ID of the measurement in the datalog (see Lidarchive.Measurement.Id).
+    scc_measurement_id : str or None
+        SCC measurement ID, used when licel_measurement_id is None.
+    '''
+    global incomplete_measurements
+    
+    if not args.stream:
+        return
+        
+    if licel_measurement_id is not None:
+        measurement = datalog.finish_measurement ( licel_measurement_id )
+    else:
+        measurement = datalog.finish_measurement_by_scc_id ( scc_measurement_id )
+        
+    if measurement is not None and not IsMeasurementComplete ( measurement ):
+        with datalog.lock:
+            incomplete_measurements += 1
+            
+def UpdateLastProcessedDate ( measurement_date ):
+    # Uploads can finish in any order when using --pipeline, only move the date forward:
+    with datalog.lock:
+        if datalog.config["last_processed_date"] is None:
+            datalog.update_config ( ("last_processed_date", measurement_date) )
+        elif measurement_date > datalog.config["last_processed_date"]:
+            datalog.update_config ( ("last_processed_date", measurement_date) )
+    
 def Upload (config, measurement_id, measurement_date, file_path, **kwargs):
     reprocess = kwargs.get("reprocess", True)
     replace = kwargs.get("replace", True)
     
     system_id = datalog.get_measurement_by_scc_id ( measurement_id )["system_id"]
     
-    measurement_exists = False
-    existing_measurement, _ = scc.client.get_measurement( measurement_id )
+    measurement_exists = scc.MeasurementExists ( measurement_id )
     
     datalog.update_measurement_by_scc_id ( measurement_id, ("already_on_scc", measurement_exists) )
     
-    if existing_measurement is not None:
-        measurement_exists = True
-    
     if measurement_exists and reprocess:
         # Reprocess the measurement and mark it for download
         logger.debug ( "Measurement already exists in the SCC, triggering reprocessing." )
         scc.client.rerun_all ( measurement_id, False )
         datalog.update_measurement_by_scc_id ( measurement_id, ("uploaded", True) )
         
-        if datalog.config["last_processed_date"] is None:
-            datalog.update_config ( ("last_processed_date", measurement_date) )
-        elif measurement_date > datalog.config["last_processed_date"]:
-            datalog.update_config ( ("last_processed_date", measurement_date) )
+        UpdateLastProcessedDate ( measurement_date )
             
         return measurement_id
     elif measurement_exists and not replace:
@@ -133,10 +346,7 @@ def Upload (config, measurement_id, measurement_date, file_path, **kwargs):
         logger.debug ( "Measurement already exists in the SCC, skipping reprocessing." )
         datalog.update_measurement_by_scc_id ( measurement_id, ("uploaded", True) )
         
-        if datalog.config["last_processed_date"] is None:
-            datalog.update_config ( ("last_processed_date", measurement_date) )
-        elif measurement_date > datalog.config["last_processed_date"]:
-            datalog.update_config ( ("last_processed_date", measurement_date) )
+        UpdateLastProcessedDate ( measurement_date )
             
         return measurement_id
     
@@ -146,10 +356,7 @@ def Upload (config, measurement_id, measurement_date, file_path, **kwargs):
 
     if can_download == True:
         logger.debug ( "Successfully uploaded to SCC", extra={'scope': measurement_id})
-        if datalog.config["last_processed_date"] is None:
-            datalog.update_config ( ("last_processed_date", measurement_date) )
-        elif measurement_date > datalog.config["last_processed_date"]:
-            datalog.update_config ( ("last_processed_date", measurement_date) )
+        UpdateLastProcessedDate ( measurement_date )
             
         datalog.update_measurement_by_scc_id ( measurement_id, ("uploaded", True) )
         return measurement_id
@@ -232,7 +439,163 @@ def ResumePastWork ():
             logger.error ( "Error processing measurement: %s" % (str(e)) )
             
     return resume_download
-
+    
+def PendingMeasurements ( licel_measurements ):
+    for index, licel_measurement in enumerate(licel_measurements):
+        if args.stream:
+            RegisterMeasurement ( licel_measurement )
+            logger.info ( f"Started processing measurement {index+1}" )
+        else:
+            logger.info ( f"Started processing measurement {index+1}/{len(licel_measurements)}" )
+        
+        if licel_measurement.Id() in [m.Id() for m in convert_resumed]:
+            logger.warning ( "This measurement measurement {licel_measurement.Id()} was processed already because of --convert. Skipping it." )
+            FinishMeasurement ( licel_measurement.Id() )
+            continue
+            
+        yield licel_measurement
+        
+def ConvertedMeasurements ( converted_measurements ):
+    '''
+    Leaves out the measurements which could not be converted, which are finished then.
+    '''
+    for licel_measurement, file_path, measurement_id in converted_measurements:
+        if measurement_id:
+            yield licel_measurement, file_path, measurement_id
+        else:
+            FinishMeasurement ( licel_measurement.Id() )
+    
+def UploadConverted ( licel_measurement, file_path, measurement_id ):
+    '''
+    Uploads a converted measurement to the SCC, copying its files to the debug folder first if needed.
+    
+    Returned value
+    --------------
+    The SCC measurement ID to download the products for, or None.
+    '''
+    if args.debug:
+        if config.measurements_debug_dir:
+            DebugMeasurement (licel_measurement, file_path, config.measurements_debug_dir)
+            
+    if args.convert:
+        FinishMeasurement ( licel_measurement.Id() )
+        return None
+        
+    if licel_measurement.Id() in [m.Id() for m in upload_resumed]:
+        logger.warning ( "This measurement measurement {licel_measurement.Id()} was processed already because of --convert. Skipping it." )
+        FinishMeasurement ( licel_measurement.Id() )
+        return None
+        
+    uploaded_id = Upload (
+        config,
+        measurement_id,
+        licel_measurement.DataFiles()[-1].EndDateTime(),
+        file_path,
+        reprocess = args.reprocess,
+        replace = args.replace
+    )
+    
+    if not uploaded_id or not args.download:
+        FinishMeasurement ( licel_measurement.Id() )
+    elif args.stream:
+        # Only needed for converting or uploading again (see ResumePastWork):
+        datalog.update_measurement ( licel_measurement.Id(), ("licel_measurement", None), save=False )
+        
+    return uploaded_id
+    
+def RecordDownload ( measurement_id, result, wait, error = None ):
+    '''
+    Records the result of downloading the SCC products of a measurement in the datalog.
+    
+    Parameters
+    ----------
+    measurement_id : str
+        SCC measurement ID.
+    result : scc_access.Measurement or None
+        The measurement as returned by the SCC API once finished, or None if it was not
+        found or not finished.
+    wait : bool
+        True if obiwan waited for the SCC to finish processing the measurement.
+    error : str or None
+        Why obiwan stopped waiting for the measurement, if result is None.
+    '''
+    try:
+        if result is not None:
+            logger.debug ( "Processing finished", extra={'scope': measurement_id} )
+            
+            try:
+                scc_version = scc.GetSCCVersion ( scc.client.output_dir, measurement_id )
+            except Exception as e:
+                if result.elpp != 127:
+                    logger.error ( "No SCC products found", extra={'scope': measurement_id} )
+                    datalog.update_measurement_by_scc_id( measurement_id, ("result", "No SCC products found") )
+                else:
+                    logger.error ( "Unknown error in SCC products", extra={'scope': measurement_id} )
+                    datalog.update_measurement_by_scc_id( measurement_id, ("result", "Unknown error in SCC products") )
+                
+                scc_version = "Unknown SCC Version! Check preprocessed NetCDF files."
+                logger.error ( e )
+                return
+                
+            logger.info ( scc_version, extra={'scope': measurement_id} )
+            datalog.update_measurement_by_scc_id( measurement_id, ("downloaded", True) )
+            datalog.update_measurement_by_scc_id( measurement_id, ("result", scc.client.output_dir) )
+            datalog.update_measurement_by_scc_id( measurement_id, ("scc_version", scc_version) )
+        elif wait:
+            logger.error ( "Download failed", extra={'scope': measurement_id} )
+            datalog.update_measurement_by_scc_id( measurement_id, ("result", error or "Error downloading SCC products") )
+        else:
+            logger.info ( "Measurement was not yet processed by the SCC, will not wait for it.", extra={'scope': measurement_id} )
+            datalog.update_measurement_by_scc_id( measurement_id, ("result", "SCC did not finish processing in due time.") )
+    except Exception as e:
+        logger.error ( f"Error downloading SCC products: {str(e)}" )
+        datalog.update_measurement_by_scc_id( measurement_id, ("result", "Error downloading SCC products") )
+    finally:
+        FinishMeasurement ( scc_measurement_id = measurement_id )
+    
+def DownloadMeasurement ( measurement_id ):
+    '''
+    Downloads the SCC products of a measurement if the SCC finished processing it,
+    without waiting.
+    '''
+    result, _ = scc.client.get_measurement(measurement_id)
+    
+    if result is not None and result.has_finished:
+        scc.DownloadFinished ( result )
+    else:
+        result = None
+        
+    RecordDownload ( measurement_id, result, False )
+    
+def RecordDownloads ( poller ):
+    '''
+    Records the products downloaded by a ProcessingPoller, until it is closed.
+    '''
+    for measurement_id, result, error in poller.Results ():
+        RecordDownload ( measurement_id, result, True, error )
+        
+def RunArguments ():
+    '''
+    Retrieves the command line arguments which affect the work done by a run, for
+    comparing it with the last complete run (see RunState).
+    '''
+    run_arguments = dict ( vars ( args ) )
+    run_arguments["folder"] = os.path.abspath ( args.folder )
+    run_arguments["verbose"] = None
+    
+    return run_arguments
+    
+def IsRunComplete ():
+    '''
+    Checks if all the measurements of this run went through every requested step. Runs
+    with failed measurements are not saved as complete, so they are repeated next time.
+    '''
+    with datalog.lock:
+        if incomplete_measurements > 0:
+            return False
+            
+        return all ( IsMeasurementComplete ( measurement ) for measurement in datalog.measurements.values() )
+    
 parser = argparse.ArgumentParser(description="Tool for processing Licel lidar measurements using the Single Calculus Chain.")
 parser.add_argument("folder", help="The path to the folder you want to scan.")
 parser.add_argument("--datalog", help="Path of the Datalog CSV you want to save the processing log in.", default="datalog.csv")
@@ -249,222 +612,305 @@ parser.add_argument("--continuous", help="Use for continuous measuring systems",
 parser.add_argument("--resume", help="Tries to resume past, interrupted, processing if possible.", action="store_true")
 parser.add_argument("--test-files", help="Copies any raw test files to tests folder.", action="store_true", dest="test_files")
 parser.add_argument("--debug", help="Copies raw measurement files and resulting NetCDF files in the debug folder.", action="store_true")
-
-args = parser.parse_args ()
-
-if args.verbose is not None:
-    SetLogLevel ( args.verbose )
-
-if args.folder is None:
-    logger.error ( "You must specify the data folder. Exiting..." )
-    parser.print_help()
-    sys.exit (1)
-        
-try:
-    config = Config ( args.cfg )
-except Exception as e:
-    sys.exit (1)
-    
-scc.Initialize(
-    config.scc_basic_credentials,
-    config.scc_output_dir,
-    config.scc_base_url,
-    config.scc_website_credentials
-)
-
-datalog_path = os.path.join ( config.netcdf_out_dir, SWAP_FILE_NAME )
-UseSwapFile ( datalog_path )
-UseCsvDatalog ( args.datalog )
-
-test_lists = config.test_lists
-
-sys.path.append ( os.path.dirname (config.netcdf_parameters_path) )
-netcdf_parameters_filename = os.path.basename ( config.netcdf_parameters_path )
-if netcdf_parameters_filename.endswith ('.py'):
-    netcdf_parameters_filename = netcdf_parameters_filename[:-3]
-
-nc_parameters_module = importlib.import_module ( netcdf_parameters_filename )
-
-class CustomLidarMeasurement(LicelLidarMeasurement):
-    extra_netcdf_parameters = nc_parameters_module
-
-lidarchive = lidarchive.Lidarchive ( measurement_location = config.measurement_location, dark_location = config.dark_location )
-lidarchive.SetFolder (args.folder)
-
-if args.startdate is None:
-    start_date = None
-else:
-    start_date = datetime.datetime.strptime( args.startdate, '%Y%m%d%H%M%S' )
+parser.add_argument("--scan-workers", help="Number of processes used to read raw file headers (0 uses all available cores).", type=int, default=1, dest="scan_workers")
+parser.add_argument("--workers", help="Number of processes used to convert measurements to SCC NetCDF (0 uses all available cores).", type=int, default=1)
+parser.add_argument("--stream", help="Process each measurement as soon as it is identified, reading the data folder in chronological order.", action="store_true")
+parser.add_argument("--force-convert", help="Convert measurements even if their SCC NetCDF files are up to date.", action="store_true", dest="force_convert")
+parser.add_argument("--compression-report", help="Compares SCC NetCDF compression settings on the first measurement found, without processing anything.", action="store_true", dest="compression_report")
+parser.add_argument("--pipeline", help="Upload and download measurements while the next ones are being converted.", action="store_true")
+parser.add_argument("--upload-workers", help="Number of measurements uploaded to the SCC at the same time.", type=int, default=1, dest="upload_workers")
+parser.add_argument("--download-workers", help="Number of measurements waited for and downloaded at the same time when using --wait or --pipeline.", type=int, default=4, dest="download_workers")
+
+def main ():
+    global args, config, system_index, nc_parameters_module, CustomLidarMeasurement, manifest, netcdf_compression
     
-if args.enddate is None:
-    end_date = None
-else:
-    end_date = datetime.datetime.strptime( args.enddate, '%Y%m%d%H%M%S' )
+    args = parser.parse_args ()
     
-to_download = []
-
-if args.continuous:
-    logger.debug(datalog.config)
+    if args.verbose is not None:
+        SetLogLevel ( args.verbose )
     
-    last_processed_date = datalog.config.get("last_processed_date", None)
+    if args.folder is None:
+        logger.error ( "You must specify the data folder. Exiting..." )
+        parser.print_help()
+        sys.exit (1)
+            
+    try:
+        config = Config ( args.cfg )
+    except Exception as e:
+        sys.exit (1)
+        
+    datalog_path = os.path.join ( config.netcdf_out_dir, SWAP_FILE_NAME )
+    UseSwapFile ( datalog_path )
+    UseCsvDatalog ( args.datalog )
     
-    if last_processed_date is not None:
-        if start_date is not None and start_date < last_processed_date:
-            start_date = last_processed_date
-        if start_date is None:
-            start_date = last_processed_date
-
-system_index = SystemIndex (config.scc_configurations_folder)
-
-if not args.convert:
-    scc.Login()
-
-if args.resume:
-    resume_download = ResumePastWork ()
-    to_download += resume_download
-    # datalog.reset()
-
-log_header_run_time = "Run started at %s" % ( datetime.datetime.now().strftime ( "%Y-%m-%d %H:%M:%S" ) )
-logger.info ( log_header_run_time, extra={'scope': 'start'} )
-
-log_header_cfg = "Configuration file = %s" % ( config.file_path )
-logger.info ( log_header_cfg )
-
-log_header_folder = "Data folder = %s" % os.path.abspath ( args.folder )
-logger.info ( log_header_folder )
-
-start_time_text = "N/A" if start_date is None else start_date.strftime ( "%Y-%m-%d %H:%M:%S" )
-log_header_start_time = "Minimum start time = %s" % ( start_time_text )
-logger.info ( log_header_start_time )
-
-end_time_text = "N/A" if end_date is None else end_date.strftime ( "%Y-%m-%d %H:%M:%S" )
-log_header_end_time = "Maximum end time = %s" % (end_time_text)
-logger.info ( log_header_end_time )
-
-log_header_gap = "Maximum gap between measurements (seconds) = %d" % config.max_acceptable_gap
-logger.info ( log_header_gap )
-
-logger.info ( "Identifying measurements. This can take a few minutes...")
-
-lidarchive.ReadFolder (start_date, end_date)
-logger.debug ( "Found %d files" % len (lidarchive.Measurements()) )
-
-licel_measurements = lidarchive.ContinuousMeasurements (config.max_acceptable_gap, config.min_acceptable_length, config.max_acceptable_length, config.center_type)
-logger.info ( "Identified %d different continuous measurements with a maximum acceptable gap of %ds" % (len (licel_measurements), config.max_acceptable_gap) )
-
-if args.test_files:
-    logger.info("Copying test files...")
-    lidarchive.CopyTestFiles ( config.tests_dir )
-
-for licel_measurement in licel_measurements:
-    datalog.update_measurement ( licel_measurement.Id(), ("licel_measurement", licel_measurement), save=False )
-    datalog.update_measurement ( licel_measurement.Id(), ("scc_netcdf_path", ""), save=False )
-    datalog.update_measurement ( licel_measurement.Id(), ("converted", False), save=False )
-    datalog.update_measurement ( licel_measurement.Id(), ("uploaded", False) )
-    datalog.update_measurement ( licel_measurement.Id(), ("downloaded", False), save=False )
-    datalog.update_measurement ( licel_measurement.Id(), ("system_id", None), save=False )
-    datalog.update_measurement ( licel_measurement.Id(), ("scc_measurement_id", None), save=False )
-    datalog.update_measurement ( licel_measurement.Id(), ("already_on_scc", False), save=False )
-    datalog.update_measurement ( licel_measurement.Id(), ("result", ""), save=False )
-    datalog.update_measurement ( licel_measurement.Id(), ("scc_version", ""), save=False )
-    datalog.update_measurement ( licel_measurement.Id(), ("process_start", datetime.datetime.now()), save=False )
+    if args.startdate is None:
+        start_date = None
+    else:
+        start_date = datetime.datetime.strptime( args.startdate, '%Y%m%d%H%M%S' )
+        
+    if args.enddate is None:
+        end_date = None
+    else:
+        end_date = datetime.datetime.strptime( args.enddate, '%Y%m%d%H%M%S' )
+        
+    # Periodic runs (--continuous from cron) usually find nothing new. Find out before
+    # importing the processing modules and reading the system files. Runs asked to redo
+    # work always run:
+    run_state = RunState ( os.path.join ( config.netcdf_out_dir, RUN_STATE_FILE_NAME ) )
+    run_arguments = RunArguments ()
+    use_run_state = args.continuous and not ( args.replace or args.reprocess or args.force_convert or args.compression_report )
     
-datalog.update_config(("convert", args.convert), save=False)
-datalog.update_config(("reprocess", args.reprocess), save=False)
-datalog.update_config(("replace", args.replace), save=False)
-datalog.update_config(("download", args.download), save=False)
-datalog.update_config(("folder", os.path.abspath(args.folder)), save=False)
-datalog.update_config(("last_processed_date", None), save=False)
-datalog.update_config(("debug", args.debug), save=False)
-datalog.update_config(("yaml", config), save=True)
-
-logger.info ( "Starting processing" )
-
-for index, licel_measurement in enumerate(licel_measurements):
-    # try:
-    logger.info ( f"Started processing measurement {index+1}/{len(licel_measurements)}" )
+    if not args.compression_report:
+        if use_run_state and run_state.IsIdle ( run_arguments, config, datalog_path, end_date ):
+            logger.info ( "No new or changed files since the last run. Exiting..." )
+            sys.exit (0)
+            
+        run_state.Clear ()
+        
+    LoadProcessingModules ()
     
-    if licel_measurement.Id() in [m.Id() for m in convert_resumed]:
-        logger.warning ( "This measurement measurement {licel_measurement.Id()} was processed already because of --convert. Skipping it." )
-        continue
+    scc.Initialize(
+        config.scc_basic_credentials,
+        config.scc_output_dir,
+        config.scc_base_url,
+        config.scc_website_credentials
+    )
     
-    file_path, measurement_id = Convert ( config, licel_measurement )
-
-    if not measurement_id:
-        continue
-
-    if args.debug:
-        if config.measurements_debug_dir:
-            DebugMeasurement (licel_measurement, file_path, config.measurements_debug_dir)
+    scc.Throttle (
+        config.scc_requests_per_second,
+        config.scc_maximum_request_retries,
+        config.scc_retry_delay,
+        config.scc_failures_before_pause,
+        config.scc_pause_time
+    )
+    
+    # One connection for each upload and download running at the same time:
+    scc.SetConnectionPoolSize ( args.upload_workers + ( args.download_workers if args.pipeline else 0 ) )
+    
+    test_lists = config.test_lists
+    
+    nc_parameters_module = LoadParametersModule ( config.netcdf_parameters_path )
+    CustomLidarMeasurement = MeasurementClass ( nc_parameters_module )
+    UseDarkCache ( config.dark_cache_size )
+    UseConversionBlocks ( config.conversion_block_size )
+    
+    netcdf_compression = NetcdfCompression ( config.netcdf_compression_level, config.netcdf_shuffle, config.netcdf_chunk_profiles )
+    UseNetcdfCompression ( netcdf_compression )
+    
+    manifest = ConversionManifest ( os.path.join ( config.netcdf_out_dir, MANIFEST_FILE_NAME ) )
+    
+    # Measurement IDs start with the date and the station call sign:
+    call_sign = nc_parameters_module.general_parameters['Call sign']
+    
+    if config.scc_index_lifetime > 0:
+        scc.UseMeasurementIndex ( SccMeasurementIndex (
+            os.path.join ( config.netcdf_out_dir, SCC_INDEX_FILE_NAME ),
+            len ( "YYYYmmdd" + call_sign ),
+            config.scc_index_lifetime
+        ) )
+    
+    archive = lidarchive.Lidarchive (
+        measurement_location = config.measurement_location,
+        dark_location = config.dark_location,
+        catalog = os.path.join ( config.netcdf_out_dir, CATALOG_FILE_NAME ),
+        workers = args.scan_workers if args.scan_workers > 0 else os.cpu_count(),
+        folder_pattern = config.folder_date_pattern,
+        match_dark_channels = config.match_dark_channels
+    )
+    archive.SetFolder (args.folder)
+    
+    to_download = []
+    
+    if args.continuous:
+        logger.debug(datalog.config)
+        
+        last_processed_date = datalog.config.get("last_processed_date", None)
+        
+        if last_processed_date is not None:
+            if start_date is not None and start_date < last_processed_date:
+                start_date = last_processed_date
+            if start_date is None:
+                start_date = last_processed_date
+    
+    system_index = SystemIndex (config.scc_configurations_folder, catalog = archive.catalog)
+    
+    if not args.convert and not args.compression_report:
+        scc.Login()
+    
+    if args.resume and not args.compression_report:
+        resume_download = ResumePastWork ()
+        to_download += resume_download
+        # datalog.reset()
+    
+    log_header_run_time = "Run started at %s" % ( datetime.datetime.now().strftime ( "%Y-%m-%d %H:%M:%S" ) )
+    logger.info ( log_header_run_time, extra={'scope': 'start'} )
+    
+    log_header_cfg = "Configuration file = %s" % ( config.file_path )
+    logger.info ( log_header_cfg )
+    
+    log_header_folder = "Data folder = %s" % os.path.abspath ( args.folder )
+    logger.info ( log_header_folder )
+    
+    start_time_text = "N/A" if start_date is None else start_date.strftime ( "%Y-%m-%d %H:%M:%S" )
+    log_header_start_time = "Minimum start time = %s" % ( start_time_text )
+    logger.info ( log_header_start_time )
+    
+    end_time_text = "N/A" if end_date is None else end_date.strftime ( "%Y-%m-%d %H:%M:%S" )
+    log_header_end_time = "Maximum end time = %s" % (end_time_text)
+    logger.info ( log_header_end_time )
+    
+    log_header_gap = "Maximum gap between measurements (seconds) = %d" % config.max_acceptable_gap
+    logger.info ( log_header_gap )
+    
+    logger.info ( "Identifying measurements. This can take a few minutes...")
+    
+    if args.stream:
+        licel_measurements = archive.StreamContinuousMeasurements (config.max_acceptable_gap, config.min_acceptable_length, config.max_acceptable_length, config.center_type, start_date, end_date)
+        
+        if args.test_files:
+            logger.warning ( "Test files can not be copied when using --stream. Skipping." )
+    else:
+        archive.ReadFolder (start_date, end_date)
+        logger.debug ( "Found %d files" % len (archive.Measurements()) )
+        
+        for kept_path, duplicate_paths in archive.duplicates.items():
+            logger.debug ( "Using %s, skipped identical copies: %s" % (kept_path, ", ".join (duplicate_paths)) )
+        
+        licel_measurements = archive.ContinuousMeasurements (config.max_acceptable_gap, config.min_acceptable_length, config.max_acceptable_length, config.center_type)
+        logger.info ( "Identified %d different continuous measurements with a maximum acceptable gap of %ds" % (len (licel_measurements), config.max_acceptable_gap) )
+        
+        if args.test_files:
+            logger.info("Copying test files...")
+            archive.CopyTestFiles ( config.tests_dir )
+        
+    if args.compression_report:
+        CompressionReport ( config, licel_measurements )
+        sys.exit (0)
+        
+    if not args.stream:
+        for licel_measurement in licel_measurements:
+            RegisterMeasurement ( licel_measurement )
             
-    if not args.convert:
-        if licel_measurement.Id() in [m.Id() for m in upload_resumed]:
-            logger.warning ( "This measurement measurement {licel_measurement.Id()} was processed already because of --convert. Skipping it." )
-            continue
+        if not args.convert:
+            # Ask the SCC for the existing measurements of all the processed days at once:
+            prefixes = sorted ( set (
+                licel_measurement.DataFiles()[0].StartDateTime().strftime('%Y%m%d') + call_sign
+                for licel_measurement in licel_measurements if len ( licel_measurement.DataFiles() ) > 0
+            ) )
             
-        measurement_id = Upload (
-            config,
-            measurement_id,
-            licel_measurement.DataFiles()[-1].EndDateTime(),
-            file_path,
-            reprocess = args.reprocess,
-            replace = args.replace
-        )
+            fetched = scc.PrefetchMeasurements ( prefixes )
+            logger.debug ( "Listed the SCC measurements of %d days (%d up to date)" % ( fetched, len(prefixes) - fetched ) )
         
-        if measurement_id:
-            to_download.append(measurement_id)
-            
-    # except Exception as e:
-        # logger.error ( "Error processing measurement: %s" % (str(e)) )
-
-if args.download:
-    logger.info ( "Downloading SCC products" )
+    datalog.update_config(("convert", args.convert), save=False)
+    datalog.update_config(("reprocess", args.reprocess), save=False)
+    datalog.update_config(("replace", args.replace), save=False)
+    datalog.update_config(("download", args.download), save=False)
+    datalog.update_config(("folder", os.path.abspath(args.folder)), save=False)
+    datalog.update_config(("last_processed_date", None), save=False)
+    datalog.update_config(("debug", args.debug), save=False)
+    datalog.update_config(("yaml", config), save=True)
     
-    to_download = list(set(to_download))
+    logger.info ( "Starting processing" )
     
-    for measurement_id in to_download:
-        if args.wait:
-            result = scc.client.monitor_processing ( measurement_id, exit_if_missing = not args.wait )
-            logger.debug ( "Waiting for processing to finish and downloading files...", extra={'scope': measurement_id} )
-        else:
-            result, _ = scc.client.get_measurement(measurement_id)
+    conversion_workers = args.workers if args.workers > 0 else os.cpu_count()
+    
+    if conversion_workers > 1 and not CanConvertInParallel ():
+        logger.warning ( "Parallel conversion is not supported on this system, converting one measurement at a time." )
+        conversion_workers = 1
+    
+    if conversion_workers > 1:
+        converted_measurements = ParallelConvert ( config, PendingMeasurements ( licel_measurements ), conversion_workers )
+    else:
+        converted_measurements = ( (licel_measurement,) + Convert ( config, licel_measurement ) for licel_measurement in PendingMeasurements ( licel_measurements ) )
+    
+    converted_measurements = ConvertedMeasurements ( converted_measurements )
+    
+    if args.pipeline and not args.convert:
+        # Uploads and downloads run in their own threads while the next measurements are
+        # converted. Downloads start right after uploading, so they always wait for the SCC:
+        pipeline = Pipeline ()
+        pipeline.AddStage ( "upload", lambda item: UploadConverted ( *item ), args.upload_workers )
+        
+        if args.download:
+            poller = ProcessingPoller ( scc, args.download_workers )
+            pipeline.AddStage ( "download", poller.Add, unique = True )
+            
+            for measurement_id in to_download:
+                poller.Add ( measurement_id )
+                
+            downloads = threading.Thread ( target = RecordDownloads, args = ( poller, ), name = "download", daemon = True )
+            downloads.start ()
             
+        pipeline.Start ()
+        
         try:
-            if result is not None:
-                logger.debug ( "Processing finished", extra={'scope': measurement_id} )
+            for item in converted_measurements:
+                pipeline.Put ( item )
+        finally:
+            pipeline.Finish ()
+            
+            if args.download:
+                poller.Close ()
+                downloads.join ()
+    else:
+        if args.upload_workers > 1 and not args.convert:
+            # Upload several measurements at the same time, while the next ones are converted:
+            uploaded_measurements = UploadPool ( args.upload_workers ).Map ( lambda item: UploadConverted ( *item ), converted_measurements )
+        else:
+            uploaded_measurements = ( (item, UploadConverted ( *item ), None) for item in converted_measurements )
+            
+        for (licel_measurement, file_path, measurement_id), uploaded_id, error in uploaded_measurements:
+            if error is not None:
+                logger.error ( "Error uploading measurement: %s" % error, extra={'scope': measurement_id} )
+                datalog.update_measurement_by_scc_id ( measurement_id, ( "result", "Error uploading to SCC" ) )
+                FinishMeasurement ( licel_measurement.Id() )
+                continue
                 
-                try:
-                    scc_version = scc.GetSCCVersion ( scc.client.output_dir, measurement_id )
-                except Exception as e:
-                    if result.elpp != 127:
-                        logger.error ( "No SCC products found", extra={'scope': measurement_id} )
-                        datalog.update_measurement_by_scc_id( measurement_id, ("result", "No SCC products found") )
-                    else:
-                        logger.error ( "Unknown error in SCC products", extra={'scope': measurement_id} )
-                        datalog.update_measurement_by_scc_id( measurement_id, ("result", "Unknown error in SCC products") )
-                    
-                    scc_version = "Unknown SCC Version! Check preprocessed NetCDF files."
-                    logger.error ( e )
-                    continue
+            if uploaded_id:
+                to_download.append(uploaded_id)
+                
+        if args.download:
+            logger.info ( "Downloading SCC products" )
+            
+            to_download = list(set(to_download))
+            
+            if args.wait:
+                # Wait for all the measurements at once, downloading each as soon as it's processed:
+                poller = ProcessingPoller ( scc, args.download_workers )
+                
+                for measurement_id in to_download:
+                    poller.Add ( measurement_id )
                     
-                logger.info ( scc_version, extra={'scope': measurement_id} )
-                datalog.update_measurement_by_scc_id( measurement_id, ("downloaded", True) )
-                datalog.update_measurement_by_scc_id( measurement_id, ("result", scc.client.output_dir) )
-                datalog.update_measurement_by_scc_id( measurement_id, ("scc_version", scc_version) )
-            elif args.wait:
-                logger.error ( "Download failed", extra={'scope': measurement_id} )
-                datalog.update_measurement_by_scc_id( measurement_id, ("result", "Error downloading SCC products") )
+                poller.Close ()
+                RecordDownloads ( poller )
             else:
-                logger.info ( "Measurement was not yet processed by the SCC, will not wait for it.", extra={'scope': measurement_id} )
-                datalog.update_measurement_by_scc_id( measurement_id, ("result", "SCC did not finish processing in due time.") )
-        except Exception as e:
-            logger.error ( f"Error downloading SCC products: {str(e)}" )
-            datalog.update_measurement_by_scc_id( measurement_id, ("result", "Error downloading SCC products") )
+                for measurement_id in to_download:
+                    DownloadMeasurement ( measurement_id )
+                
+    run_complete = IsRunComplete ()
+    
+    if len ( archive.late_files ) > 0:
+        # Measurements they belong to were already processed without them:
+        logger.warning ( "Skipped %d files found after newer ones were processed. Run again without --stream to process them." % len ( archive.late_files ) )
+        
+        for path in archive.late_files:
+            logger.debug ( "Skipped late file %s" % path )
             
-if args.datalog is not None:
-    datalog.write_csv()
+        run_complete = False
+    
+    if args.datalog is not None:
+        datalog.write_csv()
+    
+    # Delete swap file
+    datalog.reset_measurements()
+    datalog.save()
+    
+    if use_run_state and run_complete:
+        # Measurements left out as too recent are processed by the first run after this:
+        due_time = None if archive.held_back_end is None else archive.held_back_end + config.max_acceptable_gap
+        run_state.Store ( run_arguments, config, datalog_path, start_date, end_date, due_time )
+        
+    sys.exit (0)
 
-# Delete swap file
-datalog.reset_measurements()
-datalog.save()
-sys.exit (0)
+if __name__ == "__main__":
+    main ()
@@ -0,0 +1,201 @@
+import queue
+import threading
+import time
+
+from obiwan.log import logger
+
+# Number of items waiting in front of each worker of a stage. Queues are kept short, so
+# a slow stage holds back the stages feeding it instead of letting work pile up:
+QUEUE_ITEMS_PER_WORKER = 2
+
+# Tells a stage worker that no more items will come:
+STOP = object ()
+
+class PipelineStage:
+    '''
+    A set of threads running the same function on the items of a bounded queue. The
+    results which are not None are passed on to the next stage.
+    '''
+    def __init__ ( self, name, function, workers = 1, queue_size = None, unique = False ):
+        '''
+        Parameters
+        ----------
+        name : str
+            Name of the stage, used in log messages.
+        function : callable
+            Function called for each item. It returns the item passed on to the next
+            stage, or None if there is nothing to pass on.
+        workers : int
+            Number of threads running the function.
+        queue_size : int or None
+            Maximum number of items waiting for this stage. If None, QUEUE_ITEMS_PER_WORKER
+            items are allowed for each worker.
+        unique : bool
+            If True, an item which was already put in this stage is skipped.
+        '''
+        self.name = name
+        self.function = function
+        self.workers = max ( workers, 1 )
+        self.queue = queue.Queue ( maxsize = queue_size or QUEUE_ITEMS_PER_WORKER * self.workers )
+        self.unique = unique
+        self.next = None
+        self.threads = []
+        self.seen = set ()
+        self.lock = threading.Lock ()
+
+        # Statistics:
+        self.processed = 0
+        self.failed = 0
+        self.busy_time = 0
+        self.blocked_time = 0
+        self.latencies = []
+
+    def Start ( self ):
+        for index in range ( self.workers ):
+            thread = threading.Thread ( target = self.Work, name = f"{self.name}-{index+1}", daemon = True )
+            thread.start ()
+            self.threads.append ( thread )
+
+    def Put ( self, item, entered = None ):
+        '''
+        Queues an item for this stage, waiting while the queue is full.
+
+        Parameters
+        ----------
+        item : object
+            The item to process.
+        entered : float or None
+            Time (time.monotonic) the item entered the pipeline. If None, the current time is used.
+        '''
+        if self.unique:
+            with self.lock:
+                if item in self.seen:
+                    return
+
+                self.seen.add ( item )
+
+        self.queue.put ( ( time.monotonic () if entered is None else entered, item ) )
+
+    def Stop ( self ):
+        '''
+        Lets the workers finish the queued items and waits for them.
+        '''
+        for thread in self.threads:
+            self.queue.put ( STOP )
+
+        for thread in self.threads:
+            thread.join ()
+
+        self.threads = []
+
+    def Work ( self ):
+        while True:
+            entry = self.queue.get ()
+
+            if entry is STOP:
+                return
+
+            entered, item = entry
+            started = time.monotonic ()
+
+            try:
+                result = self.function ( item )
+                failed = False
+            except Exception as e:
+                logger.error ( f"Error in the {self.name} stage: {str(e)}" )
+                result = None
+                failed = True
+
+            finished = time.monotonic ()
+
+            if result is not None and self.next is not None:
+                self.next.Put ( result, entered )
+
+            with self.lock:
+                self.processed += 1
+                self.failed += failed
+                self.busy_time += finished - started
+                self.blocked_time += time.monotonic () - finished
+
+                if result is not None and self.next is None:
+                    self.latencies.append ( finished - entered )
+
+    def LogStatistics ( self ):
+        logger.debug ( "Pipeline stage %s: %d items (%d failed), %.1fs busy, %.1fs waiting for the next stage, %d workers" % (
+            self.name, self.processed, self.failed, self.busy_time, self.blocked_time, self.workers
+        ) )
+
+        if len(self.latencies) > 0:
+            logger.debug ( "Pipeline latency: %.1fs average, %.1fs maximum" % (
+                sum ( self.latencies ) / len(self.latencies), max ( self.latencies )
+            ) )
+
+class Pipeline:
+    '''
+    Chains stages running in their own threads through bounded queues, so all the stages
+    work at the same time. A stage which can't keep up blocks the stages before it, and the
+    time an item spends in the pipeline depends on the slowest stage, not on the sum of all
+    stages.
+    '''
+    def __init__ ( self ):
+        self.stages = []
+
+    def AddStage ( self, name, function, workers = 1, queue_size = None, unique = False ):
+        '''
+        Appends a stage to the pipeline. See PipelineStage for the parameters.
+        '''
+        stage = PipelineStage ( name, function, workers, queue_size, unique )
+
+        if len(self.stages) > 0:
+            self.stages[-1].next = stage
+
+        self.stages.append ( stage )
+
+        return stage
+
+    def Stage ( self, name ):
+        for stage in self.stages:
+            if stage.name == name:
+                return stage
+
+        raise KeyError ( name )
+
+    def Start ( self ):
+        for stage in self.stages:
+            stage.Start ()
+
+    def Put ( self, item ):
+        '''
+        Queues an item for the first stage, waiting while the stage is busy.
+        '''
+        self.stages[0].Put ( item )
+
+    def Finish ( self ):
+        '''
+        Waits for all the queued items to go through the pipeline.
+        '''
+        # Stages are stopped in order, so each one has received everything before stopping:
+        for stage in self.stages:
+            stage.Stop ()
+
+        for stage in self.stages:
+            stage.LogStatistics ()
+
+    def Run ( self, items ):
+        '''
+        Feeds items to the first stage from the calling thread and waits for them to go
+        through the pipeline.
+
+        Parameters
+        ----------
+        items : iterable
+            Items for the first stage. A generator is only advanced when the first stage
+            has room for another item.
+        '''
+        self.Start ()
+
+        try:
+            for item in items:
+                self.Put ( item )
+        finally:
+            self.Finish ()
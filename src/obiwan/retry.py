@@ -0,0 +1,164 @@
+import random
+import threading
+import time
+
+class CircuitOpenError(Exception):
+    '''
+    Raised instead of calling a service which is considered down (see CircuitBreaker).
+    '''
+    pass
+
+class RetryPolicy:
+    '''
+    Computes the delays between the attempts of an operation: exponential backoff with
+    jitter, so clients which failed at the same time don't retry at the same time.
+    '''
+    def __init__ ( self, maximum_retries = 4, base_delay = 2, maximum_delay = 60 ):
+        '''
+        Parameters
+        ----------
+        maximum_retries : int
+            Number of attempts after the first one failed.
+        base_delay : float
+            Delay before the first retry, in seconds. Each retry waits twice as long as
+            the one before.
+        maximum_delay : float
+            Maximum delay between two attempts, in seconds.
+        '''
+        self.maximum_retries = maximum_retries
+        self.base_delay = base_delay
+        self.maximum_delay = maximum_delay
+
+    def Delay ( self, retry ):
+        '''
+        Computes the delay before a retry.
+
+        Parameters
+        ----------
+        retry : int
+            Number of the retry, starting at 1.
+
+        Returned value
+        --------------
+        The delay in seconds, between half and all of the exponential backoff delay.
+        '''
+        delay = min ( self.base_delay * 2 ** ( retry - 1 ), self.maximum_delay )
+
+        return delay / 2 + random.uniform ( 0, delay / 2 )
+
+class TokenBucket:
+    '''
+    Limits the rate of an operation shared by several threads. Each operation takes a
+    token, and tokens are added at a fixed rate up to the bucket size, which allows
+    short bursts.
+    '''
+    def __init__ ( self, rate, size = None ):
+        '''
+        Parameters
+        ----------
+        rate : float
+            Tokens added per second. If 0 or None, the rate is not limited.
+        size : float or None
+            Maximum number of tokens. If None, the bucket holds one second of tokens.
+        '''
+        self.rate = rate
+        self.size = max ( size or rate or 1, 1 )
+        self.tokens = self.size
+        self.updated = time.monotonic ()
+        self.lock = threading.Lock ()
+
+    def Acquire ( self ):
+        '''
+        Takes a token, waiting until one is available.
+        '''
+        if not self.rate:
+            return
+
+        while True:
+            with self.lock:
+                now = time.monotonic ()
+                self.tokens = min ( self.size, self.tokens + ( now - self.updated ) * self.rate )
+                self.updated = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                wait = ( 1 - self.tokens ) / self.rate
+
+            time.sleep ( wait )
+
+class CircuitBreaker:
+    '''
+    Stops calls to a service which keeps failing. After a given number of consecutive
+    failures the circuit opens and calls fail right away (see Check) for a while. Then
+    one call is let through: if it works, the circuit closes again, otherwise it stays
+    open for another while.
+    '''
+    def __init__ ( self, failure_threshold = 5, open_time = 60, name = "service" ):
+        '''
+        Parameters
+        ----------
+        failure_threshold : int
+            Consecutive failures opening the circuit. If 0, the circuit never opens.
+        open_time : float
+            Seconds the circuit stays open before a call is tried again.
+        name : str
+            Name of the service, used in messages.
+        '''
+        self.failure_threshold = failure_threshold
+        self.open_time = open_time
+        self.name = name
+        self.failures = 0
+        self.opened = None
+        self.trying = False
+        self.lock = threading.Lock ()
+
+    def Check ( self ):
+        '''
+        Called before each call.
+
+        Raises
+        ------
+        CircuitOpenError
+            If the circuit is open, or another thread is already trying the service again.
+        '''
+        with self.lock:
+            if self.opened is None:
+                return
+
+            remaining = self.opened + self.open_time - time.monotonic ()
+
+            if remaining > 0 or self.trying:
+                raise CircuitOpenError ( "%s is not answering, calls are paused for %.0fs" % ( self.name, max ( remaining, 0 ) ) )
+
+            self.trying = True
+
+    def IsOpen ( self ):
+        with self.lock:
+            return self.opened is not None
+
+    def Success ( self ):
+        with self.lock:
+            self.failures = 0
+            self.opened = None
+            self.trying = False
+
+    def Failure ( self ):
+        '''
+        Records a failed call.
+
+        Returned value
+        --------------
+        True if this failure opened the circuit.
+        '''
+        with self.lock:
+            self.failures += 1
+            was_open = self.opened is not None
+            self.trying = False
+
+            if self.failure_threshold and ( was_open or self.failures >= self.failure_threshold ):
+                self.opened = time.monotonic ()
+                return not was_open
+
+            return False
@@ -0,0 +1,139 @@
+import datetime
+import hashlib
+import json
+import os
+import time
+
+from obiwan.lidarchive.walker import DateFolderWalker
+
+class RunState:
+    '''
+    Fingerprint of everything a run of obiwan depends on (command line, configuration,
+    system files, swap file and the raw files in the processed interval), saved after
+    each complete run. When nothing changed since, the next run has no work to do and
+    can exit before importing the processing modules or reading any raw file header.
+
+    Only names, sizes and modification times are compared, so computing the fingerprint
+    costs one directory listing of the processed interval. Measurements left out because
+    they were too recent don't need any new file to be processed, so the state also holds
+    the time when they are due, after which runs are no longer idle.
+    '''
+
+    def __init__ ( self, path ):
+        '''
+        Parameters
+        ----------
+        path : str
+            Path of the JSON file holding the state of the last complete run.
+        '''
+        self.path = path
+
+    def Load ( self ):
+        '''
+        Reads the saved state.
+
+        Returned value
+        --------------
+        A (fingerprint, start_date, due_time) tuple, or (None, None, None) if there is no
+        usable state. The due time is in epoch seconds, or None if nothing was left out.
+        '''
+        try:
+            with open ( self.path ) as state_file:
+                state = json.load ( state_file )
+
+            start_date = state["start_date"]
+
+            if start_date is not None:
+                start_date = datetime.datetime.strptime ( start_date, '%Y%m%d%H%M%S' )
+
+            return state["fingerprint"], start_date, state["due_time"]
+        except ( OSError, ValueError, KeyError, TypeError ):
+            return None, None, None
+
+    @staticmethod
+    def Fingerprint ( arguments, config, swap_path, start_date = None, end_date = None ):
+        '''
+        Computes the fingerprint of a run.
+
+        Parameters
+        ----------
+        arguments : dict
+            Command line arguments affecting the run.
+        config : obiwan.config.Config
+            The configuration used by the run.
+        swap_path : str
+            Path of the swap file (see obiwan.log.SwapFile).
+        start_date : datetime or None
+            Date folders holding only files older than this date are not listed.
+        end_date : datetime or None
+            Date folders holding only files newer than this date are not listed.
+
+        Returned value
+        --------------
+        A hexadecimal string.
+        '''
+        fingerprint = hashlib.blake2b ( digest_size = 20 )
+        fingerprint.update ( repr ( sorted ( arguments.items () ) ).encode () )
+
+        def AddFile ( path ):
+            try:
+                stat = os.stat ( path )
+                fingerprint.update ( ( "%s\0%d\0%d\0" % ( path, stat.st_size, stat.st_mtime_ns ) ).encode () )
+            except OSError:
+                fingerprint.update ( ( "%s\0missing\0" % path ).encode () )
+
+        for path in ( config.file_path, config.netcdf_parameters_path, swap_path ):
+            AddFile ( path )
+
+        for root, dirs, files in os.walk ( config.scc_configurations_folder ):
+            dirs.sort ()
+
+            for name in sorted ( files ):
+                AddFile ( os.path.join ( root, name ) )
+
+        walker = DateFolderWalker ( config.folder_date_pattern )
+
+        for root, files in walker.Walk ( arguments["folder"], start_date, end_date ):
+            for name in files:
+                AddFile ( os.path.join ( root, name ) )
+
+        return fingerprint.hexdigest ()
+
+    def IsIdle ( self, arguments, config, swap_path, end_date = None ):
+        '''
+        Checks if nothing changed since the last complete run, and no measurement it left
+        out is due yet.
+        '''
+        fingerprint, start_date, due_time = self.Load ()
+
+        if fingerprint is None:
+            return False
+
+        if due_time is not None and time.time () >= due_time:
+            return False
+
+        return fingerprint == RunState.Fingerprint ( arguments, config, swap_path, start_date, end_date )
+
+    def Store ( self, arguments, config, swap_path, start_date = None, end_date = None, due_time = None ):
+        '''
+        Saves the state after a complete run. The start date is the one used by the run,
+        so files added later inside the processed interval are always noticed. The due time
+        (epoch seconds) is when measurements left out as too recent can be processed.
+        '''
+        state = {
+            "fingerprint": RunState.Fingerprint ( arguments, config, swap_path, start_date, end_date ),
+            "start_date": None if start_date is None else start_date.strftime ( '%Y%m%d%H%M%S' ),
+            "due_time": due_time,
+        }
+
+        with open ( self.path, 'w' ) as state_file:
+            json.dump ( state, state_file )
+
+    def Clear ( self ):
+        '''
+        Forgets the saved state, so the next run does all the work again.
+        '''
+        try:
+            os.remove ( self.path )
+        except FileNotFoundError:
+            pass
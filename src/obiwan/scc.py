@@ -1,14 +1,168 @@
+from obiwan.converter import netcdf_lock
 from obiwan.log import logger
+from obiwan.retry import CircuitBreaker, CircuitOpenError, RetryPolicy, TokenBucket
 
 import os
+import re
+import requests
+import threading
+import time
 
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from requests.adapters import HTTPAdapter
+from urllib.parse import urljoin
 from scc_access import scc_access
 from netCDF4 import Dataset
 
+# Connections kept open to the SCC by default, the same as the requests library:
+CONNECTION_POOL_SIZE = 10
+
+# Limits for the requests sent to the SCC (see SccSession):
+REQUESTS_PER_SECOND = 5
+MAXIMUM_REQUEST_RETRIES = 4
+RETRY_DELAY = 2
+MAXIMUM_RETRY_DELAY = 60
+FAILURES_BEFORE_PAUSE = 5
+PAUSE_TIME = 60
+
+# Seconds to wait for the SCC to accept a connection and to answer a request. Without a
+# timeout, a request to an unresponsive server would never end:
+REQUEST_TIMEOUT = (30, 300)
+
+# HTTP status codes meaning the SCC is down or overloaded, rather than refusing the request:
+UNAVAILABLE_STATUS_CODES = (429, 500, 502, 503, 504)
+
+# Request methods which can be sent again without side effects:
+RETRIED_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+# Measurements requested per page when listing the measurements of a day:
+LIST_PAGE_SIZE = 100
+
+# Seconds between two status requests for a measurement being processed by the SCC. The
+# interval grows while the status of the measurement doesn't change:
+POLL_MINIMUM_INTERVAL = 5
+POLL_MAXIMUM_INTERVAL = 60
+POLL_INTERVAL_GROWTH = 1.5
+
+# Status requests answered with "not found" before giving up on a measurement, the same as
+# scc_access.SCC.monitor_processing:
+POLL_MISSING_ATTEMPTS = 3
+
+# Consecutive status requests failing (e.g. connection errors, or calls paused by the
+# circuit breaker) before giving up on a measurement. With the growing poll interval this
+# is about 6 minutes of errors:
+POLL_ERROR_ATTEMPTS = 10
+
 def SetSCCConfig ( basic_credentials, output_dir, scc_base_url, website_credentials = None ):
     global scc
     scc.Initialize( basic_credentials, output_dir, scc_base_url, website_credentials )
 
+class SccSession ( requests.Session ):
+    '''
+    HTTP session used by the SCC client, so every call to the SCC (login, upload,
+    status requests, reprocessing, downloads) goes through the same limits:
+    
+    * requests are spaced by a token bucket shared by all threads;
+    * requests which can be repeated safely (GET) are retried with exponential backoff
+      and jitter when the connection fails or the SCC is unavailable, honouring its
+      Retry-After header;
+    * after several consecutive failures the SCC is considered down and requests fail
+      right away with CircuitOpenError for a while, instead of piling up.
+    '''
+    def __init__ ( self ):
+        super().__init__ ()
+        self.Throttle ()
+        
+    def Throttle ( self, requests_per_second = REQUESTS_PER_SECOND, maximum_retries = MAXIMUM_REQUEST_RETRIES, retry_delay = RETRY_DELAY, failures_before_pause = FAILURES_BEFORE_PAUSE, pause_time = PAUSE_TIME ):
+        '''
+        Sets the limits of the session.
+        
+        Parameters
+        ----------
+        requests_per_second : float
+            Maximum rate of requests sent to the SCC. Use 0 for no limit.
+        maximum_retries : int
+            Number of times a failed GET request is retried.
+        retry_delay : float
+            Seconds before the first retry, doubled for each of the next ones.
+        failures_before_pause : int
+            Consecutive failed requests after which the SCC is considered down. Use 0 to
+            never stop sending requests.
+        pause_time : float
+            Seconds without requests once the SCC is considered down.
+        '''
+        self.bucket = TokenBucket ( requests_per_second, 2 * requests_per_second )
+        self.retry_policy = RetryPolicy ( maximum_retries, retry_delay, MAXIMUM_RETRY_DELAY )
+        self.breaker = CircuitBreaker ( failures_before_pause, pause_time, "The SCC" )
+        
+    def Failure ( self, url, reason ):
+        if self.breaker.Failure ():
+            logger.warning ( "The SCC is not answering (%s), pausing requests for %ds." % ( reason, self.breaker.open_time ) )
+        else:
+            logger.debug ( "SCC request to %s failed: %s" % ( url, reason ) )
+            
+    def request ( self, method, url, *args, **kwargs ):
+        kwargs.setdefault ( 'timeout', REQUEST_TIMEOUT )
+        retries = self.retry_policy.maximum_retries if method.upper () in RETRIED_METHODS else 0
+        retry = 0
+        
+        while True:
+            self.breaker.Check ()
+            self.bucket.Acquire ()
+            
+            try:
+                response = super().request ( method, url, *args, **kwargs )
+            except ( requests.exceptions.ConnectionError, requests.exceptions.Timeout ) as e:
+                self.Failure ( url, type(e).__name__ )
+                
+                if retry >= retries or self.breaker.IsOpen ():
+                    raise
+                    
+                delay = None
+            else:
+                if response.status_code not in UNAVAILABLE_STATUS_CODES:
+                    self.breaker.Success ()
+                    return response
+                    
+                self.Failure ( url, "status code %d" % response.status_code )
+                
+                if retry >= retries or self.breaker.IsOpen ():
+                    return response
+                    
+                delay = RetryAfter ( response )
+                response.close ()
+                
+            retry += 1
+            
+            if delay is None:
+                delay = self.retry_policy.Delay ( retry )
+                
+            logger.debug ( "Retrying SCC request in %.1fs (%d/%d)." % ( delay, retry, retries ) )
+            time.sleep ( delay )
+            
+def RetryAfter ( response ):
+    '''
+    Reads the delay requested by a server in the Retry-After header of a response.
+    
+    Returned value
+    --------------
+    The delay in seconds (at most MAXIMUM_RETRY_DELAY), or None if the header is missing
+    or not a number of seconds.
+    '''
+    try:
+        return min ( max ( float ( response.headers['Retry-After'] ), 0 ), MAXIMUM_RETRY_DELAY )
+    except ( KeyError, ValueError ):
+        return None
+        
+class SccClient ( scc_access.SCC ):
+    '''
+    scc_access.SCC reading the measurement ID of uploaded files under netcdf_lock.
+    '''
+    @staticmethod
+    def measurement_id_from_file ( filename ):
+        with netcdf_lock:
+            return scc_access.SCC.measurement_id_from_file ( filename )
+
 class OwScc:
     def __init__ ( self ):
         self.client = None
@@ -17,6 +171,7 @@ class OwScc:
         self.client_base_url = None
         self.website_credentials = None
         self.logged_in = False
+        self.index = None
     
     def Initialize ( self, basic_credentials, output_dir, scc_base_url, website_credentials ):
         self.basic_credentials = basic_credentials
@@ -24,7 +179,110 @@ class OwScc:
         self.client_base_url = scc_base_url
         self.website_credentials = website_credentials
         
-        self.client = scc_access.SCC(self.basic_credentials, self.output_dir, self.client_base_url)
+        self.client = SccClient(self.basic_credentials, self.output_dir, self.client_base_url)
+        
+        # Send all the SCC requests through the same limits:
+        session = SccSession ()
+        session.auth = self.client.session.auth
+        session.verify = self.client.session.verify
+        self.client.session = session
+        
+    def Throttle ( self, *args, **kwargs ):
+        '''
+        Sets the limits of the requests sent to the SCC. See SccSession.Throttle for the parameters.
+        '''
+        self.client.session.Throttle ( *args, **kwargs )
+        
+    def UseMeasurementIndex ( self, index ):
+        '''
+        Answers the checks for existing measurements using an index of the measurements
+        stored in the SCC (see obiwan.sccindex.SccMeasurementIndex).
+        '''
+        self.index = index
+        
+    def ListMeasurements ( self, prefix ):
+        '''
+        Retrieves the IDs of all the measurements in the SCC starting with a prefix.
+        
+        Parameters
+        ----------
+        prefix : str
+            Start of the measurement IDs, e.g. the date and the station call sign.
+        
+        Returned value
+        --------------
+        A set of measurement IDs, or None if the SCC could not be asked.
+        '''
+        measurement_ids = set ()
+        url = urljoin ( self.client.api_base_url, 'measurements/' )
+        parameters = { 'id__startswith': prefix, 'limit': LIST_PAGE_SIZE }
+        
+        try:
+            # The API answers one page at a time, with the address of the next page:
+            while url is not None:
+                response = self.client.session.get ( url, params = parameters )
+                
+                if response.status_code != 200:
+                    logger.debug ( "Could not list SCC measurements starting with %s. Status code %d" % ( prefix, response.status_code ) )
+                    return None
+                    
+                page = response.json ()
+                measurement_ids.update ( measurement['id'] for measurement in page['objects'] )
+                
+                next_page = page.get ( 'meta', {} ).get ( 'next' )
+                url = None if not next_page else urljoin ( self.client.base_url, next_page )
+                parameters = None
+        except ( requests.exceptions.RequestException, CircuitOpenError, ValueError, KeyError, TypeError ) as e:
+            logger.debug ( "Could not list SCC measurements starting with %s: %s" % ( prefix, str(e) ) )
+            return None
+            
+        return measurement_ids
+        
+    def PrefetchMeasurements ( self, prefixes ):
+        '''
+        Updates the measurement index for the given prefixes, so existing measurements
+        can be checked without asking the SCC.
+        
+        Returned value
+        --------------
+        The number of prefixes requested from the SCC.
+        '''
+        if self.index is None:
+            return 0
+            
+        return self.index.Update ( prefixes, self.ListMeasurements )
+        
+    def MeasurementExists ( self, measurement_id ):
+        '''
+        Checks if a measurement is stored in the SCC, using the measurement index if
+        there is one.
+        '''
+        if self.index is not None:
+            exists = self.index.Exists ( measurement_id, self.ListMeasurements )
+            
+            if exists is not None:
+                return exists
+                
+        measurement, _ = self.client.get_measurement ( measurement_id )
+        
+        return measurement is not None
+        
+    def SetConnectionPoolSize ( self, size ):
+        '''
+        Sets the number of connections to the SCC kept open by the session. All the
+        threads using the client share its session (and its login), so the pool should
+        allow one connection for each request running at the same time. Otherwise
+        connections are closed after each request and opened again for the next one.
+        
+        Parameters
+        ----------
+        size : int
+            Maximum number of open connections.
+        '''
+        adapter = HTTPAdapter ( pool_connections = 1, pool_maxsize = max ( size, CONNECTION_POOL_SIZE ) )
+        
+        self.client.session.mount ( "http://", adapter )
+        self.client.session.mount ( "https://", adapter )
         
     def Login ( self ):
         self.client.login(self.website_credentials)
@@ -44,9 +302,10 @@ class OwScc:
         -------------
         String representing the SCC preprocessor version.
         '''
-        dataset = Dataset ( file )
-        pp_version = dataset.SCCPreprocessingVersion
-        dataset.close ()
+        with netcdf_lock:
+            dataset = Dataset ( file )
+            pp_version = dataset.SCCPreprocessingVersion
+            dataset.close ()
         
         return pp_version
     
@@ -63,9 +322,10 @@ class OwScc:
         -------------
         Two strings, representing the ELPP version and the ELDA version.
         '''
-        dataset = Dataset ( file )
-        software_version = dataset.__AnalysisSoftwareVersion
-        dataset.close ()
+        with netcdf_lock:
+            dataset = Dataset ( file )
+            software_version = dataset.__AnalysisSoftwareVersion
+            dataset.close ()
         
         elpp_regex = 'ELPP version: ([^;]*);'
         elda_regex = 'ELDA version: (.*)$'
@@ -94,21 +354,26 @@ class OwScc:
         preprocessed_folder = os.path.join ( download_folder, measurement_id, 'elpp' )
         file = os.path.join ( preprocessed_folder, os.listdir(preprocessed_folder)[0] )
         
-        dataset = Dataset ( file )
-        
-        scc_version = dataset.scc_version_description
-        
-        dataset.close()
+        with netcdf_lock:
+            dataset = Dataset ( file )
+            scc_version = dataset.scc_version_description
+            dataset.close()
         
         return scc_version
         
     def TryUpload ( self, filename, system_id, replace ):
-        # try:
-        upload = self.client.upload_file ( filename, system_id, replace, False )
-        # except Exception, e:
-            # measurement_id = os.path.splitext ( os.path.basename(filename) ) [0]
-            # logger.warning ( "[%s] SCC upload error: %s" % (measurement_id, str(e)))        
-            # upload = False
+        try:
+            upload = self.client.upload_file ( filename, system_id, replace, False )
+        except ( requests.exceptions.RequestException, CircuitOpenError ) as e:
+            measurement_id = os.path.splitext ( os.path.basename(filename) ) [0]
+            logger.warning ( "SCC upload error: %s" % str(e), extra={'scope': measurement_id} )
+            upload = False
+        except SystemExit:
+            # scc-access exits when the measurement already exists and can't be replaced,
+            # which would stop obiwan (or only the thread running the upload):
+            measurement_id = os.path.splitext ( os.path.basename(filename) ) [0]
+            logger.error ( "Measurement already exists in the SCC and can't be replaced.", extra={'scope': measurement_id} )
+            upload = False
             
         if upload != False:
             upload = True
@@ -137,15 +402,44 @@ class OwScc:
         # Send the file to SCC and start the processing chain:
         upload = self.TryUpload (filename, system_id, replace)
         
-        # If the upload failed, retry for a given number of times.
+        # If the upload failed, retry for a given number of times, waiting longer each time:
         while upload == False and retry_count < max_retry_count:
             retry_count += 1
-            logger.warning ( "[%s] Upload to SCC failed with code. Retrying (%d/%d)." % (measurement_id, retry_count, max_retry_count), extra={'scope': measurement_id} )
+            delay = self.client.session.retry_policy.Delay ( retry_count )
+            logger.warning ( "[%s] Upload to SCC failed. Retrying in %ds (%d/%d)." % (measurement_id, delay, retry_count, max_retry_count), extra={'scope': measurement_id} )
             
+            time.sleep ( delay )
             upload = self.TryUpload (filename, system_id, replace)
             
+        if upload and self.index is not None:
+            self.index.Add ( measurement_id )
+            
         return upload
         
+    def DownloadFinished ( self, measurement ):
+        '''
+        Downloads the products of a measurement which finished processing, the same
+        way as scc_access.SCC.monitor_processing.
+        
+        Parameters
+        ----------
+        measurement : scc_access.Measurement
+            The measurement, as returned by the SCC API.
+        '''
+        if measurement.hirelpp == 127:
+            self.client.download_hirelpp ( measurement.id )
+        if measurement.cloudmask == 127:
+            self.client.download_cloudmask ( measurement.id )
+        if measurement.elpp == 127:
+            self.client.download_elpp ( measurement.id )
+        if measurement.elda == 127:
+            self.client.download_elda ( measurement.id )
+            self.client.download_plots ( measurement.id )
+        if measurement.elic == 127:
+            self.client.download_elic ( measurement.id )
+        if measurement.is_calibration and measurement.eldec == 0:
+            self.client.download_eldec ( measurement.id )
+        
     def DownloadProducts ( self, measurements ):
         '''
         Download products for a given set of measurements.
@@ -184,4 +478,251 @@ class OwScc:
             else:
                 logger.error ( "Download failed", extra={'scope': measurement_id} )
                 
+class PendingMeasurement:
+    '''
+    Polling state of a measurement waited for by a ProcessingPoller.
+    '''
+    def __init__ ( self, interval ):
+        self.next_poll = time.monotonic ()
+        self.interval = interval
+        self.status = None
+        self.missing = 0
+        self.errors = 0
+        
+class ProcessingPoller:
+    '''
+    Waits for the SCC to process many measurements at once. All the pending measurements
+    are polled in rounds and the products of each are downloaded as soon as it finishes,
+    so waiting for a set of measurements takes about as long as the slowest of them.
+    
+    Measurements are polled more and more rarely while their status doesn't change (see
+    POLL_INTERVAL_GROWTH), and again often once it does, since a processing module which
+    just finished is usually followed by the next ones.
+    '''
+    def __init__ ( self, owscc, download_workers = 1, minimum_interval = POLL_MINIMUM_INTERVAL, maximum_interval = POLL_MAXIMUM_INTERVAL ):
+        '''
+        Parameters
+        ----------
+        owscc : OwScc
+            The SCC client used for polling and downloading.
+        download_workers : int
+            Number of measurements downloaded at the same time.
+        minimum_interval : float
+            Seconds between two status requests for a measurement whose status just changed.
+        maximum_interval : float
+            Maximum number of seconds between two status requests for a measurement.
+        '''
+        self.owscc = owscc
+        self.download_workers = max ( download_workers, 1 )
+        self.minimum_interval = minimum_interval
+        self.maximum_interval = maximum_interval
+        self.pending = {}
+        self.finished = []
+        self.downloading = 0
+        self.closed = False
+        self.condition = threading.Condition ()
+        
+    def Add ( self, measurement_id ):
+        '''
+        Starts waiting for a measurement. Can be called from any thread, also while
+        the results are being read. Measurements already waited for are ignored.
+        '''
+        with self.condition:
+            if measurement_id not in self.pending:
+                self.pending[ measurement_id ] = PendingMeasurement ( self.minimum_interval )
+                self.condition.notify_all ()
+                
+    def Close ( self ):
+        '''
+        Tells the poller no more measurements will be added, so Results returns once
+        all the pending measurements finished.
+        '''
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all ()
+            
+    def Poll ( self, measurement_id ):
+        '''
+        Requests the status of a measurement and schedules its next status request.
+        
+        Returned value
+        --------------
+        A (done, measurement, error) tuple. If done is True, the measurement is no longer
+        pending, and if measurement is None, error tells why it was given up on.
+        '''
+        try:
+            measurement, _ = self.owscc.client.get_measurement ( measurement_id )
+            error = None
+        except Exception as e:
+            logger.warning ( "Could not get the processing status: %s" % str(e), extra={'scope': measurement_id} )
+            measurement = None
+            error = str(e) or type(e).__name__
+            
+        with self.condition:
+            state = self.pending[ measurement_id ]
+            
+            if measurement is not None and measurement.has_finished:
+                del self.pending[ measurement_id ]
+                return True, measurement, None
+                
+            if error is None:
+                state.errors = 0
+            else:
+                state.errors += 1
+                
+                if state.errors >= POLL_ERROR_ATTEMPTS:
+                    logger.error ( "Giving up after %d failed status requests." % state.errors, extra={'scope': measurement_id} )
+                    del self.pending[ measurement_id ]
+                    return True, None, "Could not get the processing status: %s" % error
+                    
+            if measurement is None and error is None:
+                state.missing += 1
+                
+                if state.missing >= POLL_MISSING_ATTEMPTS:
+                    logger.error ( "Measurement not found on the SCC.", extra={'scope': measurement_id} )
+                    del self.pending[ measurement_id ]
+                    return True, None, "Measurement not found on the SCC"
+                    
+            status = None if measurement is None else (
+                measurement.upload, measurement.hirelpp, measurement.cloudmask, measurement.elpp, measurement.elda, measurement.elic
+            )
+            
+            if status is not None and status != state.status:
+                logger.debug ( "Processing status: %s" % ( status, ), extra={'scope': measurement_id} )
+                state.interval = self.minimum_interval
+            else:
+                state.interval = min ( state.interval * POLL_INTERVAL_GROWTH, self.maximum_interval )
+                
+            state.status = status
+            state.next_poll = time.monotonic () + state.interval
+            
+        return False, measurement, None
+        
+    def Download ( self, measurement_id, measurement, error ):
+        try:
+            if measurement is not None:
+                logger.debug ( "Processing finished, downloading products.", extra={'scope': measurement_id} )
+                self.owscc.DownloadFinished ( measurement )
+        except Exception as e:
+            logger.error ( "Error downloading SCC products: %s" % str(e), extra={'scope': measurement_id} )
+        finally:
+            with self.condition:
+                self.downloading -= 1
+                self.finished.append ( ( measurement_id, measurement, error ) )
+                self.condition.notify_all ()
+                
+    def NextRound ( self ):
+        '''
+        Waits until some measurements have to be polled or some downloads finished.
+        
+        Returned value
+        --------------
+        A (due, finished) tuple, holding the IDs of the measurements to poll and the
+        (measurement_id, measurement, error) tuples of the finished downloads, or None if
+        there is nothing left to wait for.
+        '''
+        with self.condition:
+            while True:
+                finished, self.finished = self.finished, []
+                now = time.monotonic ()
+                due = [ measurement_id for measurement_id, state in self.pending.items () if state.next_poll <= now ]
+                
+                if len(due) > 0 or len(finished) > 0:
+                    return due, finished
+                    
+                if len(self.pending) > 0:
+                    self.condition.wait ( min ( state.next_poll for state in self.pending.values () ) - now )
+                elif self.closed and self.downloading == 0:
+                    return None
+                else:
+                    self.condition.wait ()
+                    
+    def Results ( self ):
+        '''
+        Polls the pending measurements and downloads their products.
+        
+        Returned value
+        --------------
+        A generator of (measurement_id, measurement, error) tuples, in the order the
+        downloads finished. The measurement is the last status returned by the SCC API,
+        or None if the measurement was given up on, error then telling why (not found
+        on the SCC, or too many failed status requests). The generator ends when the
+        poller is closed and no measurement is pending.
+        '''
+        with ThreadPoolExecutor ( max_workers = self.download_workers, thread_name_prefix = "download" ) as executor:
+            while True:
+                next_round = self.NextRound ()
+                
+                if next_round is None:
+                    return
+                    
+                due, finished = next_round
+                
+                yield from finished
+                
+                for measurement_id in due:
+                    done, measurement, error = self.Poll ( measurement_id )
+                    
+                    if done:
+                        with self.condition:
+                            self.downloading += 1
+                            
+                        executor.submit ( self.Download, measurement_id, measurement, error )
+                        
+class UploadPool:
+    '''
+    Runs uploads in threads, so the time spent waiting for the SCC to answer is shared
+    by several measurements. All the threads use the same SCC session (see
+    OwScc.SetConnectionPoolSize). Items are only taken from the input when an upload
+    finishes, so at most the given number of uploads are in flight and the input can
+    be a generator (e.g. measurements being converted).
+    '''
+    def __init__ ( self, workers ):
+        self.workers = max ( workers, 1 )
+        
+    def Map ( self, function, items ):
+        '''
+        Calls a function for each item in the upload threads.
+        
+        Parameters
+        ----------
+        function : callable
+            Function uploading one item. Anything it writes to the datalog must be
+            thread safe (see obiwan.log.SwapFile).
+        items : iterable
+            Items passed to the function.
+        
+        Returned value
+        --------------
+        A generator of (item, result, error) tuples, in the order the uploads finished.
+        Either result or error is None.
+        '''
+        items = iter ( items )
+        running = {}
+        exhausted = False
+        
+        with ThreadPoolExecutor ( max_workers = self.workers, thread_name_prefix = "upload" ) as executor:
+            while True:
+                while not exhausted and len(running) < self.workers:
+                    try:
+                        item = next ( items )
+                    except StopIteration:
+                        exhausted = True
+                        break
+                        
+                    running[ executor.submit ( function, item ) ] = item
+                    
+                if len(running) == 0:
+                    break
+                    
+                done, _ = wait ( running, return_when = FIRST_COMPLETED )
+                
+                for future in done:
+                    item = running.pop ( future )
+                    
+                    try:
+                        yield item, future.result (), None
+                    except Exception as e:
+                        yield item, None, str(e) or type(e).__name__
+                
 scc = OwScc()
\ No newline at end of file
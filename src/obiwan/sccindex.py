@@ -0,0 +1,130 @@
+import sqlite3
+import threading
+import time
+
+class SccMeasurementIndex:
+    '''
+    Local copy of the IDs of the measurements stored in the SCC, grouped by prefix (the
+    date and the station call sign, e.g. 20230101ino), stored in an SQLite database.
+    The measurements of a whole day are requested at once, so checking if measurements
+    already exist in the SCC takes one request per day instead of one per measurement.
+    Prefixes are requested again once they are older than the index lifetime.
+    '''
+
+    SCHEMA_VERSION = 1
+
+    def __init__ ( self, path, prefix_length, lifetime = 3600 ):
+        '''
+        Opens (or creates) an index.
+
+        Parameters
+        ----------
+        path : str
+            Path of the SQLite database file.
+        prefix_length : int
+            Number of characters of a measurement ID making up its prefix.
+        lifetime : float
+            Seconds before the IDs of a prefix are requested from the SCC again.
+        '''
+        self.path = path
+        self.prefix_length = prefix_length
+        self.lifetime = lifetime
+
+        # Uploads run in several threads (see obiwan.scc.UploadPool):
+        self.lock = threading.Lock ()
+        self.connection = sqlite3.connect ( path, check_same_thread = False )
+
+        version = self.connection.execute ( "PRAGMA user_version" ).fetchone ()[0]
+
+        if version != SccMeasurementIndex.SCHEMA_VERSION:
+            self.connection.execute ( "DROP TABLE IF EXISTS prefixes" )
+            self.connection.execute ( "DROP TABLE IF EXISTS measurements" )
+            self.connection.execute ( "PRAGMA user_version = %d" % SccMeasurementIndex.SCHEMA_VERSION )
+
+        self.connection.execute ( "CREATE TABLE IF NOT EXISTS prefixes (prefix TEXT PRIMARY KEY, fetched REAL NOT NULL)" )
+        self.connection.execute ( "CREATE TABLE IF NOT EXISTS measurements (id TEXT PRIMARY KEY, prefix TEXT NOT NULL)" )
+        self.connection.commit ()
+
+    def Prefix ( self, measurement_id ):
+        return measurement_id[:self.prefix_length]
+
+    def IsFresh ( self, prefix ):
+        row = self.connection.execute ( "SELECT fetched FROM prefixes WHERE prefix = ?", ( prefix, ) ).fetchone ()
+
+        return row is not None and time.time () - row[0] < self.lifetime
+
+    def Update ( self, prefixes, fetch ):
+        '''
+        Requests the measurement IDs of the prefixes which are not in the index or are
+        too old.
+
+        Parameters
+        ----------
+        prefixes : iterable
+            The prefixes to update.
+        fetch : callable
+            Function returning the set of measurement IDs starting with a prefix, or None
+            if they could not be retrieved.
+
+        Returned value
+        --------------
+        The number of prefixes requested from the SCC.
+        '''
+        fetched = 0
+
+        with self.lock:
+            for prefix in prefixes:
+                if self.IsFresh ( prefix ):
+                    continue
+
+                measurement_ids = fetch ( prefix )
+
+                if measurement_ids is None:
+                    continue
+
+                self.connection.execute ( "DELETE FROM measurements WHERE prefix = ?", ( prefix, ) )
+                self.connection.executemany (
+                    "INSERT OR REPLACE INTO measurements (id, prefix) VALUES (?, ?)",
+                    [ ( measurement_id, prefix ) for measurement_id in measurement_ids ]
+                )
+                self.connection.execute ( "INSERT OR REPLACE INTO prefixes (prefix, fetched) VALUES (?, ?)", ( prefix, time.time () ) )
+                self.connection.commit ()
+                fetched += 1
+
+        return fetched
+
+    def Exists ( self, measurement_id, fetch ):
+        '''
+        Checks if a measurement exists in the SCC, requesting the IDs of its prefix first
+        if needed (see Update).
+
+        Returned value
+        --------------
+        True or False, or None if the IDs of the prefix could not be retrieved.
+        '''
+        prefix = self.Prefix ( measurement_id )
+        self.Update ( [prefix], fetch )
+
+        with self.lock:
+            if not self.IsFresh ( prefix ):
+                return None
+
+            row = self.connection.execute ( "SELECT 1 FROM measurements WHERE id = ?", ( measurement_id, ) ).fetchone ()
+
+        return row is not None
+
+    def Add ( self, measurement_id ):
+        '''
+        Records a measurement uploaded by obiwan.
+        '''
+        with self.lock:
+            self.connection.execute (
+                "INSERT OR REPLACE INTO measurements (id, prefix) VALUES (?, ?)",
+                ( measurement_id, self.Prefix ( measurement_id ) )
+            )
+            self.connection.commit ()
+
+    def Close ( self ):
+        with self.lock:
+            self.connection.commit ()
+            self.connection.close ()
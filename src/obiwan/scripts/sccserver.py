@@ -0,0 +1,383 @@
+import argparse
+import io
+import json
+import os
+import random
+import re
+import tempfile
+import threading
+import time
+import zipfile
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from netCDF4 import Dataset
+from urllib.parse import parse_qs, urlparse
+
+# Version description written in the products, read back by OwScc.GetSCCVersion:
+SCC_VERSION_DESCRIPTION = "SCC stand-in server (obiwan benchmarks)"
+
+# Page size of the measurements API when no limit is requested, the same as the SCC:
+DEFAULT_PAGE_SIZE = 20
+MAXIMUM_PAGE_SIZE = 1000
+
+# Measurement status codes, as used by scc_access.Measurement:
+STATUS_WAITING = 0
+STATUS_RUNNING = 1
+STATUS_OK = 127
+
+class SccStandIn:
+    '''
+    State of a stand-in SCC server: the uploaded measurements and the request statistics.
+    Measurements finish processing a fixed time after being uploaded or reprocessed.
+    '''
+    def __init__ ( self, latency = 0.1, failure_rate = 0, processing_time = 60, bandwidth = 0, seed = None ):
+        '''
+        Parameters
+        ----------
+        latency : float
+            Seconds added to the answer of each request.
+        failure_rate : float
+            Fraction of the requests answered with "503 Service Unavailable".
+        processing_time : float
+            Seconds needed to process a measurement.
+        bandwidth : float
+            Upload speed in kbit/s, used to delay uploads according to their size. Use 0
+            for no limit.
+        seed : int or None
+            Seed of the random failures, to repeat a benchmark.
+        '''
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.processing_time = processing_time
+        self.bandwidth = bandwidth
+        self.random = random.Random ( seed )
+        self.lock = threading.Lock ()
+        self.products = {}
+        self.Reset ()
+
+    def Reset ( self ):
+        '''
+        Forgets all the measurements and statistics.
+        '''
+        with self.lock:
+            self.measurements = {}
+            self.statistics = dict.fromkeys ( ( 'requests', 'failures', 'uploads', 'reruns', 'deletes', 'status', 'lists', 'downloads', 'concurrent', 'maximum_concurrent' ), 0 )
+
+    def Count ( self, name, increment = 1 ):
+        with self.lock:
+            self.statistics[ name ] += increment
+
+            if name == 'concurrent':
+                self.statistics[ 'maximum_concurrent' ] = max ( self.statistics[ 'maximum_concurrent' ], self.statistics[ 'concurrent' ] )
+
+    def Fails ( self ):
+        with self.lock:
+            return self.random.random () < self.failure_rate
+
+    def Process ( self, measurement_id, system_id = None ):
+        '''
+        Starts processing a measurement, uploaded or reprocessed.
+        '''
+        with self.lock:
+            if system_id is None:
+                system_id = self.measurements.get ( measurement_id, {} ).get ( 'system' )
+
+            self.measurements[ measurement_id ] = { 'system': system_id, 'started': time.monotonic () }
+
+    def Delete ( self, measurement_id ):
+        with self.lock:
+            return self.measurements.pop ( measurement_id, None ) is not None
+
+    def Status ( self, measurement_id ):
+        '''
+        Returned value
+        --------------
+        The API description of a measurement, or None if it doesn't exist.
+        '''
+        with self.lock:
+            measurement = self.measurements.get ( measurement_id )
+
+            if measurement is None:
+                return None
+
+            elapsed = time.monotonic () - measurement['started']
+
+        if elapsed >= self.processing_time:
+            elpp = elda = STATUS_OK
+        elif elapsed >= self.processing_time / 2:
+            elpp, elda = STATUS_OK, STATUS_RUNNING
+        else:
+            elpp, elda = STATUS_RUNNING, STATUS_WAITING
+
+        return {
+            'id': measurement_id,
+            'system': measurement['system'],
+            'is_calibration': False,
+            'is_running': elda != STATUS_OK,
+            'upload': STATUS_OK,
+            'hirelpp': STATUS_WAITING,
+            'cloudmask': STATUS_WAITING,
+            'elpp': elpp,
+            'elda': elda,
+            'elic': STATUS_WAITING,
+            'eldec': STATUS_WAITING,
+            'elquick': STATUS_WAITING,
+            'resource_uri': '/api/v1/measurements/%s/' % measurement_id,
+        }
+
+    def List ( self, prefix = "", exact = None ):
+        with self.lock:
+            if exact is not None:
+                return [ exact ] if exact in self.measurements else []
+
+            return sorted ( measurement_id for measurement_id in self.measurements if measurement_id.startswith ( prefix ) )
+
+    def Products ( self, measurement_id, product ):
+        '''
+        Builds the zip file downloaded for a product of a measurement.
+        '''
+        # Requests are answered in several threads, and the NetCDF library is not thread safe:
+        with self.lock:
+            if product not in self.products:
+                # The same small NetCDF file is used for all the products:
+                with tempfile.TemporaryDirectory () as folder:
+                    path = os.path.join ( folder, 'product.nc' )
+
+                    with Dataset ( path, 'w' ) as dataset:
+                        dataset.scc_version_description = SCC_VERSION_DESCRIPTION
+                        dataset.SCCPreprocessingVersion = SCC_VERSION_DESCRIPTION
+
+                    with open ( path, 'rb' ) as product_file:
+                        self.products[ product ] = product_file.read ()
+
+        archive = io.BytesIO ()
+
+        with zipfile.ZipFile ( archive, 'w' ) as zip_file:
+            zip_file.writestr ( '%s_%s.nc' % ( measurement_id, product ), self.products[ product ] )
+
+        return archive.getvalue ()
+
+class SccRequestHandler ( BaseHTTPRequestHandler ):
+    '''
+    Answers the requests sent by scc_access.SCC, using the SccStandIn of the server.
+    '''
+    protocol_version = "HTTP/1.1"
+
+    ROUTES = (
+        ( 'GET', r'/accounts/login/', 'LoginPage' ),
+        ( 'POST', r'/accounts/login/', 'Login' ),
+        ( 'GET', r'/accounts/logout/', 'Page' ),
+        ( 'GET', r'/', 'Page' ),
+        ( 'GET', r'/data_processing/measurements/quick/', 'FormPage' ),
+        ( 'POST', r'/data_processing/measurements/quick/', 'Upload' ),
+        ( 'GET', r'/data_processing/measurements/(?P<id>[^/]+)/', 'MeasurementPage' ),
+        ( 'GET', r'/data_processing/measurements/(?P<id>[^/]+)/rerun-all/', 'Rerun' ),
+        ( 'GET', r'/data_processing/measurements/(?P<id>[^/]+)/download-(?P<product>[^/]+)/', 'Download' ),
+        ( 'GET', r'/admin/database/measurements/(?P<id>[^/]+)/delete/', 'FormPage' ),
+        ( 'POST', r'/admin/database/measurements/(?P<id>[^/]+)/delete/', 'Delete' ),
+        ( 'GET', r'/api/v1/measurements/?', 'ListMeasurements' ),
+        ( 'GET', r'/api/v1/measurements/(?P<id>[^/]+)/', 'MeasurementStatus' ),
+    )
+
+    def log_message ( self, format, *args ):
+        pass
+
+    def Send ( self, code, body = b"", content_type = "text/html", headers = () ):
+        if isinstance ( body, str ):
+            body = body.encode ()
+
+        self.send_response ( code )
+        self.send_header ( "Content-Type", content_type )
+        self.send_header ( "Content-Length", str ( len ( body ) ) )
+
+        for name, value in headers:
+            self.send_header ( name, value )
+
+        self.end_headers ()
+        self.wfile.write ( body )
+
+    def Redirect ( self, location ):
+        self.Send ( 302, headers = [ ( "Location", location ) ] )
+
+    def Handle ( self, method ):
+        scc = self.server.scc
+        url = urlparse ( self.path )
+        body = self.rfile.read ( int ( self.headers.get ( "Content-Length", 0 ) ) )
+
+        scc.Count ( 'requests' )
+        scc.Count ( 'concurrent' )
+
+        try:
+            time.sleep ( scc.latency )
+
+            if scc.Fails ():
+                scc.Count ( 'failures' )
+                return self.Send ( 503, "Service Unavailable" )
+
+            for route_method, pattern, handler in SccRequestHandler.ROUTES:
+                match = re.fullmatch ( pattern, url.path )
+
+                if route_method == method and match is not None:
+                    return getattr ( self, handler ) ( scc, match.groupdict (), parse_qs ( url.query ), body )
+
+            self.Send ( 404, "Not Found" )
+        finally:
+            scc.Count ( 'concurrent', -1 )
+
+    def do_GET ( self ):
+        self.Handle ( 'GET' )
+
+    def do_POST ( self ):
+        self.Handle ( 'POST' )
+
+    def Page ( self, scc, parameters, query, body ):
+        self.Send ( 200, "<html></html>" )
+
+    def FormPage ( self, scc, parameters, query, body ):
+        self.Send ( 200, "<form></form>", headers = [ ( "Set-Cookie", "csrftoken=standin; Path=/" ) ] )
+
+    def LoginPage ( self, scc, parameters, query, body ):
+        self.FormPage ( scc, parameters, query, body )
+
+    def Login ( self, scc, parameters, query, body ):
+        self.Send ( 302, headers = [ ( "Location", "/" ), ( "Set-Cookie", "sessionid=standin; Path=/" ) ] )
+
+    def Upload ( self, scc, parameters, query, body ):
+        # The measurement ID is the name of the uploaded SCC NetCDF file:
+        file_name = re.search ( rb'name="data"; filename="([^"]+)"', body )
+        system_id = re.search ( rb'name="system"\r\n\r\n([^\r]*)', body )
+
+        if file_name is None:
+            return self.Redirect ( "/data_processing/measurements/quick/" )
+
+        if scc.bandwidth:
+            time.sleep ( len ( body ) * 8 / ( scc.bandwidth * 1000 ) )
+
+        measurement_id = os.path.splitext ( os.path.basename ( file_name.group ( 1 ).decode () ) )[0]
+
+        scc.Count ( 'uploads' )
+        scc.Process ( measurement_id, None if system_id is None else system_id.group ( 1 ).decode () )
+
+        self.Redirect ( "/data_processing/measurements/%s/" % measurement_id )
+
+    def MeasurementPage ( self, scc, parameters, query, body ):
+        self.Send ( 200, "<h3>Measurement %s <small>" % parameters['id'] )
+
+    def Rerun ( self, scc, parameters, query, body ):
+        if scc.Status ( parameters['id'] ) is None:
+            return self.Send ( 404, "Not Found" )
+
+        scc.Count ( 'reruns' )
+        scc.Process ( parameters['id'] )
+        self.Send ( 200, "<html></html>" )
+
+    def Download ( self, scc, parameters, query, body ):
+        status = scc.Status ( parameters['id'] )
+
+        if status is None or status['is_running']:
+            return self.Send ( 404, "Not Found" )
+
+        scc.Count ( 'downloads' )
+        self.Send ( 200, scc.Products ( parameters['id'], parameters['product'] ), "application/zip" )
+
+    def Delete ( self, scc, parameters, query, body ):
+        scc.Count ( 'deletes' )
+        scc.Delete ( parameters['id'] )
+        self.Redirect ( "/admin/" )
+
+    def MeasurementStatus ( self, scc, parameters, query, body ):
+        scc.Count ( 'status' )
+        status = scc.Status ( parameters['id'] )
+
+        if status is None:
+            return self.Send ( 404, "Not Found" )
+
+        self.Send ( 200, json.dumps ( status ), "application/json" )
+
+    def ListMeasurements ( self, scc, parameters, query, body ):
+        scc.Count ( 'lists' )
+
+        prefix = query.get ( 'id__startswith', [""] )[0]
+        exact = query.get ( 'id__exact', [None] )[0]
+        limit = int ( query.get ( 'limit', [DEFAULT_PAGE_SIZE] )[0] ) or MAXIMUM_PAGE_SIZE
+        limit = min ( limit, MAXIMUM_PAGE_SIZE )
+        offset = int ( query.get ( 'offset', [0] )[0] )
+
+        measurement_ids = scc.List ( prefix, exact )
+        next_page = None
+
+        if offset + limit < len ( measurement_ids ):
+            next_page = "/api/v1/measurements/?id__startswith=%s&limit=%d&offset=%d" % ( prefix, limit, offset + limit )
+
+        page = {
+            'meta': { 'limit': limit, 'offset': offset, 'total_count': len ( measurement_ids ), 'next': next_page },
+            'objects': [ scc.Status ( measurement_id ) for measurement_id in measurement_ids[ offset:offset + limit ] ],
+        }
+
+        self.Send ( 200, json.dumps ( page ), "application/json" )
+
+class SccServer ( ThreadingHTTPServer ):
+    '''
+    HTTP server standing in for the SCC, answering each request in its own thread.
+    '''
+    daemon_threads = True
+
+    def __init__ ( self, address, scc ):
+        super().__init__ ( address, SccRequestHandler )
+        self.scc = scc
+
+    @property
+    def base_url ( self ):
+        return "http://%s:%d/" % self.server_address[:2]
+
+def StartServer ( scc, port = 0 ):
+    '''
+    Starts a stand-in SCC server in a background thread.
+
+    Parameters
+    ----------
+    scc : SccStandIn
+        State of the server.
+    port : int
+        Port to listen on. If 0, a free port is used.
+
+    Returned value
+    --------------
+    The SccServer object. Call its shutdown method to stop it.
+    '''
+    server = SccServer ( ( "127.0.0.1", port ), scc )
+    threading.Thread ( target = server.serve_forever, name = "sccserver", daemon = True ).start ()
+
+    return server
+
+def AddServerArguments ( parser ):
+    parser.add_argument ( "--latency", help = "Seconds added to each answer.", type = float, default = 0.1 )
+    parser.add_argument ( "--failure-rate", help = "Fraction of the requests answered with 503.", type = float, default = 0, dest = "failure_rate" )
+    parser.add_argument ( "--processing-time", help = "Seconds needed to process a measurement.", type = float, default = 60, dest = "processing_time" )
+    parser.add_argument ( "--bandwidth", help = "Upload speed in kbit/s (0 for no limit).", type = float, default = 0 )
+    parser.add_argument ( "--seed", help = "Seed of the random failures.", type = int, default = None )
+
+def StandInFromArguments ( args ):
+    return SccStandIn ( args.latency, args.failure_rate, args.processing_time, args.bandwidth, args.seed )
+
+def main ():
+    parser = argparse.ArgumentParser ( description = "Runs a local server standing in for the Single Calculus Chain, for testing and benchmarking obiwan." )
+    parser.add_argument ( "--port", help = "Port to listen on.", type = int, default = 8000 )
+    AddServerArguments ( parser )
+
+    args = parser.parse_args ()
+
+    scc = StandInFromArguments ( args )
+    server = SccServer ( ( "127.0.0.1", args.port ), scc )
+
+    print ( "SCC stand-in listening at %s (use it as scc_base_url). Press Ctrl+C to stop." % server.base_url )
+
+    try:
+        server.serve_forever ()
+    except KeyboardInterrupt:
+        pass
+
+    print ( json.dumps ( scc.statistics, indent = 4 ) )
+
+if __name__ == "__main__":
+    main ()
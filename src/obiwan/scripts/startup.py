@@ -0,0 +1,103 @@
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+from obiwan.config import Config
+from obiwan.obiwan import RUN_STATE_FILE_NAME
+
+# Modules imported by obiwan, timed one at a time in a fresh interpreter:
+IMPORTED_MODULES = (
+    'yaml',
+    'numpy',
+    'netCDF4',
+    'atmospheric_lidar.licel',
+    'scc_access.scc_access',
+    'obiwan.config',
+    'obiwan.runstate',
+    'obiwan.lidarchive.lidarchive',
+    'obiwan.converter',
+    'obiwan.scc',
+    'obiwan.obiwan',
+)
+
+def TimeCommand ( command, runs, before_run = None ):
+    '''
+    Runs a command several times.
+
+    Returned value
+    --------------
+    A (minimum, median) tuple of wall times, in seconds, or None if the command failed.
+    '''
+    times = []
+
+    for run in range ( runs ):
+        if before_run is not None:
+            before_run ()
+
+        started = time.perf_counter ()
+        completed = subprocess.run ( command, stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL )
+
+        if completed.returncode != 0:
+            return None
+
+        times.append ( time.perf_counter () - started )
+
+    return min ( times ), statistics.median ( times )
+
+def main ():
+    parser = argparse.ArgumentParser ( description = "Measures the startup time of obiwan, with and without work to do." )
+    parser.add_argument ( "--runs", help = "Number of times each command is run.", type = int, default = 5 )
+    parser.add_argument ( "--full-runs", help = "Number of complete runs, with the last run state deleted before each one.", type = int, default = 1, dest = "full_runs" )
+    parser.epilog = "All other arguments are passed to obiwan (e.g. --convert --continuous /mnt/data/lidar)."
+
+    args, args.obiwan_arguments = parser.parse_known_args ()
+
+    if len ( args.obiwan_arguments ) == 0:
+        parser.error ( "the obiwan arguments are required" )
+
+    # Same configuration as the benchmarked runs, to find the last run state file:
+    cfg = None
+
+    if "--cfg" in args.obiwan_arguments:
+        cfg = args.obiwan_arguments[ args.obiwan_arguments.index ( "--cfg" ) + 1 ]
+
+    state_path = os.path.join ( Config ( cfg ).netcdf_out_dir, RUN_STATE_FILE_NAME )
+
+    def ClearState ():
+        if os.path.exists ( state_path ):
+            os.remove ( state_path )
+
+    print ( "Import times (fresh interpreter, including the interpreter startup):" )
+
+    interpreter = TimeCommand ( [sys.executable, "-c", "pass"], args.runs )
+    print ( "%-32s %8.0f ms" % ( "(interpreter only)", interpreter[0] * 1000 ) )
+
+    for module in IMPORTED_MODULES:
+        times = TimeCommand ( [sys.executable, "-c", "import %s" % module], args.runs )
+
+        if times is None:
+            print ( "%-32s %11s" % ( module, "failed" ) )
+        else:
+            print ( "%-32s %8.0f ms" % ( module, times[0] * 1000 ) )
+
+    command = [sys.executable, "-m", "obiwan.obiwan"] + args.obiwan_arguments
+
+    full = TimeCommand ( command, args.full_runs, ClearState )
+
+    # The last complete run saved its state, so the next ones have nothing to do:
+    idle = TimeCommand ( command, args.runs )
+
+    print ( "" )
+    print ( "obiwan %s" % " ".join ( args.obiwan_arguments ) )
+
+    for name, times in ( ( "Complete run", full ), ( "Run with no new files", idle ) ):
+        if times is None:
+            print ( "%-32s %11s" % ( name, "failed" ) )
+        else:
+            print ( "%-32s %8.0f ms minimum, %8.0f ms median" % ( name, times[0] * 1000, times[1] * 1000 ) )
+
+if __name__ == "__main__":
+    main ()
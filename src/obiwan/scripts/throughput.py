@@ -0,0 +1,129 @@
+import argparse
+import glob
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import yaml
+
+from obiwan.config import Config
+from obiwan.obiwan import RUN_STATE_FILE_NAME, SCC_INDEX_FILE_NAME, SWAP_FILE_NAME
+from obiwan.scripts.sccserver import AddServerArguments, StandInFromArguments, StartServer
+
+# obiwan arguments compared when no --variant is given:
+DEFAULT_VARIANTS = (
+    "--download --wait",
+    "--download --wait --upload-workers 4",
+    "--download --wait --pipeline --upload-workers 4",
+)
+
+def WriteConfig ( cfg, folder, base_url ):
+    '''
+    Writes a copy of an obiwan configuration using the stand-in server, with its outputs
+    in a temporary folder.
+
+    Returned value
+    --------------
+    The path of the new configuration file.
+    '''
+    with open ( Config ( cfg ).file_path ) as cfg_file:
+        settings = yaml.safe_load ( cfg_file )
+
+    settings['scc_base_url'] = base_url
+    settings['netcdf_out_folder'] = os.path.join ( folder, 'netcdf' )
+    settings['scc_output_dir'] = os.path.join ( folder, 'scc_output' )
+    settings['measurements_debug_dir'] = os.path.join ( folder, 'debug' )
+
+    path = os.path.join ( folder, 'obiwan.config.yaml' )
+
+    with open ( path, 'w' ) as cfg_file:
+        yaml.safe_dump ( settings, cfg_file )
+
+    return path
+
+def RunObiwan ( cfg, arguments, folder, log_path ):
+    '''
+    Runs obiwan in a new process.
+
+    Returned value
+    --------------
+    A (wall time, exit code) tuple.
+    '''
+    command = [ sys.executable, "-m", "obiwan.obiwan", "--cfg", cfg, "--datalog", os.path.join ( os.path.dirname ( cfg ), "datalog.csv" ) ]
+    command += shlex.split ( arguments ) + [ folder ]
+
+    started = time.perf_counter ()
+
+    with open ( log_path, 'w' ) as log_file:
+        completed = subprocess.run ( command, stdout = log_file, stderr = subprocess.STDOUT, cwd = os.path.dirname ( cfg ) )
+
+    return time.perf_counter () - started, completed.returncode
+
+def main ():
+    parser = argparse.ArgumentParser ( description = "Runs obiwan against a local SCC stand-in server and compares the run time of several sets of arguments." )
+    parser.add_argument ( "folder", help = "The raw data folder processed by obiwan." )
+    parser.add_argument ( "--cfg", help = "obiwan configuration file, used for everything except the SCC and output folders.", default = None )
+    parser.add_argument ( "--variant", help = "obiwan arguments to benchmark, in quotes. Can be given several times.", action = "append", dest = "variants" )
+    parser.add_argument ( "--keep", help = "Keep the temporary folder with the outputs and logs of each run.", action = "store_true" )
+    AddServerArguments ( parser )
+
+    args = parser.parse_args ()
+
+    # obiwan runs in the temporary folder:
+    data_folder = os.path.abspath ( args.folder )
+
+    scc = StandInFromArguments ( args )
+    server = StartServer ( scc )
+    work_folder = tempfile.mkdtemp ( prefix = "obiwan-throughput-" )
+    cfg = WriteConfig ( args.cfg, work_folder, server.base_url )
+    netcdf_folder = os.path.join ( work_folder, 'netcdf' )
+
+    print ( "SCC stand-in at %s: %.2fs latency, %.0f%% failures, %.0fs processing time" % (
+        server.base_url, args.latency, args.failure_rate * 100, args.processing_time
+    ) )
+    print ( "Outputs and logs in %s" % work_folder )
+
+    # Convert once, so all the variants upload the same files without converting them:
+    conversion_time, code = RunObiwan ( cfg, "--convert", data_folder, os.path.join ( work_folder, "convert.log" ) )
+    converted = len ( glob.glob ( os.path.join ( netcdf_folder, '*.nc' ) ) )
+    print ( "Conversion: %.1fs, %d measurements (exit code %d)" % ( conversion_time, converted, code ) )
+
+    if code != 0 or converted == 0:
+        server.shutdown ()
+        sys.exit ( "No measurement was converted from %s, see %s" % ( data_folder, os.path.join ( work_folder, "convert.log" ) ) )
+
+    print ( "" )
+    print ( "%-52s %8s %8s %8s %9s %9s %10s" % ( "Arguments", "Time", "Uploads", "Status", "Products", "Failures", "Concurrent" ) )
+
+    for index, arguments in enumerate ( args.variants or DEFAULT_VARIANTS ):
+        # Each run starts with an empty SCC, without obiwan state except the conversion manifest:
+        scc.Reset ()
+
+        for name in ( RUN_STATE_FILE_NAME, SCC_INDEX_FILE_NAME, SWAP_FILE_NAME ):
+            if os.path.exists ( os.path.join ( netcdf_folder, name ) ):
+                os.remove ( os.path.join ( netcdf_folder, name ) )
+
+        wall_time, code = RunObiwan ( cfg, arguments, data_folder, os.path.join ( work_folder, "run%d.log" % ( index + 1 ) ) )
+        statistics = scc.statistics
+
+        print ( "%-52s %7.1fs %8d %8d %9d %9d %10d%s" % (
+            arguments,
+            wall_time,
+            statistics['uploads'],
+            statistics['status'],
+            statistics['downloads'],
+            statistics['failures'],
+            statistics['maximum_concurrent'],
+            "" if code == 0 else " (exit code %d, see run%d.log)" % ( code, index + 1 )
+        ) )
+
+    server.shutdown ()
+
+    if not args.keep:
+        shutil.rmtree ( work_folder, ignore_errors = True )
+
+if __name__ == "__main__":
+    main ()
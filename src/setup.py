@@ -31,7 +31,7 @@ def find_version(*file_paths):
 
 # Run setup
 setup(name='obiwan',
-      packages=['obiwan'],
+      packages=['obiwan', 'obiwan.lidarchive', 'obiwan.scripts'],
       version=find_version("obiwan", "__init__.py"),
       description='Package for automated lidar data processing using the Single Calculus Chain',
       long_description=long_description,
@@ -49,6 +49,7 @@ setup(name='obiwan',
       keywords='lidar licel',
       install_requires=[
         "atmospheric_lidar",
+        "numpy",
         "scc_access==0.11.0"
       ],
       entry_points={
@@ -0,0 +1,298 @@
+'''
+Equivalence tests of the array based segmentation (obiwan.lidarchive.segmentation)
+against the original list based Lidarchive.FilterByGap, FilterByLength and
+FilterByTime, which are kept below as reference.
+'''
+import random
+
+import pytest
+
+from obiwan.lidarchive.lidarchive import ChannelDescriptor, Lidarchive, from_epoch
+from obiwan.lidarchive.segmentation import epoch_arrays, gap_segments, key_ids, length_segments, time_segments
+
+# 2017-02-27 11:00:00 UTC
+FIRST_START = 1488193200
+
+SITES = ('Buchares', 'Buchares', 'Buchares', 'Magurele')
+
+CHANNEL_SETS = (
+    [ChannelDescriptor('BT0', 3.75, 1064, 1, 12, True, True), ChannelDescriptor('BC0', 3.75, 1064, 1, 0, False, True)],
+    [ChannelDescriptor('BC0', 3.75, 1064, 1, 0, False, True), ChannelDescriptor('BT0', 3.75, 1064, 1, 12, True, True)],
+    [ChannelDescriptor('BT1', 3.75, 532, 1, 12, True, True)],
+)
+
+MAX_GAP = 600
+MIN_LENGTH = 600
+
+
+def minute(seconds):
+    return seconds // 60 % 60
+
+
+def reference_filter_by_gap(measurements, max_gap, same_location=True):
+    if len(measurements) < 1:
+        return []
+
+    cset = [measurements[0]]
+    last_measurement = measurements[0]
+    distinct_sets = []
+
+    for measurement_index in range(1, len(measurements)):
+        previous_end = measurements[measurement_index - 1].EndEpoch()
+        current_start = measurements[measurement_index].StartEpoch()
+
+        gap_trigger = ((current_start - previous_end) > max_gap) or (
+                    measurements[measurement_index].HasSameChannelsAs(last_measurement) == False)
+
+        location_trigger = False
+        if same_location:
+            if measurements[measurement_index - 1].Site() != measurements[measurement_index].Site():
+                location_trigger = True
+
+        if gap_trigger == True or location_trigger == True:
+            distinct_sets.append(cset)
+
+            cset = []
+            last_measurement = measurements[measurement_index]
+
+        cset.append(measurements[measurement_index])
+
+    if len(cset) > 0:
+        distinct_sets.append(cset)
+
+    return distinct_sets
+
+
+def reference_filter_by_time(measurements, min_length, max_length, center_type):
+    remaining_hours = int(max_length / 3600)
+
+    if len(measurements) < 1:
+        return []
+
+    segments = []
+    segment = [measurements[0]]
+
+    if minute(measurements[0].EndEpoch()) - minute(measurements[0].StartEpoch()) < 0 and center_type == 1:
+        remaining_hours -= 1
+        if remaining_hours == 0:
+            segments.append(segment)
+            segment = []
+            remaining_hours = int(max_length / 3600)
+
+    if minute(measurements[0].StartEpoch()) <= 30 and minute(measurements[0].EndEpoch()) >= 30 and center_type == 0:
+        remaining_hours -= 1
+        if remaining_hours == 0:
+            segments.append(segment)
+            segment = []
+            remaining_hours = int(max_length / 3600)
+
+    for i in range(1, len(measurements)):
+        segment.append(measurements[i])
+        if minute(measurements[i].EndEpoch()) - minute(measurements[i].StartEpoch()) < 0 and center_type == 1:
+            remaining_hours -= 1
+            if remaining_hours == 0:
+                segments.append(segment)
+                segment = []
+                remaining_hours = int(max_length / 3600)
+            continue
+        if minute(measurements[i].StartEpoch()) - minute(measurements[i - 1].EndEpoch()) < 0 and center_type == 1:
+            remaining_hours -= 1
+            if remaining_hours == 0:
+                segments.append(segment)
+                segment = []
+                remaining_hours = int(max_length / 3600)
+            continue
+        if minute(measurements[i].StartEpoch()) < 30 and minute(measurements[i].EndEpoch()) >= 30 and center_type == 0:
+            remaining_hours -= 1
+            if remaining_hours == 0:
+                segments.append(segment)
+                segment = []
+                remaining_hours = int(max_length / 3600)
+            continue
+        if minute(measurements[i - 1].EndEpoch()) < 30 and minute(measurements[i].StartEpoch()) >= 30 and center_type == 0:
+            remaining_hours -= 1
+            if remaining_hours == 0:
+                segments.append(segment)
+                segment = []
+                remaining_hours = int(max_length / 3600)
+            continue
+
+    if len(segment) > 0:
+        segments.append(segment)
+
+    if len(segments) == 0:
+        return segments
+    if (segments[0][-1].EndEpoch() - segments[0][0].StartEpoch()) < min_length and len(segments) > 1:
+        segments[0].extend(segments[1])
+        segments.remove(segments[1])
+
+    if (segments[-1][-1].EndEpoch() - segments[-1][0].StartEpoch()) < min_length and len(segments) > 1:
+        segments[-2].extend(segments[-1])
+        segments.remove(segments[-1])
+    return segments
+
+
+def reference_filter_by_length(measurements, max_length, min_length):
+    if len(measurements) < 1:
+        return []
+
+    last_end = measurements[-1].EndEpoch()
+    segment_start = measurements[0].StartEpoch()
+    segments = []
+    segment = [measurements[0]]
+
+    for index in range(1, len(measurements)):
+        current_start = measurements[index].StartEpoch()
+
+        if (last_end - current_start) < min_length:
+            segment.extend(measurements[index:])
+            segments.append(segment)
+            break
+
+        if (current_start - segment_start) > max_length:
+            segments.append(segment)
+            segment = [measurements[index]]
+            segment_start = measurements[index].StartEpoch()
+            continue
+
+        segment.append(measurements[index])
+
+    return segments
+
+
+def measurement_file(index, start, end, site='Buchares', channels=CHANNEL_SETS[0]):
+    return Lidarchive.MeasurementFile('/data/RM%07d' % index, from_epoch(start), from_epoch(end), site, 'RM', channels)
+
+
+def files_from_times(times, **kwargs):
+    return [measurement_file(index, start, end, **kwargs) for index, (start, end) in enumerate(times)]
+
+
+def random_files(rng, mixed=False):
+    '''
+    Builds files sorted by start time, with gaps around MAX_GAP and durations crossing
+    the xx:00 and xx:30 marks. If mixed, the sites and channels change now and then.
+    '''
+    files = []
+    start = FIRST_START + rng.randrange(3600)
+
+    for index in range(rng.randrange(1, 60)):
+        duration = rng.choice((0, 1, 59, 60, 61, 299, 300, 600, 1800, rng.randrange(1, 1200)))
+        site = rng.choice(SITES) if mixed else SITES[0]
+        channels = rng.choice(CHANNEL_SETS) if mixed and rng.random() < 0.2 else CHANNEL_SETS[0]
+
+        files.append(measurement_file(index, start, start + duration, site, channels))
+
+        gap = rng.choice((0, 0, 0, 1, MAX_GAP - 1, MAX_GAP, MAX_GAP + 1, rng.randrange(3 * MAX_GAP)))
+        start += duration + gap
+
+    return files
+
+
+def segments_from_pairs(files, pairs):
+    return [files[first:stop] for first, stop in pairs]
+
+
+def assert_same_segments(segments, expected):
+    assert [[f.Filename() for f in segment] for segment in segments] == [[f.Filename() for f in segment] for segment in expected]
+
+
+def check_gap(files, max_gap, same_location):
+    starts, ends = epoch_arrays(files)
+    keys = [key_ids(f.signature for f in files)]
+
+    if same_location:
+        keys.append(key_ids(f.site for f in files))
+
+    expected = reference_filter_by_gap(files, max_gap, same_location)
+
+    assert_same_segments(segments_from_pairs(files, gap_segments(starts, ends, max_gap, *keys)), expected)
+    assert_same_segments(Lidarchive().FilterByGap(files, max_gap, same_location), expected)
+
+
+def check_length(files, max_length, min_length):
+    starts, ends = epoch_arrays(files)
+    expected = reference_filter_by_length(files, max_length, min_length)
+
+    assert_same_segments(segments_from_pairs(files, length_segments(starts, ends, max_length, min_length)), expected)
+    assert_same_segments(Lidarchive().FilterByLength(files, max_length, min_length), expected)
+
+
+def check_time(files, min_length, max_length, center_type):
+    starts, ends = epoch_arrays(files)
+    expected = reference_filter_by_time(files, min_length, max_length, center_type)
+
+    assert_same_segments(segments_from_pairs(files, time_segments(starts, ends, min_length, max_length, center_type)), expected)
+    assert_same_segments(Lidarchive().FilterByTime(files, min_length, max_length, center_type), expected)
+
+
+@pytest.mark.parametrize('seed', range(300))
+def test_gap_random(seed):
+    rng = random.Random(seed)
+    check_gap(random_files(rng, mixed=True), MAX_GAP, rng.random() < 0.7)
+
+
+@pytest.mark.parametrize('seed', range(300))
+def test_length_random(seed):
+    rng = random.Random(seed)
+    max_length = rng.choice((60, 600, 1800, 3600, 7200))
+    min_length = rng.choice((0, 60, MIN_LENGTH, max_length))
+    check_length(random_files(rng), max_length, min_length)
+
+
+@pytest.mark.parametrize('seed', range(300))
+@pytest.mark.parametrize('center_type', (-1, 0, 1, 2))
+def test_time_random(seed, center_type):
+    rng = random.Random(seed)
+    max_length = rng.choice((1800, 3600, 5400, 7200, 10800))
+    check_time(random_files(rng), rng.choice((0, 60, MIN_LENGTH, 3600)), max_length, center_type)
+
+
+def test_empty():
+    check_gap([], MAX_GAP, True)
+    check_length([], 3600, MIN_LENGTH)
+
+    for center_type in (-1, 0, 1):
+        check_time([], MIN_LENGTH, 3600, center_type)
+
+
+@pytest.mark.parametrize('duration', (0, 60, 1800, 3599))
+def test_single_file(duration):
+    # 11:20, so a 1800s file crosses the xx:30 mark and a 3599s file the xx:00 mark:
+    files = files_from_times([(FIRST_START + 1200, FIRST_START + 1200 + duration)])
+
+    check_gap(files, MAX_GAP, True)
+    check_length(files, 3600, MIN_LENGTH)
+
+    for center_type in (-1, 0, 1):
+        check_time(files, MIN_LENGTH, 3600, center_type)
+
+
+@pytest.mark.parametrize('gap', (MAX_GAP - 1, MAX_GAP, MAX_GAP + 1))
+def test_gap_threshold(gap):
+    files = files_from_times([(FIRST_START, FIRST_START + 60), (FIRST_START + 60 + gap, FIRST_START + 120 + gap)])
+    check_gap(files, MAX_GAP, True)
+
+
+@pytest.mark.parametrize('delta', (-1, 0, 1))
+def test_length_thresholds(delta):
+    # Files starting exactly max_length after the segment start, or exactly min_length
+    # before the end of the last file (give or take one second):
+    times = [(FIRST_START + index * 60, FIRST_START + index * 60 + 60) for index in range(120)]
+    times.append((times[-1][1] + delta, times[-1][1] + delta + 60))
+    files = files_from_times(times)
+
+    for max_length in (3600 + delta, 1800, 600 + delta):
+        for min_length in (MIN_LENGTH + delta, 60, 0):
+            check_length(files, max_length, min_length)
+
+
+@pytest.mark.parametrize('center_type', (-1, 0, 1, 2))
+def test_time_marks(center_type):
+    # One minute files from 10:58 to 14:02, touching the xx:00 and xx:30 marks exactly:
+    start = FIRST_START - 120
+    files = files_from_times([(start + index * 60, start + index * 60 + 60) for index in range(185)])
+
+    for max_length in (1800, 3600, 7200):
+        for min_length in (0, 120, 3600):
+            check_time(files, min_length, max_length, center_type)